@@ -7,6 +7,8 @@ import numpy as np
 import torch
 import torchvision.transforms as transforms
 from PIL import Image
+from dataset import read_image_file
+from dataset.seg_maps import SEG_MAP_FORMAT_NPY, save_seg_map
 from util._telegram import send_simple_message
 
 from BiSeNet.model import BiSeNet
@@ -81,6 +83,7 @@ def segment_images(
     output_maps_path_lst: Iterable,
     output_imgs_path_lst: Iterable,
     save_imgs: bool = False,
+    seg_map_format: str = SEG_MAP_FORMAT_NPY,
 ) -> None:
     net = BiSeNet(n_classes=N_CLASSES)
     net.cuda()
@@ -101,14 +104,14 @@ def segment_images(
             input_path_lst, output_maps_path_lst, output_imgs_path_lst
         ):
             step_time = time()
-            img = Image.open(input_img)
+            img = read_image_file(input_img).convert("RGB")
             image = img.resize((512, 512), Image.BILINEAR)
             img = to_tensor(image)
             img = torch.unsqueeze(img, 0)
             img = img.cuda()
             out = net(img)[0]
             parsing = out.squeeze(0).cpu().numpy().argmax(0)
-            np.save(output_map, parsing)
+            save_seg_map(output_map, parsing, seg_map_format=seg_map_format)
 
             if save_imgs:
                 vis_parsing_maps(
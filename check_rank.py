@@ -6,6 +6,12 @@ from pathlib import Path
 import pandas as pd
 
 from experiments.dlib_resnet_ga_approximation import calc_rank
+from experiments.experiment_dataset import (
+    ExperimentDataset,
+    get_experiment_dataset,
+    load_pairs_distances,
+)
+from fr.projection import projected_distances_path
 
 # Read params
 EXPERIMENT_ID = int(sys.argv[1])
@@ -27,8 +33,16 @@ EXPERIMENT_FOLDER = EXPERIMENT_ROOT_FOLDER.joinpath(
 
 DLIB_DISTANCES_FILE = Path("fr", "distances_dlib.json")
 RESNET_DISTANCES_FILE = Path("fr", "distances_resnet.json")
-RESNET_FACEPARTS_DISTANCES_FILE = Path("fr", "distances_resnet_faceparts_nb.json")
+# Projection of the ResNET faceparts features (e.g. "pca64", see fr.projection) or None for the full features
+RESNET_FACEPARTS_PROJECTION = None
+RESNET_FACEPARTS_DISTANCES_FILE = projected_distances_path(
+    Path("fr", "distances_resnet_faceparts_nb.json"), RESNET_FACEPARTS_PROJECTION
+)
 DLIB_DATASET_CLUSTERS_FILE = Path("fr", "dlib_clusters.json")
+# Preprocessed distances, with the ResNET distance (see experiments.experiment_dataset)
+EXPERIMENT_DATASET_FOLDER = projected_distances_path(
+    Path("fr", "experiment_dataset_check_rank_nb"), RESNET_FACEPARTS_PROJECTION
+)
 
 DLIB_RESNET_BEST_COMB = EXPERIMENT_FOLDER.joinpath("best_individual.json")
 DLIB_RESNET_BEST_COMBS = EXPERIMENT_FOLDER.joinpath("best_individuals.json")
@@ -42,97 +56,20 @@ CHECK_RANK_PREPEND = (
 )
 
 
-def prepare_distances():
-    tmp_raw_data = json.load(open(DLIB_DISTANCES_FILE, "r"))
-    dlib_distances = pd.DataFrame(
-        dict(
-            pair=tmp_raw_data.keys(),
-            dlib_distance=(d["dlib"] for d in tmp_raw_data.values()),
-        )
+def load_experiment_dataset() -> ExperimentDataset:
+    return get_experiment_dataset(
+        EXPERIMENT_DATASET_FOLDER,
+        lambda: load_pairs_distances(
+            DLIB_DISTANCES_FILE,
+            [(RESNET_DISTANCES_FILE, "resnet"), (RESNET_FACEPARTS_DISTANCES_FILE, None)],
+        ),
+        DLIB_DATASET_CLUSTERS_FILE,
     )
-    del tmp_raw_data
-
-    # ResNET Distances ({<pair>: distance})
-    tmp_raw_data = json.load(open(RESNET_DISTANCES_FILE, "r"))
-    resnet_distances = pd.DataFrame(
-        dict(pair=tmp_raw_data.keys(), resnet_distance=tmp_raw_data.values())
-    )
-    del tmp_raw_data
-
-    # ResNET Faceparts Distances
-    def rows_generator(resnet_faceparts_raw_data):
-        for pair, distances in resnet_faceparts_raw_data.items():
-            distances.update({"pair": pair})
-            yield distances
-
-    tmp_raw_data = json.load(open(RESNET_FACEPARTS_DISTANCES_FILE, "r"))
-    generator = rows_generator(tmp_raw_data)
-    del tmp_raw_data
-
-    resnet_faceparts_distances = pd.DataFrame(generator)
-
-    # Join distances into a sigle dataframe
-    distances = dlib_distances.merge(resnet_distances, on="pair", how="outer")
-    distances = distances.merge(resnet_faceparts_distances, on="pair", how="outer")
-
-    # Filter only images with "n" (from VGGFACE2)
-    distances = distances[distances.pair.apply(lambda p: "n" in p)]
-
-    # Generate extra columns
-    distances["img1"] = distances.pair.apply(lambda p: p.split(" x ")[0])
-    distances["img2"] = distances.pair.apply(lambda p: p.split(" x ")[1])
-    distances["person1"] = distances.img1.apply(lambda p: p.split("_")[0])
-    distances["person2"] = distances.img2.apply(lambda p: p.split("_")[0])
-    distances["same_person"] = (distances.person1 == distances.person2).apply(
-        lambda s: "same" if s else "different"
-    )
-
-    # Delete unnecessary columns
-    distances.drop(columns="pair", inplace=True)
-
-    # Sort columns by name
-    distances = distances.reindex(sorted(distances.columns), axis=1)
 
-    # Load clusters
-    if CLUSTER_ID is not None:
-        clusters_ref = pd.DataFrame(
-            data=json.load(open(DLIB_DATASET_CLUSTERS_FILE, "r"))
-        )
-        clusters_ref.set_index("label", inplace=True)
-
-        distances["img1_cluster"] = distances.img1.apply(
-            lambda i: clusters_ref.cluster.get(i, None)
-        )
-        distances["img2_cluster"] = distances.img2.apply(
-            lambda i: clusters_ref.cluster.get(i, None)
-        )
-
-        distances = distances[
-            (distances.img1_cluster == CLUSTER_ID)
-            & (distances.img2_cluster == CLUSTER_ID)
-        ]
-
-        del clusters_ref
 
-    # Normalize distances
-    img1_cluster_bkp = distances.img1_cluster
-    img2_cluster_bkp = distances.img2_cluster
-    distances_num = distances.select_dtypes(include="number")
-    for col in distances_num.columns:
-        distances_num[col] = (distances_num[col] - distances_num[col].min()) / (
-            distances_num[col].max() - distances_num[col].min()
-        )
-
-    distances[distances_num.columns] = distances_num
-    distances.img1_cluster = img1_cluster_bkp
-    distances.img2_cluster = img2_cluster_bkp
-
-    del dlib_distances
-    del resnet_distances
-    del resnet_faceparts_distances
-    del distances_num
-
-    return distances
+def prepare_distances():
+    # Distances already normalized inside the cluster
+    return load_experiment_dataset().to_dataframe(cluster=CLUSTER_ID, normalized=True)
 
 
 def get_resnet_comb_data(distances: pd.DataFrame):
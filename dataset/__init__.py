@@ -1,8 +1,34 @@
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from PIL import Image
 
+from dataset.seg_maps import (
+    SEG_MAP_FORMAT_COMPRESSED,
+    SEG_MAP_FORMAT_NPY,
+    SEG_MAP_FORMAT_RLE,
+    SEG_MAP_FORMATS,
+    load_seg_map,
+    migrate_seg_map,
+    save_seg_map,
+)
+from dataset.shards import (
+    DEFAULT_SHARD_MAX_SAMPLES,
+    SHARD_EXT_SEG_MAP,
+    ShardReader,
+    ShardWriter,
+    decode_image,
+    decode_seg_map,
+    encode_seg_map,
+    file_source,
+    sample_key,
+)
+
 DATASET_LFW = "lfw"
 DATASET_VGGFACE2 = "vggface2"
 __DATASETS = [DATASET_LFW, DATASET_VGGFACE2]
@@ -26,72 +52,310 @@ for dataset in __DATASETS:
 
 # Dataset index file
 ___DATASET_IDX = __ROOT_FOLDER.joinpath("dataset_index.pickle")
+___DATASET_IDX_MANIFEST = __ROOT_FOLDER.joinpath("dataset_index_manifest.json")
+__INDEX_COLUMNS = ["dataset", "kind", "person_name", "extension", "img_path"]
+__SCAN_WORKERS = 16
+__SHARDS_FOLDER = "shards"
 
 
-def get_dataset_index(recreate: bool = False, dataset: str = "all") -> pd.DataFrame:
+class DatasetCatalog:
     """
-    Generate the dataset index reference to improve image recovering performance.
+    In-memory dataset index, loaded once per process. The repeated columns are categorical and
+    the rows are grouped by (dataset, kind) and (dataset, kind, person_name), so the paths and
+    person queries are answered from the group indexes instead of scanning the whole index.
+    """
+
+    def __init__(self, dataset_idx: pd.DataFrame):
+        dataset_idx = dataset_idx.reset_index(drop=True)
+        for column in ["dataset", "kind", "person_name", "extension"]:
+            if column in dataset_idx:
+                dataset_idx[column] = dataset_idx[column].astype("category")
+
+        self.index = dataset_idx
+        self.__kind_groups = {}
+        self.__person_groups = {}
+        self.__names = {}  # {<kind>: {<image name>: <position>}}, built on first use
+        if len(dataset_idx) > 0:
+            self.__kind_groups = dataset_idx.groupby(
+                ["dataset", "kind"], observed=True, sort=False
+            ).indices
+            self.__person_groups = dataset_idx.groupby(
+                ["dataset", "kind", "person_name"], observed=True, sort=False
+            ).indices
+
+    def __len__(self):
+        return len(self.index)
+
+    def datasets(self) -> list:
+        return list(dict.fromkeys(ds for ds, _ in self.__kind_groups.keys()))
+
+    def __positions(
+        self, dataset: str = "all", kind: str = None, person_name: str = None
+    ) -> np.ndarray:
+        if person_name is not None:
+            if dataset != "all" and kind is not None:
+                return self.__person_groups.get(
+                    (dataset, kind, person_name), np.empty(0, dtype=np.intp)
+                )
+            positions = [
+                tmp_positions
+                for (
+                    tmp_dataset,
+                    tmp_kind,
+                    tmp_person,
+                ), tmp_positions in self.__person_groups.items()
+                if dataset in ("all", tmp_dataset)
+                and kind in (None, tmp_kind)
+                and tmp_person == person_name
+            ]
+            if not positions:
+                return np.empty(0, dtype=np.intp)
+            return np.sort(np.concatenate(positions))
+
+        positions = [
+            tmp_positions
+            for (tmp_dataset, tmp_kind), tmp_positions in self.__kind_groups.items()
+            if dataset in ("all", tmp_dataset) and kind in (None, tmp_kind)
+        ]
+        if not positions:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(positions))
+
+    def entries(
+        self, dataset: str = "all", kind: str = None, person_name: str = None
+    ) -> pd.DataFrame:
+        """
+        Index entries of a dataset ("all" for every dataset), optionally filtered by kind and person.
+        """
+        if dataset == "all" and kind is None and person_name is None:
+            return self.index.copy(deep=False)
+        return self.index.iloc[self.__positions(dataset, kind, person_name)]
+
+    def paths(self, dataset: str, kind: str, person_name: str = None) -> list:
+        positions = self.__positions(dataset, kind, person_name)
+        return self.index["img_path"].to_numpy()[positions].tolist()
+
+    def person_names(self, dataset: str, kind: str) -> list:
+        """
+        Person name of every image of a dataset kind (same order as paths()).
+        """
+        positions = self.__positions(dataset, kind)
+        return self.index["person_name"].to_numpy()[positions].tolist()
+
+    def persons(self, dataset: str, kind: str) -> list:
+        """
+        Unique person names of a dataset kind.
+        """
+        return [
+            tmp_person
+            for tmp_dataset, tmp_kind, tmp_person in self.__person_groups.keys()
+            if tmp_dataset == dataset and tmp_kind == kind
+        ]
+
+    def img_path(
+        self, dataset: str, kind: str, person_name: str, image_name: str
+    ) -> Path:
+        """
+        Indexed path of an image (None if the image is not in the index).
+        """
+        for tmp_path in self.paths(dataset, kind, person_name):
+            if Path(tmp_path).stem == image_name:
+                return Path(tmp_path)
+        return None
+
+    def find(self, image_name: str, kind: str) -> tuple:
+        """
+        Find an indexed image of a kind by its name, in any dataset.
+
+        Out:
+            (dataset, person_name, img_path) of the image, or None if the image is not in the index.
+        """
+        names = self.__names.get(kind, None)
+        if names is None:
+            positions = self.__positions(kind=kind)
+            img_paths = self.index["img_path"].to_numpy()[positions]
+            names = {
+                os.path.splitext(os.path.basename(tmp_path))[0]: position
+                for tmp_path, position in zip(img_paths, positions)
+            }
+            self.__names[kind] = names
+
+        position = names.get(image_name, None)
+        if position is None:
+            return None
+        entry = self.index.iloc[position]
+        return entry["dataset"], entry["person_name"], Path(entry["img_path"])
+
+    def iter_entries(
+        self,
+        dataset: str = "all",
+        kind: str = None,
+        chunk_size: int = 10000,
+    ):
+        """
+        Lazily iterate over the index entries in DataFrame chunks of "chunk_size" rows.
+        """
+        positions = self.__positions(dataset, kind)
+        for start in range(0, len(positions), chunk_size):
+            yield self.index.iloc[positions[start : start + chunk_size]]
+
+    def iter_paths(self, dataset: str = "all", kind: str = None):
+        """
+        Lazily iterate over the images paths.
+        """
+        img_paths = self.index["img_path"].to_numpy()
+        for position in self.__positions(dataset, kind):
+            yield img_paths[position]
+
+
+__catalog = None
+
+
+def __scan_person_folder(folder_info: tuple) -> list:
+    tmp_dataset, kind, person_folder = folder_info
+    return [
+        {
+            "dataset": tmp_dataset,
+            "kind": kind,
+            "person_name": person_folder.stem,
+            "extension": img_path.suffix,
+            "img_path": str(img_path),
+        }
+        for img_path in person_folder.iterdir()
+        if img_path.is_file()
+    ]
+
+
+def refresh_dataset_index(
+    full: bool = False, workers: int = __SCAN_WORKERS
+) -> pd.DataFrame:
+    """
+    Refresh the dataset index incrementally. Only the person folders whose modification time
+    changed since the last refresh (according to the stored folders manifest) are scanned, in parallel,
+    and their entries are merged into the existing index. Removed folders are dropped from the index.
 
     In:
-        recreate: If True, recreate the index file.
+        full: If True, scan all folders (recreate the index).
+        workers: Number of threads scanning folders.
     Out:
         Pandas DataFrame with the all dataset images references.
     """
-    if recreate or not ___DATASET_IDX.exists():
-        print("Creating the datasets index file, this can take a couple of minutes...")
-        entries = []
-        for tmp_dataset in __DATASETS:
-            for kind in __DATASET_KINDS:
-                tmp_folder = __ROOT_FOLDER.joinpath(tmp_dataset, kind)
-                for person_folder in tmp_folder.iterdir():
-                    for img_path in person_folder.iterdir():
-                        if img_path.is_file():
-                            entries.append(
-                                {
-                                    "dataset": tmp_dataset,
-                                    "kind": kind,
-                                    "person_name": person_folder.stem,
-                                    "extension": img_path.suffix,
-                                    "img_path": str(img_path),
-                                }
-                            )
-
-        dataset_idx = pd.DataFrame(entries)
-
-        # Save the index file
-        dataset_idx.to_pickle(___DATASET_IDX)
-
-        print("Datasets index file created!")
+    global __catalog
 
+    manifest = {}
+    dataset_idx = pd.DataFrame(columns=__INDEX_COLUMNS)
+    if not full and ___DATASET_IDX.exists() and ___DATASET_IDX_MANIFEST.exists():
+        manifest = json.load(open(___DATASET_IDX_MANIFEST, "r"))
+        dataset_idx = (
+            __catalog.index if __catalog is not None else pd.read_pickle(___DATASET_IDX)
+        )
     else:
-        dataset_idx = pd.read_pickle(___DATASET_IDX)
+        print("Creating the datasets index file, this can take a couple of minutes...")
 
-    if dataset == "all":
-        return dataset_idx
-    else:
-        return dataset_idx.loc[dataset_idx["dataset"] == dataset]
+    # Find the new/changed person folders
+    new_manifest = {}
+    folders_to_scan = []
+    for tmp_dataset in __DATASETS:
+        for kind in __DATASET_KINDS:
+            tmp_folder = __ROOT_FOLDER.joinpath(tmp_dataset, kind)
+            for person_folder in tmp_folder.iterdir():
+                if not person_folder.is_dir():
+                    continue
+                folder_key = f"{tmp_dataset}/{kind}/{person_folder.stem}"
+                new_manifest[folder_key] = person_folder.stat().st_mtime_ns
+                if manifest.get(folder_key, None) != new_manifest[folder_key]:
+                    folders_to_scan.append((tmp_dataset, kind, person_folder))
+
+    changed_keys = set(manifest.keys()) - set(new_manifest.keys())
+    changed_keys.update(f"{d}/{k}/{p.stem}" for d, k, p in folders_to_scan)
+
+    if not changed_keys and manifest:
+        print("Datasets index file up to date!")
+        __catalog = DatasetCatalog(dataset_idx) if __catalog is None else __catalog
+        return __catalog.entries()
+
+    with ThreadPool(processes=workers) as pool:
+        entries = [
+            entry
+            for folder_entries in pool.map(__scan_person_folder, folders_to_scan)
+            for entry in folder_entries
+        ]
+
+    # Merge the new entries with the ones of the unchanged folders
+    if len(dataset_idx) > 0:
+        folder_keys = (
+            dataset_idx["dataset"].astype(str)
+            + "/"
+            + dataset_idx["kind"].astype(str)
+            + "/"
+            + dataset_idx["person_name"].astype(str)
+        )
+        dataset_idx = dataset_idx.loc[~folder_keys.isin(changed_keys)]
+
+    dataset_idx = pd.concat(
+        [dataset_idx.astype(str), pd.DataFrame(entries, columns=__INDEX_COLUMNS)],
+        ignore_index=True,
+    )
+
+    # Save the index and manifest files
+    dataset_idx.to_pickle(___DATASET_IDX)
+    json.dump(new_manifest, open(___DATASET_IDX_MANIFEST, "w"))
+    __catalog = DatasetCatalog(dataset_idx)
+
+    print(
+        f"Datasets index file updated! ({len(folders_to_scan)} folders scanned, {len(changed_keys)} folders changed)"
+    )
+    return __catalog.entries()
+
+
+def get_dataset_catalog(recreate: bool = False) -> DatasetCatalog:
+    """
+    Get the (process wide) dataset catalog, loading the index file only once.
+
+    In:
+        recreate: If True, recreate the index file.
+    """
+    global __catalog
+    if recreate or not ___DATASET_IDX.exists():
+        refresh_dataset_index(full=True)
+    elif __catalog is None:
+        __catalog = DatasetCatalog(pd.read_pickle(___DATASET_IDX))
+
+    return __catalog
+
+
+def get_dataset_index(recreate: bool = False, dataset: str = "all") -> pd.DataFrame:
+    """
+    Generate the dataset index reference to improve image recovering performance.
+
+    In:
+        recreate: If True, recreate the index file.
+    Out:
+        Pandas DataFrame with the all dataset images references.
+    """
+    return get_dataset_catalog(recreate=recreate).entries(dataset=dataset)
 
 
 def get_raw_imgs_dataset_index() -> pd.DataFrame:
-    return get_dataset_index().loc[get_dataset_index()["kind"] == DATASET_KIND_RAW]
+    return get_dataset_catalog().entries(kind=DATASET_KIND_RAW)
 
 
 def get_aligned_imgs_dataset_index() -> pd.DataFrame:
-    return get_dataset_index().loc[get_dataset_index()["kind"] == DATASET_KIND_ALIGNED]
+    return get_dataset_catalog().entries(kind=DATASET_KIND_ALIGNED)
 
 
 def get_seg_maps_dataset_index() -> pd.DataFrame:
-    return get_dataset_index().loc[get_dataset_index()["kind"] == DATASET_KIND_SEG_MAP]
+    return get_dataset_catalog().entries(kind=DATASET_KIND_SEG_MAP)
 
 
 def info():
-    dataset_index = get_dataset_index()
-    datasets = dataset_index.dataset.unique()
+    catalog = get_dataset_catalog()
+    datasets = catalog.datasets()
     print(f"Datasets: {datasets}")
     for ds in datasets:
-        filtered = dataset_index.loc[dataset_index["dataset"] == ds]
+        filtered = catalog.entries(dataset=ds)
         print(f"Dataset: {ds}")
-        print(f"\tPersons: {len(filtered.person_name.unique())}")
+        print(f"\tPersons: {filtered.person_name.nunique()}")
         print(f"\tImages: {filtered.shape[0]}")
 
 
@@ -110,7 +374,94 @@ def get_file_path(
         raise ValueError(f"Invalid dataset: {dataset}")
 
 
+__shards_readers = {}
+__shards_readers_lock = threading.Lock()
+
+
+def get_shards_folder(dataset: str, kind: str) -> Path:
+    return __ROOT_FOLDER.joinpath(dataset, __SHARDS_FOLDER, kind)
+
+
+def get_shards_reader(dataset: str, kind: str) -> ShardReader:
+    """
+    Get the (process wide) reader of the packed shards of a dataset kind.
+    """
+    with __shards_readers_lock:
+        reader = __shards_readers.get((dataset, kind), None)
+        if reader is None:
+            reader = ShardReader(get_shards_folder(dataset, kind))
+            __shards_readers[(dataset, kind)] = reader
+    return reader
+
+
+def __is_packed(dataset: str, kind: str, key: str) -> bool:
+    """
+    The sample is packed and its file (if any) didn't change since it was packed (see pack_shards).
+    Samples packed without the stats of their file are always up to date.
+    """
+    reader = get_shards_reader(dataset, kind)
+    if key not in reader:
+        return False
+    source = reader.source(key)
+    if source is None:
+        return True
+
+    try:
+        stat = __ROOT_FOLDER.joinpath(
+            dataset, kind, key.rsplit("/", 1)[0], source[0]
+        ).stat()
+    except FileNotFoundError:
+        return True
+    return (stat.st_size, stat.st_mtime_ns) == source[1:]
+
+
+def pack_shards(
+    dataset: str, kind: str, max_samples: int = DEFAULT_SHARD_MAX_SAMPLES
+) -> int:
+    """
+    Pack the indexed aligned images or segmentation maps of a dataset into tar shards.
+    Segmentation maps are stored as uint8. Images already packed are skipped, unless their file changed
+    since they were packed (the stats of the files are saved in the shards index): they are packed again,
+    and the former copies are no longer read.
+
+    Out:
+        Number of packed images.
+    """
+    reader = get_shards_reader(dataset, kind)
+    count = 0
+    with ShardWriter(get_shards_folder(dataset, kind), max_samples=max_samples) as writer:
+        for img_path in get_dataset_catalog().iter_paths(dataset=dataset, kind=kind):
+            img_path = Path(img_path)
+            key = sample_key(img_path.parent.stem, img_path.stem)
+            source = file_source(img_path)
+            if key in reader and reader.source(key) == source:
+                continue
+
+            if kind == DATASET_KIND_SEG_MAP:
+                files = {SHARD_EXT_SEG_MAP: encode_seg_map(load_seg_map(img_path))}
+            else:
+                files = {img_path.suffix[1:]: img_path.read_bytes()}
+            writer.write(key, files, source=source)
+            count += 1
+
+    # New shards are visible to the next reader
+    with __shards_readers_lock:
+        old_reader = __shards_readers.pop((dataset, kind), None)
+    if old_reader is not None:
+        old_reader.close()
+    print(f"{count} {kind} images packed for {dataset}")
+    return count
+
+
 def read_aligned(dataset: str, person_name: str, image_name: str) -> Image:
+    """
+    Read an aligned image, from the shards when it is packed and up to date.
+    """
+    key = sample_key(person_name, image_name)
+    if __is_packed(dataset, DATASET_KIND_ALIGNED, key):
+        reader = get_shards_reader(dataset, DATASET_KIND_ALIGNED)
+        return decode_image(reader.read(key)).convert("RGB")
+
     return Image.open(
         get_file_path(
             dataset=dataset,
@@ -121,13 +472,147 @@ def read_aligned(dataset: str, person_name: str, image_name: str) -> Image:
     ).convert("RGB")
 
 
+def read_seg_map(dataset: str, person_name: str, image_name: str) -> np.ndarray:
+    """
+    Read a segmentation map, from the shards when it is packed and up to date.
+    """
+    key = sample_key(person_name, image_name)
+    if __is_packed(dataset, DATASET_KIND_SEG_MAP, key):
+        reader = get_shards_reader(dataset, DATASET_KIND_SEG_MAP)
+        return decode_seg_map(reader.read(key, SHARD_EXT_SEG_MAP))
+
+    return load_seg_map(
+        get_file_path(
+            dataset=dataset,
+            kind=DATASET_KIND_SEG_MAP,
+            person_name=person_name,
+            image_name=image_name,
+            file_extension=".npy",
+        )
+    )
+
+
+def find_packed_image(image_name: str, kind: str) -> tuple:
+    """
+    Find an image packed in the shards of a dataset kind by its name (see ShardReader.key_of).
+    Images whose file changed since they were packed are not packed (until they are packed again).
+
+    Out:
+        (dataset, person_name) of the image, or None if it is not packed.
+    """
+    for dataset in __DATASETS:
+        key = get_shards_reader(dataset, kind).key_of(image_name)
+        if key is not None and __is_packed(dataset, kind, key):
+            return dataset, key.rsplit("/", 1)[0]
+    return None
+
+
+def packed_image_version(
+    dataset: str, kind: str, person_name: str, image_name: str
+) -> tuple:
+    """
+    Version of a packed image (see find_packed_image), changing when it is packed again.
+    """
+    return get_shards_reader(dataset, kind).version(sample_key(person_name, image_name))
+
+
+def find_image(image_name: str, kind: str) -> tuple:
+    """
+    Find an image of a dataset kind by its name, packed in the shards (see find_packed_image) or indexed.
+    Raises FileNotFoundError if the image is not found.
+
+    Out:
+        (dataset, person_name) of the image.
+    """
+    packed = find_packed_image(image_name, kind)
+    if packed is not None:
+        return packed
+
+    indexed = get_dataset_catalog().find(image_name, kind)
+    if indexed is None:
+        raise FileNotFoundError(f"Image {image_name} not found ({kind})")
+    return indexed[0], indexed[1]
+
+
+def find_file_path(image_name: str, kind: str) -> Path:
+    """
+    Path of the file of an image of a dataset kind found by its name (see find_image). The file of a packed
+    image may not exist, read it with read_aligned or read_seg_map.
+    Raises FileNotFoundError if the image is not found.
+    """
+    indexed = get_dataset_catalog().find(image_name, kind)
+    if indexed is not None:
+        return indexed[2]
+
+    dataset, person_name = find_image(image_name, kind)
+    return get_file_path(
+        dataset=dataset,
+        kind=kind,
+        person_name=person_name,
+        image_name=image_name,
+        file_extension=".npy" if kind == DATASET_KIND_SEG_MAP else ".png",
+    )
+
+
+def split_file_path(file_path: Path) -> tuple:
+    """
+    Split the path of a file of the datasets folders.
+
+    Out:
+        (dataset, kind, person_name, image_name) of the file, or None if it is not a file of the datasets.
+    """
+    try:
+        parts = Path(file_path).resolve().relative_to(__ROOT_FOLDER.resolve()).parts
+    except ValueError:
+        return None
+    if len(parts) != 4 or parts[0] not in __DATASETS or parts[1] not in __DATASET_KINDS:
+        return None
+    return parts[0], parts[1], parts[2], os.path.splitext(parts[3])[0]
+
+
+def read_image_file(file_path: Path) -> Image:
+    """
+    Read an image file. The aligned images of the datasets are read with read_aligned (from the shards when
+    they are packed), the other files are opened as they are.
+    """
+    location = split_file_path(file_path)
+    if location is not None and location[1] == DATASET_KIND_ALIGNED:
+        return read_aligned(location[0], location[2], location[3])
+    return Image.open(file_path)
+
+
+def image_version(image_name: str, kind: str) -> tuple:
+    """
+    Version of an image of a dataset kind found by its name, changing when the image is rewritten: the packed
+    version of a packed image (see packed_image_version), or the size and modification time of its file.
+    """
+    packed = find_packed_image(image_name, kind)
+    if packed is not None:
+        return packed_image_version(packed[0], kind, packed[1], image_name)
+
+    stat = find_file_path(image_name, kind).stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def iter_shards(dataset: str, kind: str):
+    """
+    Sequentially iterate over the packed images of a dataset kind, yielding (person_name, image_name, data),
+    where data is a PIL image (aligned images) or a numpy array (segmentation maps).
+    """
+    for key, files in get_shards_reader(dataset, kind).iter_samples():
+        person_name, image_name = key.rsplit("/", 1)
+        if SHARD_EXT_SEG_MAP in files:
+            yield person_name, image_name, decode_seg_map(files[SHARD_EXT_SEG_MAP])
+        else:
+            yield person_name, image_name, decode_image(next(iter(files.values())))
+
+
 def ls_imgs_paths(dataset: str, kind: str = DATASET_KIND_RAW) -> list:
     """
     List the images paths.
     Out: A list with the raw images paths.
     """
-    entries = get_dataset_index(dataset=dataset)
-    return entries.loc[entries["kind"] == kind, "img_path"].tolist()
+    return get_dataset_catalog().paths(dataset, kind)
 
 
 def ls_imgs_person_names(dataset: str, kind: str = DATASET_KIND_RAW) -> list:
@@ -135,5 +620,4 @@ def ls_imgs_person_names(dataset: str, kind: str = DATASET_KIND_RAW) -> list:
     List the images paths.
     Out: A list with the raw images paths.
     """
-    entries = get_dataset_index(dataset=dataset)
-    return entries.loc[entries["kind"] == kind, "person_name"].tolist()
+    return get_dataset_catalog().person_names(dataset, kind)
@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+SEG_MAP_FORMAT_NPY = "npy"  # Plain uint8 .npy
+SEG_MAP_FORMAT_COMPRESSED = "compressed"  # Deflate compressed uint8 (.npz container)
+SEG_MAP_FORMAT_RLE = "rle"  # Row-major run-length encoding (.npz container)
+SEG_MAP_FORMATS = [SEG_MAP_FORMAT_NPY, SEG_MAP_FORMAT_COMPRESSED, SEG_MAP_FORMAT_RLE]
+
+_COMPRESSED_KEY = "seg_map"
+_RLE_VALUES_KEY = "rle_values"
+_RLE_LENGTHS_KEY = "rle_lengths"
+_RLE_SHAPE_KEY = "rle_shape"
+
+
+def rle_encode(seg_map: np.ndarray) -> tuple:
+    """
+    Run-length encode a segmentation map (row-major order).
+
+    :return: (values, lengths) of the runs.
+    """
+    flat = np.asarray(seg_map, dtype=np.uint8).ravel()
+    if flat.size == 0:
+        return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint32)
+
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    lengths = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+    return flat[starts], lengths
+
+
+def rle_decode(values: np.ndarray, lengths: np.ndarray, shape: tuple) -> np.ndarray:
+    return np.repeat(values.astype(np.uint8), lengths).reshape(shape)
+
+
+def save_seg_map(
+    file, seg_map: np.ndarray, seg_map_format: str = SEG_MAP_FORMAT_NPY
+) -> None:
+    """
+    Save a segmentation map as uint8 (there are less than 256 classes), optionally compressed.
+    Every format is read back by load_seg_map, whatever the file name.
+
+    :param file: File path or binary file object.
+    """
+    seg_map = np.asarray(seg_map).astype(np.uint8)
+    if isinstance(file, (str, Path)):
+        with open(file, "wb") as f:
+            return save_seg_map(f, seg_map, seg_map_format=seg_map_format)
+
+    if seg_map_format == SEG_MAP_FORMAT_NPY:
+        np.save(file, seg_map)
+    elif seg_map_format == SEG_MAP_FORMAT_COMPRESSED:
+        np.savez_compressed(file, **{_COMPRESSED_KEY: seg_map})
+    elif seg_map_format == SEG_MAP_FORMAT_RLE:
+        values, lengths = rle_encode(seg_map)
+        np.savez(
+            file,
+            **{
+                _RLE_VALUES_KEY: values,
+                _RLE_LENGTHS_KEY: lengths,
+                _RLE_SHAPE_KEY: np.asarray(seg_map.shape),
+            },
+        )
+    else:
+        raise ValueError(f"Invalid segmentation map format: {seg_map_format}")
+
+
+def load_seg_map(file) -> np.ndarray:
+    """
+    Load a segmentation map saved in any format (including the legacy int64 .npy files) as uint8.
+
+    :param file: File path or binary file object.
+    """
+    data = np.load(file)
+    if isinstance(data, np.ndarray):
+        return data.astype(np.uint8, copy=False)
+
+    with data:
+        if _COMPRESSED_KEY in data:
+            return data[_COMPRESSED_KEY]
+        return rle_decode(
+            data[_RLE_VALUES_KEY],
+            data[_RLE_LENGTHS_KEY],
+            tuple(data[_RLE_SHAPE_KEY]),
+        )
+
+
+def migrate_seg_map(
+    file_path: Path, seg_map_format: str = SEG_MAP_FORMAT_NPY
+) -> tuple:
+    """
+    Rewrite a segmentation map file in the given format (atomically, same file name).
+
+    :return: (old size, new size) in bytes.
+    """
+    file_path = Path(file_path)
+    old_size = file_path.stat().st_size
+    seg_map = load_seg_map(file_path)
+
+    tmp_path = file_path.with_suffix(".tmp")
+    save_seg_map(tmp_path, seg_map, seg_map_format=seg_map_format)
+    os.replace(tmp_path, file_path)
+
+    return old_size, file_path.stat().st_size
@@ -0,0 +1,231 @@
+import io
+import json
+import os
+import tarfile
+import threading
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from dataset.seg_maps import SEG_MAP_FORMAT_NPY, load_seg_map, save_seg_map
+
+SHARD_EXT_SEG_MAP = "seg.npy"
+
+_SHARD_PREFIX = "shard_"
+_SHARD_EXTENSION = ".tar"
+_INDEX_EXTENSION = ".index.json"
+_SOURCE_MEMBER = "_source"  # (file name, size, modification time) of the packed file, in the index
+DEFAULT_SHARD_MAX_SAMPLES = 10000
+
+
+def _shard_name(shard: int) -> str:
+    return f"{_SHARD_PREFIX}{shard:06d}{_SHARD_EXTENSION}"
+
+
+def _index_path(shard_path: Path) -> Path:
+    return shard_path.with_name(shard_path.name + _INDEX_EXTENSION)
+
+
+def sample_key(person_name: str, image_name: str) -> str:
+    return f"{person_name}/{image_name}"
+
+
+def encode_seg_map(
+    seg_map: np.ndarray, seg_map_format: str = SEG_MAP_FORMAT_NPY
+) -> bytes:
+    """
+    Segmentation maps are stored as uint8 .npy data (there are less than 256 classes), optionally compressed.
+    """
+    buffer = io.BytesIO()
+    save_seg_map(buffer, seg_map, seg_map_format=seg_map_format)
+    return buffer.getvalue()
+
+
+def decode_seg_map(data: bytes) -> np.ndarray:
+    return load_seg_map(io.BytesIO(data))
+
+
+def decode_image(data: bytes) -> Image:
+    return Image.open(io.BytesIO(data))
+
+
+class ShardWriter:
+    """
+    Write samples ({<ext>: bytes}) into packed (WebDataset-style) tar shards of up to "max_samples" samples.
+    The members are named "<person_name>/<image_name>.<ext>", so the shards can be read sequentially with
+    any tar reader, and a JSON index next to every shard keeps the members offsets for random access
+    (and the stats of the packed files, to find the ones rewritten after being packed).
+    New shards are numbered after the existing ones of the folder, so writing is incremental.
+    Shards and their indexes are written to temporary files and renamed when the shard is closed.
+    """
+
+    def __init__(self, folder: Path, max_samples: int = DEFAULT_SHARD_MAX_SAMPLES):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_samples = max_samples
+        self.__next_shard = len(list(self.folder.glob(f"*{_SHARD_EXTENSION}")))
+        self.__tar = None
+        self.__shard_path = None
+        self.__index = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __open_shard(self):
+        self.__shard_path = self.folder.joinpath(_shard_name(self.__next_shard))
+        self.__tar = tarfile.open(
+            self.__shard_path.with_suffix(".tmp"), mode="w", format=tarfile.GNU_FORMAT
+        )
+        self.__index = {}
+        self.__next_shard += 1
+
+    def write(self, key: str, files: dict, source: tuple = None) -> None:
+        """
+        Write a sample.
+
+        :param key: Sample key, "<person_name>/<image_name>" (see sample_key).
+        :param files: Dict with the files data of the sample ({<ext>: bytes}).
+        :param source: (file name, size, modification time) of the packed file (see file_source).
+        """
+        if self.__tar is None:
+            self.__open_shard()
+
+        members = {}
+        for ext, data in files.items():
+            tar_info = tarfile.TarInfo(f"{key}.{ext}")
+            tar_info.size = len(data)
+            self.__tar.addfile(tar_info, io.BytesIO(data))
+            # The data is the last (block padded) part of the member
+            data_blocks = -(-tar_info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members[ext] = [self.__tar.offset - data_blocks, tar_info.size]
+        if source is not None:
+            members[_SOURCE_MEMBER] = list(source)
+        self.__index[key] = members
+
+        if len(self.__index) >= self.max_samples:
+            self.close()
+
+    def close(self) -> None:
+        if self.__tar is None:
+            return
+
+        self.__tar.close()
+        tmp_index_path = _index_path(self.__shard_path).with_suffix(".tmp")
+        json.dump(self.__index, open(tmp_index_path, "w"))
+        os.replace(self.__shard_path.with_suffix(".tmp"), self.__shard_path)
+        os.replace(tmp_index_path, _index_path(self.__shard_path))
+        self.__tar = None
+
+
+def file_source(file_path: Path) -> tuple:
+    """
+    (file name, size, modification time) of a file to pack, saved in the shards index.
+    """
+    stat = os.stat(file_path)
+    return Path(file_path).name, stat.st_size, stat.st_mtime_ns
+
+
+class ShardReader:
+    """
+    Read samples from the tar shards of a folder, by key (random access) or sequentially.
+    A sample packed again is read from its last shard.
+    Random access reads are thread safe: the shards are read with positional reads (os.pread, or a lock
+    around seek and read where it is not available), so the threads never share a file position.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        self.__index = {}
+        self.__names = {}
+        self.__files = {}
+        self.__lock = threading.Lock()
+
+        for shard_path in sorted(self.folder.glob(f"*{_SHARD_EXTENSION}")):
+            if not _index_path(shard_path).exists():
+                continue
+            for key, members in json.load(open(_index_path(shard_path), "r")).items():
+                self.__index[key] = (shard_path, members)
+                self.__names[key.split("/")[-1]] = key
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__index
+
+    def keys(self) -> list:
+        return list(self.__index.keys())
+
+    def key_of(self, image_name: str) -> str:
+        """
+        Sample key of an image name (None if the image is not in the shards).
+        """
+        return self.__names.get(image_name, None)
+
+    def source(self, key: str) -> tuple:
+        """
+        (file name, size, modification time) of the packed file of a sample (None if it was not recorded).
+        """
+        source = self.__index[key][1].get(_SOURCE_MEMBER, None)
+        return None if source is None else tuple(source)
+
+    def version(self, key: str) -> tuple:
+        """
+        (shard name, offset) of a sample, changing when the sample is packed again.
+        """
+        shard_path, members = self.__index[key]
+        return shard_path.name, min(v[0] for e, v in members.items() if e != _SOURCE_MEMBER)
+
+    def read(self, key: str, ext: str = None) -> bytes:
+        """
+        Read a file of a sample (random access). Without "ext", the first file of the sample is read.
+        """
+        shard_path, members = self.__index[key]
+        if ext is None:
+            ext = next(e for e in members.keys() if e != _SOURCE_MEMBER)
+        offset, size = members[ext]
+        shard_file = self.__files.get(shard_path, None)
+        if shard_file is None:
+            with self.__lock:
+                shard_file = self.__files.get(shard_path, None)
+                if shard_file is None:
+                    shard_file = open(shard_path, "rb")
+                    self.__files[shard_path] = shard_file
+
+        if hasattr(os, "pread"):
+            return os.pread(shard_file.fileno(), size, offset)
+        with self.__lock:
+            shard_file.seek(offset)
+            return shard_file.read(size)
+
+    def iter_samples(self):
+        """
+        Iterate sequentially over all samples, yielding (key, {<ext>: bytes}). The former copies of the
+        samples packed again are skipped.
+        """
+        for shard_path in sorted({p for p, _ in self.__index.values()}):
+            key = None
+            files = {}
+            with tarfile.open(shard_path, mode="r|") as tar:
+                for member in tar:
+                    person_name, file_name = member.name.rsplit("/", 1)
+                    image_name, ext = file_name.split(".", 1)
+                    member_key = sample_key(person_name, image_name)
+                    if member_key != key and key is not None:
+                        if self.__index[key][0] == shard_path:
+                            yield key, files
+                        files = {}
+                    key = member_key
+                    files[ext] = tar.extractfile(member).read()
+            if key is not None and self.__index[key][0] == shard_path:
+                yield key, files
+
+    def close(self) -> None:
+        with self.__lock:
+            for shard_file in self.__files.values():
+                shard_file.close()
+            self.__files = {}
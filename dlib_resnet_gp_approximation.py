@@ -13,11 +13,22 @@ import numpy as np
 import pandas as pd
 from deap import algorithms, base, creator, gp, tools
 
+from experiments.experiment_dataset import (
+    ExperimentDataset,
+    get_experiment_dataset,
+    load_pairs_distances,
+)
+from experiments.rank_correlation import RankCorrelation
+from fr.projection import projected_distances_path
 from util._telegram import send_simple_message
 
 # TODO - Configure to use (or not) blank background in reset parts
 # RESNET_FACEPARTS_DISTANCES_FILE = Path("fr", "distances_resnet_faceparts.json")
-RESNET_FACEPARTS_DISTANCES_FILE = Path("fr", "distances_resnet_faceparts_nb.json")
+# Projection of the ResNET faceparts features (e.g. "pca64", see fr.projection) or None for the full features
+RESNET_FACEPARTS_PROJECTION = None
+RESNET_FACEPARTS_DISTANCES_FILE = projected_distances_path(
+    Path("fr", "distances_resnet_faceparts_nb.json"), RESNET_FACEPARTS_PROJECTION
+)
 
 # TODO When not using blank background, we need to ignore more combinations
 # RESNET_COLS_TO_IGNORE = [
@@ -44,6 +55,10 @@ RESNET_COLS_TO_IGNORE = [
 
 DLIB_DISTANCES_FILE = Path("fr", "distances_dlib.json")
 DLIB_DATASET_CLUSTERS_FILE = Path("fr", "dlib_clusters.json")
+# Preprocessed distances (see experiments.experiment_dataset), shared with the GA experiments
+EXPERIMENT_DATASET_FOLDER = projected_distances_path(
+    Path("fr", "experiment_dataset_nb"), RESNET_FACEPARTS_PROJECTION
+)
 
 RESULTS_FOLDER = Path(
     "experiments", f"{datetime.now().strftime('%Y%m%d%H%M%S')}_results_gp_nb"
@@ -75,97 +90,26 @@ RANK_ERROR_IMGS_LIMIT = 15
 RAND_SEED = 318
 
 
-def load_dlib_df_distances() -> pd.DataFrame:
-    print("Loading DLIB distances...")
-    # Load distances from raw files into dataframes
-
-    # DLIB Distances ( <pair>: {'dlib': distance}} )
-    tmp_raw_data = json.load(open(DLIB_DISTANCES_FILE, "r"))
-    dlib_distances = pd.DataFrame(
-        dict(
-            pair=tmp_raw_data.keys(),
-            dlib_distance=(d["dlib"] for d in tmp_raw_data.values()),
-        )
-    )
-    del tmp_raw_data
-
-    print("DLIB raw data loaded")
-
-    # ResNET Faceparts Distances
-    def rows_generator(resnet_faceparts_raw_data):
-        for pair, distances in resnet_faceparts_raw_data.items():
-            distances.update({"pair": pair})
-            yield distances
-
-    tmp_raw_data = json.load(open(RESNET_FACEPARTS_DISTANCES_FILE, "r"))
-
-    generator = rows_generator(tmp_raw_data)
-    del tmp_raw_data
-
-    resnet_faceparts_distances = pd.DataFrame(generator)
-
-    print("ResNET Faceparts raw data loaded")
-
-    # Join distances into a sigle dataframe
-    distances = dlib_distances.merge(resnet_faceparts_distances, on="pair", how="outer")
-
-    del dlib_distances
-    del resnet_faceparts_distances
-
-    print("DLIB and ResNET Faceparts distances joined")
-
-    # Filter only images with "n" (from VGGFACE2)
-    distances = distances[distances.pair.apply(lambda p: "n" in p)]
-
-    # Generate extra columns
-    distances["img1"] = distances.pair.apply(lambda p: p.split(" x ")[0])
-    distances["img2"] = distances.pair.apply(lambda p: p.split(" x ")[1])
-    distances["person1"] = distances.img1.apply(lambda p: p.split("_")[0])
-    distances["person2"] = distances.img2.apply(lambda p: p.split("_")[0])
-    distances["same_person"] = (distances.person1 == distances.person2).apply(
-        lambda s: "same" if s else "different"
-    )
-
-    # Delete unnecessary columns
-    distances.drop(columns="pair", inplace=True)
-
-    print("Distances extra columns generated")
-
-    # Sort columns by name
-    distances = distances.reindex(sorted(distances.columns), axis=1)
-
-    # Load clusters
-    clusters_ref = pd.DataFrame(data=json.load(open(DLIB_DATASET_CLUSTERS_FILE, "r")))
-    clusters_ref.set_index("label", inplace=True)
-
-    distances["img1_cluster"] = distances.img1.apply(
-        lambda i: clusters_ref.cluster.get(i, None)
-    )
-    distances["img2_cluster"] = distances.img2.apply(
-        lambda i: clusters_ref.cluster.get(i, None)
+def load_experiment_dataset() -> ExperimentDataset:
+    """
+    DLIB and ResNET Faceparts distances of the pairs of every cluster (shared with the GA experiments).
+    """
+    print("Loading experiment dataset...")
+    return get_experiment_dataset(
+        EXPERIMENT_DATASET_FOLDER,
+        lambda: load_pairs_distances(
+            DLIB_DISTANCES_FILE, [(RESNET_FACEPARTS_DISTANCES_FILE, None)]
+        ),
+        DLIB_DATASET_CLUSTERS_FILE,
     )
 
-    del clusters_ref
-
-    print("Clusters data added")
-
-    distances = distances.replace(inf, np.nan)
-    distances.dropna(inplace=True)
-
-    distances = distances[distances.img1 != distances.img2]  # Remove same image pairs
-
-    return distances.sort_values(by="dlib_distance", ascending=True)
-
 
 # ======================================================================================================
 # Run the experiments
 # ======================================================================================================
 
-distances = load_dlib_df_distances()
-clusters = set(distances.img1_cluster.unique()).union(
-    set(distances.img2_cluster.unique())
-)
-clusters = sorted(clusters)
+experiment_dataset = load_experiment_dataset()
+clusters = experiment_dataset.clusters
 
 print("Distances data loaded")
 
@@ -173,7 +117,7 @@ print("Distances data loaded")
 resnet_cols = list(
     filter(
         lambda c: ("resnet" in c) and (c not in RESNET_COLS_TO_IGNORE),
-        distances.columns,
+        experiment_dataset.columns,
     )
 )
 
@@ -199,24 +143,15 @@ def rank_error_gp(individual, cluster_norm_distances, resnet_distances_norm, too
     cluster_norm_distances = cluster_norm_distances.sort_values(
         by="dlib_distance", ascending=True, ignore_index=True
     )
-    by_comb_distances = cluster_norm_distances.sort_values(
-        by="combination", ascending=True, ignore_index=True
-    )
+    imgs_corrs = RankCorrelation(
+        cluster_norm_distances.img1, cluster_norm_distances.img2
+    ).correlations_series(cluster_norm_distances.combination.to_numpy())
 
     imgs = list(cluster_norm_distances.img1.unique())
     shuffle(imgs)
     corrs = []
     for img in imgs[:RANK_ERROR_IMGS_LIMIT]:
-        dlib_img_distances = cluster_norm_distances[
-            cluster_norm_distances.img1 == img
-        ].reset_index(drop=True)
-        comb_img_distances = by_comb_distances[
-            by_comb_distances.img1 == img
-        ].reset_index(drop=True)
-
-        tmp_corr = dlib_img_distances.img2.corr(
-            comb_img_distances.img2, method="kendall"
-        )
+        tmp_corr = imgs_corrs[img]
 
         if not np.isnan(tmp_corr):
             corrs.append(tmp_corr)
@@ -352,24 +287,14 @@ def calc_rank(individual, cluster_norm_distances, resnet_distances_norm, toolbox
     cluster_norm_distances.sort_values(
         by="dlib_distance", inplace=True, ascending=True, ignore_index=True
     )
-    by_comb_distances = cluster_norm_distances.sort_values(
-        by="combination", ascending=True, ignore_index=True
-    )
 
-    imgs = cluster_norm_distances.img1.unique()
-    corrs = []
-    for img in imgs:
-        dlib_img_distances = cluster_norm_distances[
-            cluster_norm_distances.img1 == img
-        ].reset_index(drop=True)
-        comb_img_distances = by_comb_distances[
-            by_comb_distances.img1 == img
-        ].reset_index(drop=True)
-
-        tmp_corr = dlib_img_distances.img2.corr(
-            comb_img_distances.img2, method="kendall"
-        )
+    # Kendall tau of all the images at once, between the DLIB and the combination orders
+    imgs_corrs = RankCorrelation(
+        cluster_norm_distances.img1, cluster_norm_distances.img2
+    ).correlations_series(cluster_norm_distances.combination.to_numpy())
 
+    corrs = []
+    for img, tmp_corr in imgs_corrs.items():
         if not np.isnan(tmp_corr):
             corrs.append(tmp_corr)
 
@@ -394,24 +319,14 @@ def gen_imgs_ranks(
     cluster_norm_distances.sort_values(
         by="dlib_distance", inplace=True, ascending=True, ignore_index=True
     )
-    by_comb_distances = cluster_norm_distances.sort_values(
-        by="combination", ascending=True, ignore_index=True
-    )
 
-    imgs = cluster_norm_distances.img1.unique()
-    corrs = []
-    for img in imgs:
-        dlib_img_distances = cluster_norm_distances[
-            cluster_norm_distances.img1 == img
-        ].reset_index(drop=True)
-        comb_img_distances = by_comb_distances[
-            by_comb_distances.img1 == img
-        ].reset_index(drop=True)
-
-        tmp_corr = dlib_img_distances.img2.corr(
-            comb_img_distances.img2, method="kendall"
-        )
+    # Kendall tau of all the images at once, between the DLIB and the combination orders
+    imgs_corrs = RankCorrelation(
+        cluster_norm_distances.img1, cluster_norm_distances.img2
+    ).correlations_series(cluster_norm_distances.combination.to_numpy())
 
+    corrs = []
+    for img, tmp_corr in imgs_corrs.items():
         if not np.isnan(tmp_corr):
             corrs.append({"img": img, "rank": tmp_corr})
 
@@ -568,10 +483,12 @@ def run_experiment():
         best = {}
         for cluster in clusters:
             exp_id += 1
-            cluster_distances = distances[
-                (distances.img1_cluster == cluster)
-                & (distances.img2_cluster == cluster)
-            ]
+            cluster_pairs = experiment_dataset.cluster_slice(cluster)
+            # The dataset distances are already normalized inside the cluster, unless only a subset is used
+            use_subset = cluster_pairs.stop - cluster_pairs.start > SUB_SET_SIZE
+            cluster_distances = experiment_dataset.to_dataframe(
+                cluster=cluster, normalized=not use_subset
+            ).sort_values(by="dlib_distance", ascending=True)
 
             cluster_distances = cluster_distances.iloc[:SUB_SET_SIZE]
 
@@ -594,13 +511,14 @@ def run_experiment():
             cluster_norm_distances = cluster_distances.copy()
 
             # Normalize numerical col
-            for col in resnet_cols + ["dlib_distance"]:
-                cluster_norm_distances[col] = (
-                    cluster_norm_distances[col] - cluster_norm_distances[col].min()
-                ) / (
-                    cluster_norm_distances[col].max()
-                    - cluster_norm_distances[col].min()
-                )
+            if use_subset:
+                for col in resnet_cols + ["dlib_distance"]:
+                    cluster_norm_distances[col] = (
+                        cluster_norm_distances[col] - cluster_norm_distances[col].min()
+                    ) / (
+                        cluster_norm_distances[col].max()
+                        - cluster_norm_distances[col].min()
+                    )
 
             resnet_distances_norm = cluster_norm_distances.loc[:, resnet_cols]
 
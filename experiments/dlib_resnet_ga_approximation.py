@@ -1,7 +1,6 @@
 # Face Recognition (FR) - DLIB ResNET Approximation with Genetic Algorithm
 
 import json
-import pickle
 from datetime import datetime
 from math import inf
 from pathlib import Path
@@ -13,12 +12,37 @@ import pandas as pd
 from deap import algorithms, base, creator, tools
 from scipy import stats
 
+from experiments.experiment_dataset import (
+    ExperimentDataset,
+    get_experiment_dataset,
+    load_pairs_distances,
+)
+from experiments.fitness_engine import (
+    FITNESS_ABS_ERROR,
+    FITNESS_MAE,
+    FITNESS_MAPE,
+    FITNESS_MSE,
+    FITNESS_STEP_ERROR,
+    FitnessEngine,
+    PopulationEvaluator,
+)
+from experiments.rank_correlation import RankCorrelation
+from fr.distances_store import get_distances_store
+from fr.knn_index import load_neighbors, neighbors_path, neighbors_to_df
+from fr.projection import projected_distances_path
 from util._telegram import send_simple_message
 
 # TODO - Configure to use (or not) blank background in reset parts
 # RESNET_FACEPARTS_DISTANCES_FILE = Path("fr", "distances_resnet_faceparts.json")
-RESNET_FACEPARTS_DISTANCES_FILE = Path("fr", "distances_resnet_faceparts_nb.json")
-DISTANCES_FILES_PKL = Path("fr", "distances.pickle")
+# Projection of the ResNET faceparts features (e.g. "pca64", see fr.projection) or None for the full features
+RESNET_FACEPARTS_PROJECTION = None
+RESNET_FACEPARTS_DISTANCES_FILE = projected_distances_path(
+    Path("fr", "distances_resnet_faceparts_nb.json"), RESNET_FACEPARTS_PROJECTION
+)
+# Preprocessed distances (see experiments.experiment_dataset)
+EXPERIMENT_DATASET_FOLDER = projected_distances_path(
+    Path("fr", "experiment_dataset_nb"), RESNET_FACEPARTS_PROJECTION
+)
 
 # TODO When not using blank background, we need to ignore more combinations
 # RESNET_COLS_TO_IGNORE = [
@@ -46,6 +70,15 @@ RESNET_COLS_TO_IGNORE = [
 DLIB_DISTANCES_FILE = Path("fr", "distances_dlib.json")
 DLIB_DATASET_CLUSTERS_FILE = Path("fr", "dlib_clusters.json")
 
+# Only consider the top k DLIB neighbors of every image (see gen_dlib_neighbors) instead of all the pairs.
+# None to use the full DLIB distances matrix.
+DLIB_NEIGHBORS_TOP_K = None
+DLIB_NEIGHBORS_FILE = neighbors_path(DLIB_DISTANCES_FILE)
+if DLIB_NEIGHBORS_TOP_K is not None:
+    EXPERIMENT_DATASET_FOLDER = EXPERIMENT_DATASET_FOLDER.with_name(
+        f"{EXPERIMENT_DATASET_FOLDER.name}_top{DLIB_NEIGHBORS_TOP_K}"
+    )
+
 # TODO When not usng blank background, we need to adjust the name of the experiments
 # RESULTS_FOLDER = Path("experiments", f"{datetime.now().strftime('%Y%m%d%H%M%S')}")
 RESULTS_FOLDER = Path(
@@ -81,99 +114,52 @@ RECOVER_FITNESS_TOP_N = 25
 FITNESS_CACHING_LIMIT = 1000000
 
 
-def load_dlib_df_distances() -> pd.DataFrame:
-    # Try to load the pre-processed distances from pickle file
-    try:
-        print("Loading DLIB distances from pickle file...")
-        distances = pickle.load(open(DISTANCES_FILES_PKL, "rb"))
-    except:
-        # Load distances from raw files into dataframes
-        # DLIB Distances ( <pair>: {'dlib': distance}} )
-        print("No distances pickle file found. Loading DLIB Raw distances data...")
-        tmp_raw_data = json.load(open(DLIB_DISTANCES_FILE, "r"))
-
-        dlib_distances = pd.DataFrame(
-            dict(
-                pair=tmp_raw_data.keys(),
-                dlib_distance=(d["dlib"] for d in tmp_raw_data.values()),
-            )
-        )
-        del tmp_raw_data
-
-        # ResNET Faceparts Distances
-        def rows_generator(resnet_faceparts_raw_data):
-            for pair, distances in resnet_faceparts_raw_data.items():
-                distances.update({"pair": pair})
-                yield distances
-
-        print("Loading ResNET Faceparts distances from json file...")
-        tmp_raw_data = json.load(open(RESNET_FACEPARTS_DISTANCES_FILE, "r"))
-
-        generator = rows_generator(tmp_raw_data)
-        del tmp_raw_data
-
-        resnet_faceparts_distances = pd.DataFrame(generator)
-
-        print("ResNET Faceparts raw data loaded")
-
-        # Join distances into a sigle dataframe
-        distances = dlib_distances.merge(
-            resnet_faceparts_distances, on="pair", how="outer"
-        )
-
-        del dlib_distances
-        del resnet_faceparts_distances
-
-        print("DLIB and ResNET Faceparts distances joined")
-
-        # Filter only images with "n" (from VGGFACE2)
-        distances = distances[distances.pair.apply(lambda p: "n" in p)]
-
-        # Generate extra columns
-        distances["img1"] = distances.pair.apply(lambda p: p.split(" x ")[0])
-        distances["img2"] = distances.pair.apply(lambda p: p.split(" x ")[1])
-        distances["person1"] = distances.img1.apply(lambda p: p.split("_")[0])
-        distances["person2"] = distances.img2.apply(lambda p: p.split("_")[0])
-        distances["same_person"] = (distances.person1 == distances.person2).apply(
-            lambda s: "same" if s else "different"
-        )
-
-        # Delete unnecessary columns
-        distances.drop(columns="pair", inplace=True)
+def load_dlib_neighbors_df_distances() -> pd.DataFrame:
+    """
+    DLIB and ResNET Faceparts distances of the top "DLIB_NEIGHBORS_TOP_K" DLIB neighbors of every image.
+    Only these pairs are read from the ResNET Faceparts distances store.
+    """
+    print("Loading DLIB neighbors...")
+    names, idxes, neighbors_distances = load_neighbors(DLIB_NEIGHBORS_FILE)
+    dlib_distances = neighbors_to_df(
+        names,
+        idxes[:, :DLIB_NEIGHBORS_TOP_K],
+        neighbors_distances[:, :DLIB_NEIGHBORS_TOP_K],
+        key="dlib_distance",
+    )
 
-        print("Distances extra columns generated")
+    print("Loading ResNET Faceparts distances of the neighbors...")
+    resnet_store = get_distances_store(RESNET_FACEPARTS_DISTANCES_FILE, readonly=True)
+    in_store = dlib_distances.img1.isin(resnet_store.names) & dlib_distances.img2.isin(
+        resnet_store.names
+    )
+    dlib_distances = dlib_distances[in_store]
+    resnet_faceparts_distances = resnet_store.pairs_to_dataframe(
+        dlib_distances.img1.astype(str).tolist(), dlib_distances.img2.astype(str).tolist()
+    )
 
-        # Sort columns by name
-        distances = distances.reindex(sorted(distances.columns), axis=1)
+    resnet_faceparts_distances["dlib_distance"] = dlib_distances.dlib_distance.to_numpy()
+    return resnet_faceparts_distances
 
-        # Load clusters
-        clusters_ref = pd.DataFrame(
-            data=json.load(open(DLIB_DATASET_CLUSTERS_FILE, "r"))
-        )
-        clusters_ref.set_index("label", inplace=True)
 
-        distances["img1_cluster"] = distances.img1.apply(
-            lambda i: clusters_ref.cluster.get(i, None)
-        )
-        distances["img2_cluster"] = distances.img2.apply(
-            lambda i: clusters_ref.cluster.get(i, None)
+def load_experiment_dataset() -> ExperimentDataset:
+    """
+    DLIB and ResNET Faceparts distances of the pairs of every cluster, preprocessed the first time.
+    """
+    print("Loading experiment dataset...")
+    if DLIB_NEIGHBORS_TOP_K is not None:
+        load_distances = load_dlib_neighbors_df_distances
+    else:
+        load_distances = lambda: load_pairs_distances(
+            DLIB_DISTANCES_FILE, [(RESNET_FACEPARTS_DISTANCES_FILE, None)]
         )
+    return get_experiment_dataset(
+        EXPERIMENT_DATASET_FOLDER, load_distances, DLIB_DATASET_CLUSTERS_FILE
+    )
 
-        del clusters_ref
-
-        print("Clusters data added")
-
-        distances = distances.replace(inf, np.nan)
-        distances.dropna(inplace=True)
-
-        distances = distances[
-            distances.img1 != distances.img2
-        ]  # Remove same image pairs
-
-        print("Saving distances to pickle file...")
-        pickle.dump(distances, open(DISTANCES_FILES_PKL, "wb"))
 
-    return distances.round(8).reset_index(drop=True)
+def load_dlib_df_distances() -> pd.DataFrame:
+    return load_experiment_dataset().to_dataframe().round(8)
 
 
 # ======================================================================================================
@@ -209,7 +195,9 @@ def add_cached_fitness(individual, fitness):
 
 
 # Fitness Function
-def rank_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def rank_error(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     """
     Calculate the Mean Squared Error (MSE) of the individual as a measure of fitness
     """
@@ -224,35 +212,25 @@ def rank_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
     if cached_fitness is not None:
         return cached_fitness
 
-    # Remove equal images
-    norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    # Calculate the Distance with the ResNet Combination
-    norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-    norm_distances.combination = norm_distances.combination.round(8)
+    if fitness_engine is None:
+        fitness_engine = FitnessEngine(
+            cluster_norm_distances,
+            resnet_distances_norm,
+            step_threshold=STEP_ERROR_DLIB_THRESHOLD,
+        )
 
-    # Sort by the Dlib Distance and the Combination Distance.
-    # The distances are sorted by dlib by default
-    by_comb_distances = norm_distances.sort_values(
-        by="combination", ascending=True, ignore_index=True
+    # Kendall tau of all the images at once (the distances are sorted by dlib by default)
+    imgs_corrs = fitness_engine.rank_correlations(individual)
+    imgs_sizes = pd.Series(
+        fitness_engine.rank_correlation.sizes, index=fitness_engine.rank_correlation.imgs
     )
 
     corrs = []
     for img in imgs[:RANK_ERROR_IMGS_LIMIT]:
-        dlib_img2_sequence = (
-            norm_distances[norm_distances.img1 == img].reset_index(drop=True).img2
-        )
-
-        if len(dlib_img2_sequence) < RANK_ERROR_MIN_IMGS:
+        if imgs_sizes.get(img, 0) < RANK_ERROR_MIN_IMGS:
             continue
 
-        comb_img2_sequence = (
-            by_comb_distances[by_comb_distances.img1 == img].reset_index(drop=True).img2
-        )
-
-        tmp_corr = dlib_img2_sequence.corr(comb_img2_sequence, method="kendall")
+        tmp_corr = imgs_corrs[img]
 
         if not np.isnan(tmp_corr):
             corrs.append(round(tmp_corr, 8))
@@ -265,7 +243,9 @@ def rank_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
     return fitness
 
 
-def recover_fitness(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def recover_fitness(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     individual_sum = sum(individual)
 
     if individual_sum == 0 or any((i < 0 for i in individual)):
@@ -321,200 +301,117 @@ def recover_fitness(individual, cluster_norm_distances, resnet_distances_norm, i
     return fitness
 
 
-def mse(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def evaluate_fitness(
+    individual,
+    fitness_function: str,
+    cluster_norm_distances,
+    resnet_distances_norm,
+    fitness_engine: FitnessEngine = None,
+):
     """
-    Calculate the Mean Squared Error (MSE) of the individual as a measure of fitness
+    Evaluate an individual with the fitness engine of its cluster (see FitnessEngine).
+    Without "fitness_engine", one is built from the cluster distances (slower, for single evaluations).
     """
     individual_sum = sum(individual)
 
     if individual_sum == 0 or any((i < 0 for i in individual)):
         return (inf,)
 
-    individual = [i / individual_sum for i in individual]
-
-    cached_fitness = get_cached_fitness(individual)
+    cached_fitness = get_cached_fitness([i / individual_sum for i in individual])
     if cached_fitness is not None:
         return cached_fitness
 
-    cluster_norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    cluster_norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-    cluster_norm_distances.loc[:, "error"] = (
-        cluster_norm_distances.combination - cluster_norm_distances.dlib_distance
-    )
-    cluster_norm_distances.loc[:, "sqr_error"] = (
-        cluster_norm_distances.error.abs() + 1
-    ) ** 2  # Avoid squared of fractions
+    if fitness_engine is None:
+        fitness_engine = FitnessEngine(
+            cluster_norm_distances,
+            resnet_distances_norm,
+            step_threshold=STEP_ERROR_DLIB_THRESHOLD,
+        )
 
     # Shall return a tuple for compatibility with DEAP
-    fitness = (
-        cluster_norm_distances[
-            cluster_norm_distances.sqr_error != inf
-        ].sqr_error.mean(),
-    )
+    fitness = fitness_engine.evaluate(individual, fitness_function)
 
-    add_cached_fitness(individual=individual, fitness=fitness)
+    add_cached_fitness(
+        individual=[i / individual_sum for i in individual], fitness=fitness
+    )
 
     return fitness
 
 
-def mae(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def mse(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     """
-    Calculate the Mean Absolute Error (MAE) of the individual as a measure of fitness
+    Calculate the Mean Squared Error (MSE) of the individual as a measure of fitness
     """
-
-    individual_sum = sum(individual)
-
-    if individual_sum == 0 or any((i < 0 for i in individual)):
-        return (inf,)
-
-    individual = [i / individual_sum for i in individual]
-
-    cached_fitness = get_cached_fitness(individual)
-    if cached_fitness is not None:
-        return cached_fitness
-
-    cluster_norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    cluster_norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-    cluster_norm_distances.loc[:, "error"] = (
-        cluster_norm_distances.combination - cluster_norm_distances.dlib_distance
-    )
-
-    # Shall return a tuple for compatibility with DEAP
-    fitness = (
-        cluster_norm_distances[cluster_norm_distances.error != inf].error.abs().mean(),
+    return evaluate_fitness(
+        individual,
+        FITNESS_MSE,
+        cluster_norm_distances,
+        resnet_distances_norm,
+        fitness_engine=fitness_engine,
     )
 
-    add_cached_fitness(individual=individual, fitness=fitness)
-
-    return fitness
-
 
-def abs_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def mae(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     """
-    Calculate the Absolute Error Sum of the individual as a measure of fitness
+    Calculate the Mean Absolute Error (MAE) of the individual as a measure of fitness
     """
-
-    individual_sum = sum(individual)
-
-    if individual_sum == 0 or any((i < 0 for i in individual)):
-        return (inf,)
-
-    individual = [i / individual_sum for i in individual]
-
-    cached_fitness = get_cached_fitness(individual)
-    if cached_fitness is not None:
-        return cached_fitness
-
-    cluster_norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    cluster_norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-    cluster_norm_distances.loc[:, "error"] = (
-        cluster_norm_distances.combination - cluster_norm_distances.dlib_distance
-    )
-
-    # Shall return a tuple for compatibility with DEAP
-    fitness = (
-        cluster_norm_distances[cluster_norm_distances.error != inf].error.abs().sum(),
+    return evaluate_fitness(
+        individual,
+        FITNESS_MAE,
+        cluster_norm_distances,
+        resnet_distances_norm,
+        fitness_engine=fitness_engine,
     )
 
-    add_cached_fitness(individual=individual, fitness=fitness)
-
-    return fitness
-
 
-def mape_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def abs_error(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     """
     Calculate the Absolute Error Sum of the individual as a measure of fitness
     """
-
-    individual_sum = sum(individual)
-
-    if individual_sum == 0 or any((i < 0 for i in individual)):
-        return (inf,)
-
-    individual = [i / individual_sum for i in individual]
-
-    cached_fitness = get_cached_fitness(individual)
-    if cached_fitness is not None:
-        return cached_fitness
-
-    cluster_norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    cluster_norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-    cluster_norm_distances.loc[:, "error"] = (
-        np.fabs(
-            cluster_norm_distances.dlib_distance - cluster_norm_distances.combination
-        )
-        / cluster_norm_distances.dlib_distance
-    )
-
-    # Shall return a tuple for compatibility with DEAP
-    fitness = (
-        cluster_norm_distances[cluster_norm_distances.error != inf].error.mean(),
+    return evaluate_fitness(
+        individual,
+        FITNESS_ABS_ERROR,
+        cluster_norm_distances,
+        resnet_distances_norm,
+        fitness_engine=fitness_engine,
     )
 
-    add_cached_fitness(individual=individual, fitness=fitness)
 
-    return fitness
+def mape_error(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
+    """
+    Calculate the Mean Absolute Percentage Error (MAPE) of the individual as a measure of fitness
+    """
+    return evaluate_fitness(
+        individual,
+        FITNESS_MAPE,
+        cluster_norm_distances,
+        resnet_distances_norm,
+        fitness_engine=fitness_engine,
+    )
 
 
-def step_error(individual, cluster_norm_distances, resnet_distances_norm, imgs):
+def step_error(
+    individual, cluster_norm_distances, resnet_distances_norm, imgs, fitness_engine=None
+):
     """
     Calculate the Step differente of the individual as a measure of fitness
     """
-
-    individual_sum = sum(individual)
-
-    if individual_sum == 0 or any((i < 0 for i in individual)):
-        return (inf,)
-
-    individual = [(i / individual_sum) for i in individual]
-
-    cached_fitness = get_cached_fitness(individual)
-    if cached_fitness is not None:
-        return cached_fitness
-
-    cluster_norm_distances = cluster_norm_distances[
-        cluster_norm_distances.img1 != cluster_norm_distances.img2
-    ].copy()
-
-    cluster_norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
-
-    # Pandas Like Error
-    cluster_norm_distances.loc[
-        :, "dlib_same_person"
-    ] = cluster_norm_distances.dlib_distance.apply(
-        lambda c: 1 if c < STEP_ERROR_DLIB_THRESHOLD else 0
-    )
-    cluster_norm_distances.loc[
-        :, "comb_same_person"
-    ] = cluster_norm_distances.combination.apply(
-        lambda c: 1 if c < STEP_ERROR_DLIB_THRESHOLD else 0
-    )
-    cluster_norm_distances.loc[:, "error"] = (
-        cluster_norm_distances.comb_same_person
-        - cluster_norm_distances.dlib_same_person
+    return evaluate_fitness(
+        individual,
+        FITNESS_STEP_ERROR,
+        cluster_norm_distances,
+        resnet_distances_norm,
+        fitness_engine=fitness_engine,
     )
 
-    # Shall return a tuple for compatibility with DEAP
-    fitness = (
-        cluster_norm_distances[cluster_norm_distances.error != inf].error.abs().sum(),
-    )
-
-    add_cached_fitness(individual=individual, fitness=fitness)
-
-    return fitness
-
 
 ERROR_FUNCTIONS = {
     "mse": mse,
@@ -527,6 +424,15 @@ ERROR_FUNCTIONS = {
 }
 ERROR_FUNCTIONS_NAMES = list(ERROR_FUNCTIONS.keys())
 
+# Error functions calculated by the fitness engine, evaluated population by population
+ENGINE_FITNESS_FUNCTIONS = {
+    mse: FITNESS_MSE,
+    mae: FITNESS_MAE,
+    abs_error: FITNESS_ABS_ERROR,
+    mape_error: FITNESS_MAPE,
+    step_error: FITNESS_STEP_ERROR,
+}
+
 
 def calc_rank(
     individual,
@@ -548,12 +454,9 @@ def calc_rank(
     # Calculate the Distance with the ResNet Combination
     norm_distances.loc[:, "combination"] = resnet_distances_norm.dot(individual)
 
-    # Sort by the Dlib Distance and the Combination Distance
+    # Sort by the Dlib Distance
     by_dlib_distances = norm_distances.sort_values(
-        by="dlib_distance", ascending=True, ignore_index=True
-    )
-    by_comb_distances = norm_distances.sort_values(
-        by="combination", ascending=True, ignore_index=True
+        by="dlib_distance", ascending=True, ignore_index=True, kind="stable"
     )
 
     if save_data:
@@ -565,28 +468,32 @@ def calc_rank(
             )
             by_dlib_distances.to_excel(output_path)
 
-    imgs = by_dlib_distances.img1.unique()
-    corrs = []
-    corrs_by_img = []
-
-    for img in imgs:
-        dlib_img2_sequence = (
-            by_dlib_distances[by_dlib_distances.img1 == img].reset_index(drop=True).img2
+    # Kendall tau of all the images at once, between the DLIB and the combination orders
+    rank_correlation = RankCorrelation(by_dlib_distances.img1, by_dlib_distances.img2)
+    if use_scipy:
+        imgs_corrs = pd.Series(
+            {
+                img: stats.kendalltau(
+                    x=by_dlib_distances[by_dlib_distances.img1 == img].img2.tolist(),
+                    y=norm_distances[norm_distances.img1 == img]
+                    .sort_values(by="combination", kind="stable")
+                    .img2.tolist(),
+                ).correlation
+                for img in rank_correlation.imgs
+            }
+        )
+    else:
+        imgs_corrs = rank_correlation.correlations_series(
+            by_dlib_distances.combination.to_numpy()
         )
 
-        if len(dlib_img2_sequence) < RANK_ERROR_MIN_IMGS:
+    corrs = []
+    corrs_by_img = []
+    for img, size in zip(rank_correlation.imgs, rank_correlation.sizes):
+        if size < RANK_ERROR_MIN_IMGS:
             continue
 
-        comb_img2_sequence = (
-            by_comb_distances[by_comb_distances.img1 == img].reset_index(drop=True).img2
-        )
-
-        if use_scipy:
-            tmp_corr = stats.kendalltau(
-                x=dlib_img2_sequence, y=comb_img2_sequence.tolist()
-            ).correlation
-        else:
-            tmp_corr = dlib_img2_sequence.corr(comb_img2_sequence, method="kendall")
+        tmp_corr = imgs_corrs[img]
 
         if not np.isnan(tmp_corr):
             corrs.append(tmp_corr)
@@ -614,6 +521,27 @@ def calc_rank(
     )
 
 
+def calc_engine_rank(individual, fitness_engine: FitnessEngine) -> tuple:
+    """
+    Same ranks as calc_rank (without saving data), with the fitness engine of the cluster.
+    """
+    imgs_corrs = fitness_engine.rank_correlations(individual)
+    if imgs_corrs is None:
+        return (np.nan, np.nan, np.nan, np.nan)
+
+    corrs = imgs_corrs.to_numpy()[
+        fitness_engine.rank_correlation.sizes >= RANK_ERROR_MIN_IMGS
+    ]
+    corrs = corrs[~np.isnan(corrs)]
+
+    return (
+        round(np.min(corrs), 8),
+        round(np.max(corrs), 8),
+        round(np.median(corrs), 8),
+        round(np.mean(corrs), 8),
+    )
+
+
 def run_experiment(params_comb=None):
     distances = load_dlib_df_distances()
     clusters = set(distances.img1_cluster.unique()).union(
@@ -737,6 +665,13 @@ def run_experiment(params_comb=None):
             imgs = list(cluster_norm_distances.img1.unique())
             shuffle(imgs)
 
+            # DLIB and ResNET distances of the cluster as float32 arrays, shared by all the evaluations
+            fitness_engine = FitnessEngine(
+                cluster_norm_distances,
+                resnet_distances_norm,
+                step_threshold=STEP_ERROR_DLIB_THRESHOLD,
+            )
+
             # Prepare DEAP
             toolbox = base.Toolbox()
             toolbox.register("attr_float", random)
@@ -748,13 +683,22 @@ def run_experiment(params_comb=None):
                 n=IND_SIZE,
             )
             toolbox.register("population", tools.initRepeat, list, toolbox.individual)
-            toolbox.register(
-                "evaluate",
-                current_error_fun,
-                cluster_norm_distances=cluster_norm_distances,
-                resnet_distances_norm=resnet_distances_norm,
-                imgs=imgs,
-            )
+            if current_error_fun in ENGINE_FITNESS_FUNCTIONS:
+                # Evaluate whole populations at once (see PopulationEvaluator)
+                evaluator = PopulationEvaluator(
+                    fitness_engine, ENGINE_FITNESS_FUNCTIONS[current_error_fun]
+                )
+                toolbox.register("evaluate", evaluator)
+                toolbox.register("map", evaluator.map)
+            else:
+                toolbox.register(
+                    "evaluate",
+                    current_error_fun,
+                    cluster_norm_distances=cluster_norm_distances,
+                    resnet_distances_norm=resnet_distances_norm,
+                    imgs=imgs,
+                    fitness_engine=fitness_engine,
+                )
             toolbox.register("mate", tools.cxTwoPoint)
             toolbox.register("mutate", tools.mutFlipBit, indpb=current_indpb)
             toolbox.register("select", tools.selTournament, tournsize=3)
@@ -766,7 +710,7 @@ def run_experiment(params_comb=None):
             fitness_time = time()
             print(f"Evaluating {current_pop_size} individuals")
             # Evaluate the entire population
-            for ind, fit in zip(pop, map(toolbox.evaluate, pop)):
+            for ind, fit in zip(pop, toolbox.map(toolbox.evaluate, pop)):
                 ind.fitness.values = fit
             print(f"Time to evaluate fitness {(time() - fitness_time)//60} minutes")
 
@@ -819,7 +763,7 @@ def run_experiment(params_comb=None):
 
                 # Evaluate the individuals with an invalid fitness (The new ones)
                 invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-                fitnesses = map(toolbox.evaluate, invalid_ind)
+                fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
                 for ind, fit in zip(invalid_ind, fitnesses):
                     ind.fitness.values = fit
 
@@ -849,7 +793,7 @@ def run_experiment(params_comb=None):
                     pop = toolbox.population(n=current_pop_size)
 
                     # Evaluate the entire population
-                    for ind, fit in zip(pop, map(toolbox.evaluate, pop)):
+                    for ind, fit in zip(pop, toolbox.map(toolbox.evaluate, pop)):
                         ind.fitness.values = fit
 
                     # Extracting all the fitnesses of
@@ -899,34 +843,14 @@ def run_experiment(params_comb=None):
             )
 
 
-def run_experiment_v2(params_comb=None, verbose=False):
-    distances = load_dlib_df_distances()
-    clusters = set(distances.img1_cluster.unique()).union(
-        set(distances.img2_cluster.unique())
-    )
-    clusters = sorted(clusters)
-
-    print("Distances data loaded")
-
-    # Individuals representation
-    resnet_cols = list(
-        filter(
-            lambda c: ("resnet" in c) and (c not in RESNET_COLS_TO_IGNORE),
-            distances.columns,
-        )
-    )
-
-    IND_SIZE = len(resnet_cols)
-
-    with open(RESULTS_FILE, "w") as f:
-        f.write(
-            "exp_id,cluster,error_function,total_pairs,total_persons,cxpb,mtpb,indpb,pop_size,max_generations,best_generation,best_fitness,min_rank,max_rank,median_rank,mean_rank,exec_time_sec\n"
-        )
+RESULTS_V2_HEADER = "exp_id,cluster,error_function,total_pairs,total_persons,cxpb,mtpb,indpb,pop_size,max_generations,best_generation,best_fitness,min_rank,max_rank,median_rank,mean_rank,exec_time_sec\n"
 
-    creator.create("FitnessMin", base.Fitness, weights=(-1.0,))  # Error (minimize)
-    creator.create("Individual", list, fitness=creator.FitnessMin)
 
-    # If no params is provided, use the available one by default
+def gen_params_comb(params_comb: list = None) -> list:
+    """
+    Combinations of GA parameters, with the error functions resolved from their names.
+    Without "params_comb", the full grid of the experiment params.
+    """
     if params_comb is None:
 
         def params_generator():
@@ -945,15 +869,282 @@ def run_experiment_v2(params_comb=None, verbose=False):
                                         "error_fun": ERROR_FUNCTIONS[error_fun_name],
                                     }
 
-        params_comb = list(params_generator())
+        return list(params_generator())
+
+    return list(
+        map(
+            lambda p: {**p, "error_fun": ERROR_FUNCTIONS[p["error_fun"]]},
+            params_comb,
+        )
+    )
+
+
+def get_resnet_cols(columns: list) -> list:
+    # Individuals representation
+    return list(
+        filter(
+            lambda c: ("resnet" in c) and (c not in RESNET_COLS_TO_IGNORE),
+            columns,
+        )
+    )
+
+
+def normalize_cluster_distances(
+    experiment_dataset: ExperimentDataset, cluster, resnet_cols: list
+) -> pd.DataFrame:
+    """
+    Distances of the pairs of a cluster, normalized inside the cluster and sorted by the DLIB distance.
+    The normalized columns of the dataset are used, unless only a subset (SUB_SET_SIZE) of the pairs is kept.
+    """
+    cluster_pairs = experiment_dataset.cluster_slice(cluster)
+    use_subset = cluster_pairs.stop - cluster_pairs.start > SUB_SET_SIZE
+    cluster_norm_distances = experiment_dataset.to_dataframe(
+        cluster=cluster, normalized=not use_subset
+    )
+
+    if use_subset:
+        cluster_norm_distances = cluster_norm_distances.iloc[:SUB_SET_SIZE].round(6)
+
+        # Normalize numerical columns
+        for col in resnet_cols + ["dlib_distance"]:
+            cluster_norm_distances[col] = (
+                cluster_norm_distances[col] - cluster_norm_distances[col].min()
+            ) / (cluster_norm_distances[col].max() - cluster_norm_distances[col].min())
+
+    cluster_norm_distances = cluster_norm_distances.round(6)
+    return cluster_norm_distances.sort_values(
+        by="dlib_distance", ascending=True, ignore_index=True, kind="stable"
+    )
+
+
+def ea_simple(
+    population,
+    toolbox,
+    cxpb,
+    mutpb,
+    ngen,
+    stats=None,
+    halloffame=None,
+    verbose=False,
+    migration=None,
+):
+    """
+    DEAP eaSimple, optionally migrating individuals between islands (see experiments.ga_scheduler.Migration)
+    every "migration.interval" generations.
+    """
+    if migration is None:
+        return algorithms.eaSimple(
+            population=population,
+            toolbox=toolbox,
+            cxpb=cxpb,
+            mutpb=mutpb,
+            ngen=ngen,
+            stats=stats,
+            halloffame=halloffame,
+            verbose=verbose,
+        )
+
+    logbook = tools.Logbook()
+    logbook.header = ["gen", "nevals"] + (stats.fields if stats else [])
+
+    def evaluate(individuals):
+        invalid_ind = [ind for ind in individuals if not ind.fitness.valid]
+        for ind, fit in zip(invalid_ind, toolbox.map(toolbox.evaluate, invalid_ind)):
+            ind.fitness.values = fit
+        return len(invalid_ind)
+
+    nevals = evaluate(population)
+    if halloffame is not None:
+        halloffame.update(population)
+    record = stats.compile(population) if stats else {}
+    logbook.record(gen=0, nevals=nevals, **record)
+    if verbose:
+        print(logbook.stream)
+
+    for gen in range(1, ngen + 1):
+        offspring = toolbox.select(population, len(population))
+        offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
+        nevals = evaluate(offspring)
+        if halloffame is not None:
+            halloffame.update(offspring)
+        population[:] = offspring
+
+        if gen % migration.interval == 0:
+            migration.migrate(population)
+            if halloffame is not None:
+                halloffame.update(population)
+
+        record = stats.compile(population) if stats else {}
+        logbook.record(gen=gen, nevals=nevals, **record)
+        if verbose:
+            print(logbook.stream)
+
+    return population, logbook
+
+
+def run_cluster_experiment(
+    params: dict,
+    cluster_norm_distances: pd.DataFrame,
+    resnet_cols: list,
+    verbose=False,
+    migration=None,
+    fitness_engine: FitnessEngine = None,
+) -> dict:
+    """
+    Run the GA of a combination of parameters over the (normalized) distances of a cluster.
+
+    :param cluster_norm_distances: Normalized distances of the cluster. Not needed with a "fitness_engine" for the
+    error functions calculated by the engine (all the ERROR_FUNCTIONS).
+    :param migration: Migration of individuals with other islands (see experiments.ga_scheduler.Migration).
+    :param fitness_engine: FitnessEngine of the cluster (e.g. over memory mapped arrays, see FitnessEngine.from_arrays).
+
+    :return: Dict with the best individual, the hall of fame (bests), the evolution log and the ranks of the best.
+    """
+    clear_cached_fitness()
+    current_error_fun = params["error_fun"]
+    resnet_distances_norm = (
+        None
+        if cluster_norm_distances is None
+        else cluster_norm_distances.loc[:, resnet_cols]
+    )
+
+    # DLIB and ResNET distances of the cluster as float32 arrays, shared by all the evaluations
+    if fitness_engine is None:
+        fitness_engine = FitnessEngine(
+            cluster_norm_distances,
+            resnet_distances_norm,
+            step_threshold=STEP_ERROR_DLIB_THRESHOLD,
+        )
+
+    # imgs list to be used at rank_error function
+    imgs = list(fitness_engine.rank_correlation.imgs)
+    shuffle(imgs)
+
+    # Prepare DEAP
+    toolbox = base.Toolbox()
+    toolbox.register("attr_float", random)
+    toolbox.register(
+        "individual",
+        tools.initRepeat,
+        creator.Individual,
+        toolbox.attr_float,
+        n=len(resnet_cols),
+    )
+    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+    if current_error_fun in ENGINE_FITNESS_FUNCTIONS:
+        # Evaluate whole populations at once (see PopulationEvaluator)
+        evaluator = PopulationEvaluator(
+            fitness_engine, ENGINE_FITNESS_FUNCTIONS[current_error_fun]
+        )
+        toolbox.register("evaluate", evaluator)
+        toolbox.register("map", evaluator.map)
     else:
-        params_comb = list(
-            map(
-                lambda p: {**p, "error_fun": ERROR_FUNCTIONS[p["error_fun"]]},
-                params_comb,
-            )
+        toolbox.register(
+            "evaluate",
+            current_error_fun,
+            cluster_norm_distances=cluster_norm_distances,
+            resnet_distances_norm=resnet_distances_norm,
+            imgs=imgs,
+            fitness_engine=fitness_engine,
         )
 
+    toolbox.register("mate", tools.cxSimulatedBinary, eta=0.3)
+    toolbox.register("mutate", tools.mutFlipBit, indpb=params["indpb"])
+    toolbox.register("select", tools.selTournament, tournsize=3)
+
+    stats_fit = tools.Statistics(lambda ind: ind.fitness.values)
+    mstats = tools.MultiStatistics(fitness=stats_fit)
+    mstats.register("max", np.max)
+    mstats.register("min", np.min)
+    mstats.register("mean", np.mean)
+    mstats.register("median", np.median)
+    mstats.register("stddev", np.std)
+
+    hof = tools.HallOfFame(maxsize=20)
+
+    # Start AG Search
+    start_time = time()
+    pop = toolbox.population(n=params["pop_size"])
+    final_pop, logbook = ea_simple(
+        population=pop,
+        toolbox=toolbox,
+        cxpb=params["cxpb"],
+        mutpb=params["mutpb"],
+        ngen=params["max_generations"],
+        stats=mstats,
+        halloffame=hof,
+        verbose=verbose,
+        migration=migration,
+    )
+
+    best = hof[0]
+    ranks = calc_engine_rank(best, fitness_engine)
+
+    return {
+        "best": list(best),
+        "best_fitness": best.fitness.values[0],
+        "bests": [
+            {
+                "generation": 0,
+                "fitness": 0,
+                "best_data": dict(zip(resnet_cols, ind)),
+            }
+            for ind in hof
+        ],
+        "log": logbook.chapters["fitness"],
+        "ranks": ranks,
+        "exec_time": time() - start_time,
+    }
+
+
+def save_cluster_experiment(
+    exp_id: int,
+    cluster,
+    params: dict,
+    total_pairs: int,
+    total_persons: int,
+    resnet_cols: list,
+    result: dict,
+) -> None:
+    """
+    Save the result of run_cluster_experiment: best individuals and evolution log files, and a line of the results CSV.
+    """
+    # Output files for best individuals
+    individuals_folder = RESULTS_FOLDER.joinpath(f"{str(exp_id).zfill(5)}_individuals")
+    individuals_folder.mkdir(exist_ok=True)
+    best_individual_file = individuals_folder.joinpath("best_individual.json")
+    best_individuals_file = individuals_folder.joinpath("best_individuals.json")
+    log_file = individuals_folder.joinpath("evolution_log.json")
+
+    json.dump(dict(zip(resnet_cols, result["best"])), open(best_individual_file, "w"))
+    json.dump(result["bests"], open(best_individuals_file, "w"))
+    json.dump(result["log"], open(log_file, "w"))
+
+    min_rank, max_rank, median_rank, mean_rank = result["ranks"]
+    with open(RESULTS_FILE, "a") as f:
+        tmp_line = f"{exp_id},{cluster},{params['error_fun'].__name__},{total_pairs},{total_persons},{params['cxpb']},{params['mutpb']}"
+        tmp_line += f",{params['indpb']},{params['pop_size']},{params['max_generations']},'na','na'"
+        tmp_line += f",{min_rank},{max_rank},{median_rank},{mean_rank},{int(result['exec_time'])}\n"
+        f.write(tmp_line)
+
+
+def run_experiment_v2(params_comb=None, verbose=False):
+    experiment_dataset = load_experiment_dataset()
+    clusters = experiment_dataset.clusters
+
+    print("Distances data loaded")
+
+    resnet_cols = get_resnet_cols(experiment_dataset.columns)
+
+    with open(RESULTS_FILE, "w") as f:
+        f.write(RESULTS_V2_HEADER)
+
+    creator.create("FitnessMin", base.Fitness, weights=(-1.0,))  # Error (minimize)
+    creator.create("Individual", list, fitness=creator.FitnessMin)
+
+    # If no params is provided, use the available one by default
+    params_comb = gen_params_comb(params_comb)
+
     send_simple_message(
         f"Starting DLIB ResNET GA Experiments with {len(params_comb)} combination of parameters"
     )
@@ -963,151 +1154,40 @@ def run_experiment_v2(params_comb=None, verbose=False):
     for params in params_comb:
         params_start_time = time()
         params_experimented += 1
-        current_cxpb = params["cxpb"]
-        current_mutpb = params["mutpb"]
-        current_indpb = params["indpb"]
-        current_pop_size = params["pop_size"]
-        current_max_generations = params["max_generations"]
-        current_error_fun = params["error_fun"]
 
-        best = {}
         for cluster in clusters:
-            clear_cached_fitness()
             exp_id += 1
-            cluster_distances = distances[
-                (distances.img1_cluster == cluster)
-                & (distances.img2_cluster == cluster)
-            ]
-
-            cluster_distances = cluster_distances.iloc[:SUB_SET_SIZE].reset_index(
-                drop=True
+            cluster_norm_distances = normalize_cluster_distances(
+                experiment_dataset, cluster, resnet_cols
             )
 
-            total_pairs = len(cluster_distances)
-            total_persons = cluster_distances.person1.unique().shape[0]
+            total_pairs = len(cluster_norm_distances)
+            total_persons = cluster_norm_distances.person1.unique().shape[0]
             print(
                 f"""
                     Experiment {exp_id} with {total_pairs} pairs of images of {total_persons} persons
                     Cluster: {cluster}
-                    Error Function: {current_error_fun.__name__}
-                    CXPB: {current_cxpb}
-                    MUTPB: {current_mutpb}
-                    INDPB: {current_indpb}
-                    POP_SIZE: {current_pop_size}
-                    MAX_GENERATIONS: {current_max_generations}
+                    Error Function: {params["error_fun"].__name__}
+                    CXPB: {params["cxpb"]}
+                    MUTPB: {params["mutpb"]}
+                    INDPB: {params["indpb"]}
+                    POP_SIZE: {params["pop_size"]}
+                    MAX_GENERATIONS: {params["max_generations"]}
                     """
             )
 
-            # Normalize distances inside cluster
-            cluster_norm_distances = cluster_distances.copy()
-            cluster_norm_distances = cluster_norm_distances.round(6)
-
-            # Normalize numerical columns
-            for col in resnet_cols + ["dlib_distance"]:
-                cluster_norm_distances[col] = (
-                    cluster_norm_distances[col] - cluster_norm_distances[col].min()
-                ) / (
-                    cluster_norm_distances[col].max()
-                    - cluster_norm_distances[col].min()
-                )
-
-            cluster_norm_distances = cluster_norm_distances.round(6)
-            cluster_norm_distances = cluster_norm_distances.sort_values(
-                by="dlib_distance", ascending=True, ignore_index=True
+            result = run_cluster_experiment(
+                params, cluster_norm_distances, resnet_cols, verbose=verbose
             )
-
-            resnet_distances_norm = cluster_norm_distances.loc[:, resnet_cols]
-
-            # imgs list to be used at rank_error function
-            imgs = list(cluster_norm_distances.img1.unique())
-            shuffle(imgs)
-
-            # Prepare DEAP
-            toolbox = base.Toolbox()
-            toolbox.register("attr_float", random)
-            toolbox.register(
-                "individual",
-                tools.initRepeat,
-                creator.Individual,
-                toolbox.attr_float,
-                n=IND_SIZE,
+            save_cluster_experiment(
+                exp_id,
+                cluster,
+                params,
+                total_pairs,
+                total_persons,
+                resnet_cols,
+                result,
             )
-            toolbox.register("population", tools.initRepeat, list, toolbox.individual)
-            toolbox.register(
-                "evaluate",
-                current_error_fun,
-                cluster_norm_distances=cluster_norm_distances,
-                resnet_distances_norm=resnet_distances_norm,
-                imgs=imgs,
-            )
-
-            toolbox.register("mate", tools.cxSimulatedBinary, eta=0.3)
-            toolbox.register("mutate", tools.mutFlipBit, indpb=current_indpb)
-            toolbox.register("select", tools.selTournament, tournsize=3)
-
-            stats_fit = tools.Statistics(lambda ind: ind.fitness.values)
-            mstats = tools.MultiStatistics(fitness=stats_fit)
-            mstats.register("max", np.max)
-            mstats.register("min", np.min)
-            mstats.register("mean", np.mean)
-            mstats.register("median", np.median)
-            mstats.register("stddev", np.std)
-
-            hof = tools.HallOfFame(maxsize=20)
-
-            # Start AG Search
-            start_time = time()
-            pop = toolbox.population(n=current_pop_size)
-            final_pop, logbook = algorithms.eaSimple(
-                population=pop,
-                toolbox=toolbox,
-                cxpb=current_cxpb,
-                mutpb=current_mutpb,
-                ngen=current_max_generations,
-                stats=mstats,
-                halloffame=hof,
-                verbose=verbose,
-            )
-
-            # Output files for best individuals
-            individuals_folder = RESULTS_FOLDER.joinpath(
-                f"{str(exp_id).zfill(5)}_individuals"
-            )
-            individuals_folder.mkdir(exist_ok=True)
-            best_individual_file = individuals_folder.joinpath("best_individual.json")
-            best_individuals_file = individuals_folder.joinpath("best_individuals.json")
-            log_file = individuals_folder.joinpath("evolution_log.json")
-
-            # Save results to files
-            best = hof[0]
-            bests = [
-                {
-                    "generation": 0,
-                    "fitness": 0,
-                    "best_data": dict(zip(resnet_cols, ind)),
-                }
-                for ind in hof
-            ]
-
-            json.dump(dict(zip(resnet_cols, best)), open(best_individual_file, "w"))
-            json.dump(bests, open(best_individuals_file, "w"))
-            min_rank, max_rank, median_rank, mean_rank = calc_rank(
-                best,
-                cluster_norm_distances,
-                resnet_distances_norm,
-                save_data=False,
-                output_files_folders=individuals_folder,
-                use_scipy=False,
-            )
-
-            log = logbook.chapters["fitness"]
-            json.dump(log, open(log_file, "w"))
-
-            with open(RESULTS_FILE, "a") as f:
-                tmp_line = f"{exp_id},{cluster},{current_error_fun.__name__},{total_pairs},{total_persons},{current_cxpb},{current_mutpb}"
-                tmp_line += f",{current_indpb},{current_pop_size},{current_max_generations},'na','na'"
-                tmp_line += f",{min_rank},{max_rank},{median_rank},{mean_rank},{int(time()-start_time)}\n"
-                f.write(tmp_line)
 
         if params_experimented % 10 == 0:
             print(
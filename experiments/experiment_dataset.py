@@ -0,0 +1,275 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fr.distances_store import get_distances_store, load_distances_df
+
+_MANIFEST_FILE = "manifest.json"
+_NORMALIZED_FOLDER = "normalized"
+_IDS_COLUMNS = ["img1", "img2", "person1", "person2", "cluster"]
+_ID_DTYPE = np.int32
+_CHUNK = 2**20
+
+
+def _names_ids(img1: pd.Series, img2: pd.Series) -> tuple:
+    """
+    Integer ids of the images of the pairs, without comparing the names row by row (categorical columns,
+    e.g. from DistancesStore.to_dataframe, are mapped through their categories).
+
+    :return: (ids_1, ids_2, names), with the names sorted so the ids keep the names order.
+    """
+
+    def codes_and_names(values):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return values.cat.codes.to_numpy(), np.asarray(
+                values.cat.categories, dtype=str
+            )
+        codes, uniques = pd.factorize(values)
+        return codes, np.asarray(uniques, dtype=str)
+
+    codes_1, names_1 = codes_and_names(img1)
+    codes_2, names_2 = codes_and_names(img2)
+    names = np.unique(np.concatenate((names_1, names_2)))
+    ids_1 = np.searchsorted(names, names_1)[codes_1]
+    ids_2 = np.searchsorted(names, names_2)[codes_2]
+    return ids_1.astype(_ID_DTYPE), ids_2.astype(_ID_DTYPE), names
+
+
+def join_distances_stores(distances: pd.DataFrame, distances_files: list) -> pd.DataFrame:
+    """
+    Add the distances of other distances stores to the pairs (img1, img2) of a DataFrame. The pairs are looked
+    up by the images indexes in every store (the matrices are symmetric), instead of merging on the names.
+    Pairs with images that are not in a store have NaN distances.
+
+    :param distances_files: List of (file path, scalar key) of the stores. The distances of the stores with
+    scalar values are added as "<scalar key>_distance" (e.g. "resnet_distance").
+    """
+    ids_1, ids_2, names = _names_ids(distances.img1, distances.img2)
+    distances = distances.copy()
+    for file_path, scalar_key in distances_files:
+        store = get_distances_store(file_path, scalar_key=scalar_key, readonly=True)
+        store_idxes = pd.Index(store.names).get_indexer(names)
+        rows = store_idxes[ids_1]
+        cols = store_idxes[ids_2]
+        in_store = (rows >= 0) & (cols >= 0)
+
+        for key in store.keys:
+            matrix = store.matrix(key)
+            values = np.full(len(distances), np.nan, dtype=np.float32)
+            idxes = np.flatnonzero(in_store)
+            for s in range(0, len(idxes), _CHUNK):
+                tmp_idxes = idxes[s : s + _CHUNK]
+                values[tmp_idxes] = matrix[rows[tmp_idxes], cols[tmp_idxes]]
+            distances[f"{key}_distance" if key == scalar_key else key] = values
+
+    return distances
+
+
+def load_pairs_distances(dlib_distances_file: Path, distances_files: list) -> pd.DataFrame:
+    """
+    DLIB distances of the pairs (dlib_distance) with the distances of other stores (see join_distances_stores).
+    """
+    print("Loading DLIB distances store...")
+    dlib_distances = load_distances_df(dlib_distances_file).rename(
+        columns={"dlib": "dlib_distance"}
+    )
+    print("Joining distances stores...")
+    return join_distances_stores(dlib_distances, distances_files)
+
+
+def build_experiment_dataset(
+    folder: Path, distances: pd.DataFrame, clusters_file: Path
+) -> "ExperimentDataset":
+    """
+    Preprocess the distances of the pairs of images (img1, img2 and a column by distance) into an experiment
+    dataset: only the pairs of different images of the same cluster, with at least one image from VGGFACE2
+    (with "n" in the name) and all the distances finite, are kept. The pairs are grouped by cluster and every
+    distance is also saved normalized (min-max) inside its cluster.
+
+    :param clusters_file: JSON file with the cluster of every image ([{"label": <img name>, "cluster": <cluster>}]).
+    """
+    ids_1, ids_2, names = _names_ids(distances.img1, distances.img2)
+    columns = sorted(
+        c
+        for c in distances.columns
+        if c not in ("img1", "img2") and pd.api.types.is_numeric_dtype(distances[c])
+    )
+
+    # Clusters and persons (<person>_<img_id>) by image
+    clusters_ref = pd.DataFrame(data=json.load(open(clusters_file, "r")))
+    clusters_ref = clusters_ref.set_index("label").cluster
+    clusters_ref = clusters_ref[~clusters_ref.index.duplicated()]
+    clusters = sorted(clusters_ref.unique().tolist())
+    names_clusters = (
+        pd.Series(np.searchsorted(clusters, clusters_ref.to_numpy()), index=clusters_ref.index)
+        .reindex(names)
+        .fillna(-1)
+        .to_numpy()
+        .astype(_ID_DTYPE)
+    )
+    persons, names_persons = np.unique(
+        np.array([n.split("_")[0] for n in names]), return_inverse=True
+    )
+    names_vggface2 = np.char.find(names, "n") >= 0
+
+    cluster = names_clusters[ids_1]
+    keep = (
+        (ids_1 != ids_2)
+        & (names_vggface2[ids_1] | names_vggface2[ids_2])
+        & (cluster >= 0)
+        & (cluster == names_clusters[ids_2])
+    )
+    for col in columns:
+        keep &= np.isfinite(distances[col].to_numpy())
+
+    # Group the pairs by cluster (keeping the pairs order inside the clusters)
+    idxes = np.flatnonzero(keep)
+    idxes = idxes[np.argsort(cluster[idxes], kind="stable")]
+    cluster = cluster[idxes]
+    offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(cluster, minlength=len(clusters))))
+    )
+
+    folder = Path(folder)
+    tmp_folder = folder.with_name(folder.name + ".tmp")
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.joinpath(_NORMALIZED_FOLDER).mkdir(parents=True)
+
+    ids = {
+        "img1": ids_1[idxes],
+        "img2": ids_2[idxes],
+        "person1": names_persons[ids_1[idxes]],
+        "person2": names_persons[ids_2[idxes]],
+        "cluster": cluster,
+    }
+    for col, values in ids.items():
+        np.save(tmp_folder.joinpath(f"{col}.npy"), values.astype(_ID_DTYPE))
+
+    for col in columns:
+        values = distances[col].to_numpy().astype(np.float64)[idxes]
+        np.save(tmp_folder.joinpath(f"{col}.npy"), values)
+
+        normalized = np.empty_like(values)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            tmp_values = values[start:end]
+            if len(tmp_values) == 0:
+                continue
+            min_value = tmp_values.min()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                normalized[start:end] = (tmp_values - min_value) / (
+                    tmp_values.max() - min_value
+                )
+        np.save(tmp_folder.joinpath(_NORMALIZED_FOLDER, f"{col}.npy"), normalized)
+
+    json.dump(
+        {
+            "names": names.tolist(),
+            "persons": persons.tolist(),
+            "clusters": clusters,
+            "offsets": offsets.tolist(),
+            "columns": columns,
+        },
+        open(tmp_folder.joinpath(_MANIFEST_FILE), "w"),
+    )
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+    return ExperimentDataset(folder)
+
+
+class ExperimentDataset:
+    """
+    Preprocessed distances of the pairs of images of the experiments (see build_experiment_dataset), saved as
+    one .npy file by column and memory mapped: integer ids of the images, persons and clusters, and the
+    distances, raw and normalized inside every cluster. The pairs of a cluster are contiguous, so loading a
+    cluster doesn't read the others. The ids follow the names order (images and persons are sorted by name).
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        manifest_path = self.folder.joinpath(_MANIFEST_FILE)
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"No experiment dataset found at {self.folder}")
+
+        manifest = json.load(open(manifest_path, "r"))
+        self.names = np.asarray(manifest["names"], dtype=object)
+        self.persons = np.asarray(manifest["persons"], dtype=object)
+        self.clusters = manifest["clusters"]
+        self.offsets = manifest["offsets"]
+        self.columns = manifest["columns"]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def column(self, col: str, normalized: bool = False) -> np.memmap:
+        """
+        Column of all the pairs: an id column (img1, img2, person1, person2 or cluster) or a distance column.
+        """
+        if col in _IDS_COLUMNS:
+            return np.load(self.folder.joinpath(f"{col}.npy"), mmap_mode="r")
+        if col not in self.columns:
+            raise KeyError(f"Invalid experiment dataset column: {col}")
+        if normalized:
+            return np.load(
+                self.folder.joinpath(_NORMALIZED_FOLDER, f"{col}.npy"), mmap_mode="r"
+            )
+        return np.load(self.folder.joinpath(f"{col}.npy"), mmap_mode="r")
+
+    def cluster_slice(self, cluster) -> slice:
+        """
+        Pairs of a cluster (a cluster label, see clusters).
+        """
+        idx = self.clusters.index(cluster)
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def to_dataframe(
+        self, cluster=None, normalized: bool = False, columns: list = None
+    ) -> pd.DataFrame:
+        """
+        Pairs as a DataFrame with the columns of the former distances DataFrames: img1, img2, person1, person2
+        (names), same_person ("same" or "different"), img1_cluster, img2_cluster and the distances.
+
+        :param cluster: Only the pairs of this cluster (all the pairs by default).
+        :param normalized: Distances normalized inside their cluster.
+        :param columns: Distance columns (all by default).
+        """
+        pairs = slice(None) if cluster is None else self.cluster_slice(cluster)
+        columns = self.columns if columns is None else columns
+
+        person1 = self.column("person1")[pairs]
+        person2 = self.column("person2")[pairs]
+        clusters = np.asarray(self.clusters)[self.column("cluster")[pairs]]
+        distances = pd.DataFrame(
+            {
+                "img1": self.names[self.column("img1")[pairs]],
+                "img2": self.names[self.column("img2")[pairs]],
+                "person1": self.persons[person1],
+                "person2": self.persons[person2],
+                "same_person": np.where(person1 == person2, "same", "different"),
+                "img1_cluster": clusters,
+                "img2_cluster": clusters,
+            }
+        )
+        for col in columns:
+            distances[col] = self.column(col, normalized=normalized)[pairs]
+
+        return distances.reindex(sorted(distances.columns), axis=1)
+
+
+def get_experiment_dataset(
+    folder: Path, load_distances, clusters_file: Path
+) -> ExperimentDataset:
+    """
+    Open the experiment dataset of a folder, building it the first time (see build_experiment_dataset).
+
+    :param load_distances: Function returning the DataFrame of distances of the pairs to build the dataset.
+    """
+    try:
+        return ExperimentDataset(folder)
+    except FileNotFoundError:
+        print(f"No experiment dataset found at {folder}. Building it...")
+        return build_experiment_dataset(folder, load_distances(), clusters_file)
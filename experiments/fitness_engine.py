@@ -0,0 +1,319 @@
+from math import inf
+
+import numpy as np
+import pandas as pd
+
+from experiments.rank_correlation import RankCorrelation
+
+FITNESS_MSE = "mse"
+FITNESS_MAE = "mae"
+FITNESS_ABS_ERROR = "abs_error"
+FITNESS_MAPE = "mape"
+FITNESS_STEP_ERROR = "step_error"
+FITNESS_FUNCTIONS = [
+    FITNESS_MSE,
+    FITNESS_MAE,
+    FITNESS_ABS_ERROR,
+    FITNESS_MAPE,
+    FITNESS_STEP_ERROR,
+]
+
+DEFAULT_STEP_THRESHOLD = 0.5
+DEFAULT_MAX_POPULATION_BYTES = 256 * 2**20  # Max size of the (pairs x individuals) buffers
+
+_DTYPE = np.float32
+
+
+class FitnessEngine:
+    """
+    Fitness of the GA individuals (weights of the ResNET faceparts distances) over the pairs of a cluster.
+    The DLIB distances and the ResNET distances matrix (pairs x faceparts) are extracted once as contiguous
+    float32 arrays and every individual is scored with a single mat-vec into preallocated buffers.
+    As the pandas implementation, pairs of the same image are ignored and the errors that are not finite
+    (e.g. a MAPE with a zero DLIB distance) are skipped.
+    """
+
+    def __init__(
+        self,
+        cluster_norm_distances: pd.DataFrame,
+        resnet_distances_norm: pd.DataFrame,
+        step_threshold: float = DEFAULT_STEP_THRESHOLD,
+        max_population_bytes: int = DEFAULT_MAX_POPULATION_BYTES,
+    ):
+        pairs = (cluster_norm_distances.img1 != cluster_norm_distances.img2).to_numpy()
+        self.__setup(
+            cluster_norm_distances.dlib_distance.to_numpy()[pairs],
+            resnet_distances_norm.reindex(cluster_norm_distances.index[pairs]).to_numpy(),
+            cluster_norm_distances.img1.to_numpy()[pairs],
+            cluster_norm_distances.img2.to_numpy()[pairs],
+            step_threshold,
+            max_population_bytes,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        dlib: np.ndarray,
+        resnet: np.ndarray,
+        img1: np.ndarray,
+        img2: np.ndarray,
+        step_threshold: float = DEFAULT_STEP_THRESHOLD,
+        max_population_bytes: int = DEFAULT_MAX_POPULATION_BYTES,
+    ) -> "FitnessEngine":
+        """
+        Engine over the arrays of the pairs of different images of a cluster, sorted by the DLIB distance.
+        Contiguous float32 "dlib" (pairs) and "resnet" (pairs x faceparts) arrays are used as they are,
+        so memory mapped arrays are shared (read only) instead of copied.
+
+        :param img1: Images of the pairs (e.g. names, or integer ids following the names order).
+        """
+        fitness_engine = cls.__new__(cls)
+        fitness_engine.__setup(
+            dlib, resnet, img1, img2, step_threshold, max_population_bytes
+        )
+        return fitness_engine
+
+    def __setup(self, dlib, resnet, img1, img2, step_threshold, max_population_bytes):
+        self.dlib = np.ascontiguousarray(dlib, dtype=_DTYPE)
+        self.resnet = np.ascontiguousarray(resnet, dtype=_DTYPE)
+        self.step_threshold = step_threshold
+        self.dlib_same_person = self.dlib < step_threshold
+        self.rank_correlation = RankCorrelation(img1, img2)
+
+        self.__weights = np.empty(self.resnet.shape[1], dtype=_DTYPE)
+        self.__combination = np.empty(len(self.dlib), dtype=_DTYPE)
+        self.__error = np.empty(len(self.dlib), dtype=_DTYPE)
+        self.__finite = np.empty(len(self.dlib), dtype=bool)
+        self.__same_person = np.empty(len(self.dlib), dtype=bool)
+
+        # Population buffers, allocated on the first population evaluation
+        self.population_chunk = int(
+            max(max_population_bytes // max(len(self.dlib) * 4, 1), 1)
+        )
+        self.__population_buffers = None
+
+    def __len__(self):
+        return len(self.dlib)
+
+    def combination(self, individual) -> np.ndarray:
+        """
+        Combined distance of every pair (the individual weights are normalized to sum 1).
+
+        :return: The engine buffer (overwritten by the next evaluation) or None for invalid individuals
+        (negative weights or zero sum).
+        """
+        self.__weights[:] = individual
+        weights_sum = self.__weights.sum()
+        if weights_sum == 0 or (self.__weights < 0).any():
+            return None
+        self.__weights /= weights_sum
+        return np.matmul(self.resnet, self.__weights, out=self.__combination)
+
+    def __finite_error(self) -> int:
+        np.isfinite(self.__error, out=self.__finite)
+        return np.count_nonzero(self.__finite)
+
+    def mse(self, individual) -> float:
+        """
+        Mean of the squared (absolute error + 1), to avoid squaring fractions.
+        """
+        if self.combination(individual) is None:
+            return inf
+        np.subtract(self.__combination, self.dlib, out=self.__error)
+        np.abs(self.__error, out=self.__error)
+        self.__error += 1
+        np.square(self.__error, out=self.__error)
+        return self.__finite_mean()
+
+    def mae(self, individual) -> float:
+        if self.combination(individual) is None:
+            return inf
+        np.subtract(self.__combination, self.dlib, out=self.__error)
+        np.abs(self.__error, out=self.__error)
+        return self.__finite_mean()
+
+    def abs_error(self, individual) -> float:
+        if self.combination(individual) is None:
+            return inf
+        np.subtract(self.__combination, self.dlib, out=self.__error)
+        np.abs(self.__error, out=self.__error)
+        return self.__finite_sum()
+
+    def mape(self, individual) -> float:
+        if self.combination(individual) is None:
+            return inf
+        np.subtract(self.dlib, self.__combination, out=self.__error)
+        np.abs(self.__error, out=self.__error)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(self.__error, self.dlib, out=self.__error)
+        return self.__finite_mean()
+
+    def step_error(self, individual) -> int:
+        """
+        Number of pairs classified differently (same person or not) by the combination and by DLIB.
+        """
+        if self.combination(individual) is None:
+            return inf
+        np.less(self.__combination, self.step_threshold, out=self.__same_person)
+        np.not_equal(self.__same_person, self.dlib_same_person, out=self.__same_person)
+        return int(np.count_nonzero(self.__same_person))
+
+    def rank_correlations(self, individual) -> pd.Series:
+        """
+        Kendall tau-b of every img1 between its img2 sorted by the pairs order (the DLIB distance)
+        and sorted by the combination (see RankCorrelation).
+
+        :return: Series of the correlations indexed by img1, or None for invalid individuals.
+        """
+        if self.combination(individual) is None:
+            return None
+        return self.rank_correlation.correlations_series(self.__combination)
+
+    def __finite_mean(self) -> float:
+        count = self.__finite_error()
+        if count == 0:
+            return float("nan")
+        return float(
+            np.add.reduce(self.__error, where=self.__finite, dtype=np.float64) / count
+        )
+
+    def __finite_sum(self) -> float:
+        self.__finite_error()
+        return float(np.add.reduce(self.__error, where=self.__finite, dtype=np.float64))
+
+    def __get_population_buffers(self) -> tuple:
+        if self.__population_buffers is None:
+            shape = (len(self.dlib), self.population_chunk)
+            self.__population_buffers = (
+                np.empty((self.resnet.shape[1], self.population_chunk), dtype=_DTYPE),
+                np.empty(shape, dtype=_DTYPE),
+                np.empty(shape, dtype=_DTYPE),
+                np.empty(shape, dtype=bool),
+            )
+        return self.__population_buffers
+
+    def evaluate_population(self, individuals: list, fitness_functions: list = None) -> dict:
+        """
+        Fitness of a whole population. The combined distances of all the individuals are calculated as a
+        single (pairs x faceparts) @ (faceparts x individuals) product (split in chunks of "population_chunk"
+        individuals to bound the memory) and every fitness function is reduced from it.
+
+        :param fitness_functions: Fitness functions to calculate (all FITNESS_FUNCTIONS by default).
+
+        :return: Dict with the fitness of every individual by fitness function ({<fitness function>: array}).
+        """
+        fitness_functions = (
+            FITNESS_FUNCTIONS if fitness_functions is None else fitness_functions
+        )
+        for fitness_function in fitness_functions:
+            if fitness_function not in FITNESS_FUNCTIONS:
+                raise ValueError(f"Invalid fitness function: {fitness_function}")
+
+        weights = np.asarray(individuals, dtype=_DTYPE).reshape(len(individuals), -1)
+        weights_sums = weights.sum(axis=1)
+        valid = (weights_sums != 0) & ~(weights < 0).any(axis=1)
+        fitness = {f: np.full(len(weights), inf) for f in fitness_functions}
+
+        weights_buffer, combination, error, finite = self.__get_population_buffers()
+        valid_idxes = np.flatnonzero(valid)
+        for start in range(0, len(valid_idxes), self.population_chunk):
+            idxes = valid_idxes[start : start + self.population_chunk]
+            chunk = len(idxes)
+            tmp_weights = weights_buffer[:, :chunk]
+            np.divide(weights[idxes].T, weights_sums[idxes], out=tmp_weights)
+            tmp_combination = combination[:, :chunk]
+            tmp_error = error[:, :chunk]
+            tmp_finite = finite[:, :chunk]
+            np.matmul(self.resnet, tmp_weights, out=tmp_combination)
+
+            if FITNESS_STEP_ERROR in fitness:
+                np.less(tmp_combination, self.step_threshold, out=tmp_finite)
+                np.not_equal(
+                    tmp_finite, self.dlib_same_person[:, np.newaxis], out=tmp_finite
+                )
+                fitness[FITNESS_STEP_ERROR][idxes] = np.count_nonzero(
+                    tmp_finite, axis=0
+                )
+
+            np.subtract(tmp_combination, self.dlib[:, np.newaxis], out=tmp_error)
+            np.abs(tmp_error, out=tmp_error)
+            np.isfinite(tmp_error, out=tmp_finite)
+            counts = np.count_nonzero(tmp_finite, axis=0)
+
+            def finite_sum():
+                return np.add.reduce(
+                    tmp_error, axis=0, where=tmp_finite, dtype=np.float64
+                )
+
+            def finite_mean():
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    return finite_sum() / counts
+
+            if FITNESS_ABS_ERROR in fitness:
+                fitness[FITNESS_ABS_ERROR][idxes] = finite_sum()
+            if FITNESS_MAE in fitness:
+                fitness[FITNESS_MAE][idxes] = finite_mean()
+            if FITNESS_MAPE in fitness:
+                # The combination is kept, so the absolute error can still be squared for the MSE
+                tmp_combination[:] = tmp_error
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    np.divide(tmp_error, self.dlib[:, np.newaxis], out=tmp_error)
+                np.isfinite(tmp_error, out=tmp_finite)
+                counts = np.count_nonzero(tmp_finite, axis=0)
+                fitness[FITNESS_MAPE][idxes] = finite_mean()
+                tmp_error[:] = tmp_combination
+            if FITNESS_MSE in fitness:
+                tmp_error += 1
+                np.square(tmp_error, out=tmp_error)
+                np.isfinite(tmp_error, out=tmp_finite)
+                counts = np.count_nonzero(tmp_finite, axis=0)
+                fitness[FITNESS_MSE][idxes] = finite_mean()
+
+        return fitness
+
+    def evaluate(self, individual, fitness_function: str) -> tuple:
+        """
+        Fitness of an individual as a DEAP fitness tuple.
+
+        :param fitness_function: One of FITNESS_FUNCTIONS.
+        """
+        if fitness_function not in FITNESS_FUNCTIONS:
+            raise ValueError(f"Invalid fitness function: {fitness_function}")
+        return (getattr(self, fitness_function)(individual),)
+
+
+class PopulationEvaluator:
+    """
+    DEAP evaluation of a fitness function with a FitnessEngine, batching the population.
+    It is registered both as "evaluate" and "map" of the toolbox:
+
+        toolbox.register("evaluate", evaluator)
+        toolbox.register("map", evaluator.map)
+
+    so "toolbox.map(toolbox.evaluate, individuals)" evaluates all the individuals with a single matrix product.
+    Other functions are mapped as the builtin map.
+    """
+
+    def __init__(self, fitness_engine: FitnessEngine, fitness_function: str):
+        if fitness_function not in FITNESS_FUNCTIONS:
+            raise ValueError(f"Invalid fitness function: {fitness_function}")
+        self.fitness_engine = fitness_engine
+        self.fitness_function = fitness_function
+
+    def __call__(self, individual) -> tuple:
+        return self.fitness_engine.evaluate(individual, self.fitness_function)
+
+    def map(self, func, individuals) -> list:
+        # The toolbox registers functions as partials
+        if getattr(func, "func", func) is not self:
+            return list(map(func, individuals))
+
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        fitness = self.fitness_engine.evaluate_population(
+            individuals, fitness_functions=[self.fitness_function]
+        )[self.fitness_function]
+        if self.fitness_function == FITNESS_STEP_ERROR:
+            return [(int(f) if f != inf else inf,) for f in fitness]
+        return [(f.item(),) for f in fitness]
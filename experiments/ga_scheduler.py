@@ -0,0 +1,301 @@
+import multiprocessing
+import queue
+import shutil
+import tempfile
+from pathlib import Path
+from time import time
+
+import numpy as np
+import pandas as pd
+from deap import base, creator
+
+from experiments.dlib_resnet_ga_approximation import (
+    RESULTS_FILE,
+    RESULTS_V2_HEADER,
+    STEP_ERROR_DLIB_THRESHOLD,
+    gen_params_comb,
+    get_resnet_cols,
+    load_experiment_dataset,
+    normalize_cluster_distances,
+    run_cluster_experiment,
+    save_cluster_experiment,
+)
+from experiments.fitness_engine import FitnessEngine
+from util._telegram import send_simple_message
+
+DEFAULT_MIGRATION_INTERVAL = 10  # Generations between migrations
+DEFAULT_MIGRATION_SIZE = 5  # Best individuals sent to the next island
+
+_SHARED_ARRAYS = ["dlib", "resnet", "img1", "img2"]
+
+# Fitness engine of the last cluster used by a worker process ({"folder": <cluster folder>, "engine": FitnessEngine})
+_worker_cluster = {}
+
+
+def save_shared_cluster(
+    folder: Path, cluster_norm_distances: pd.DataFrame, resnet_cols: list
+) -> None:
+    """
+    Save the arrays of a FitnessEngine of a cluster (see FitnessEngine.from_arrays) as .npy files, to be memory
+    mapped (read only) by the workers instead of pickling the DataFrame in every task: the float32 DLIB distances
+    and ResNET distances matrix of the pairs of different images, and the images as integer ids (following the
+    names order, as the names are compared by RankCorrelation).
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    pairs = (cluster_norm_distances.img1 != cluster_norm_distances.img2).to_numpy()
+    img1 = cluster_norm_distances.img1.to_numpy()[pairs].astype(str)
+    img2 = cluster_norm_distances.img2.to_numpy()[pairs].astype(str)
+    names = np.unique(np.concatenate((img1, img2)))
+
+    arrays = {
+        "dlib": cluster_norm_distances.dlib_distance.to_numpy()[pairs],
+        "resnet": cluster_norm_distances.loc[pairs, resnet_cols].to_numpy(),
+        "img1": np.searchsorted(names, img1),
+        "img2": np.searchsorted(names, img2),
+    }
+    for name, values in arrays.items():
+        dtype = np.float32 if name in ("dlib", "resnet") else np.int32
+        np.save(
+            folder.joinpath(f"{name}.npy"),
+            np.ascontiguousarray(values, dtype=dtype),
+        )
+
+
+def load_shared_cluster(folder: Path) -> FitnessEngine:
+    """
+    Fitness engine over the memory mapped arrays of a cluster saved with save_shared_cluster.
+    """
+    folder = Path(folder)
+    arrays = {
+        name: np.load(folder.joinpath(f"{name}.npy"), mmap_mode="r")
+        for name in _SHARED_ARRAYS
+    }
+    return FitnessEngine.from_arrays(
+        arrays["dlib"],
+        arrays["resnet"],
+        arrays["img1"],
+        arrays["img2"],
+        step_threshold=STEP_ERROR_DLIB_THRESHOLD,
+    )
+
+
+def get_shared_cluster(folder: Path) -> FitnessEngine:
+    """
+    Fitness engine of a shared cluster. Only the last cluster is kept by worker process (the tasks are sorted by
+    cluster).
+    """
+    folder = str(folder)
+    if _worker_cluster.get("folder", None) != folder:
+        _worker_cluster.clear()
+        _worker_cluster["engine"] = load_shared_cluster(folder)
+        _worker_cluster["folder"] = folder
+    return _worker_cluster["engine"]
+
+
+class Migration:
+    """
+    Migration of individuals between the islands of an experiment, in a ring: every "interval" generations an
+    island sends copies of its "size" best individuals to the next island and replaces its worst individuals
+    with the ones received from the previous island. The queues are never waited for, so the islands don't
+    need to run at the same time (e.g. with less workers than islands).
+    Individuals are sent as plain (genes, fitness) tuples, so the queues don't depend on the DEAP creator classes.
+    """
+
+    def __init__(
+        self,
+        inbox,
+        outbox,
+        interval: int = DEFAULT_MIGRATION_INTERVAL,
+        size: int = DEFAULT_MIGRATION_SIZE,
+    ):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.interval = interval
+        self.size = size
+
+    def migrate(self, population: list) -> None:
+        by_fitness = sorted(
+            range(len(population)), key=lambda i: population[i].fitness, reverse=True
+        )
+        self.outbox.put(
+            [
+                (list(population[i]), population[i].fitness.values)
+                for i in by_fitness[: self.size]
+            ]
+        )
+
+        immigrants = []
+        while True:
+            try:
+                immigrants += self.inbox.get_nowait()
+            except queue.Empty:
+                break
+        if not immigrants:
+            return
+
+        individuals = []
+        for genes, fitness in immigrants:
+            individual = creator.Individual(genes)
+            individual.fitness.values = fitness
+            individuals.append(individual)
+        immigrants = sorted(individuals, key=lambda ind: ind.fitness, reverse=True)
+        for i, immigrant in zip(reversed(by_fitness), immigrants[: self.size]):
+            population[i] = immigrant
+
+
+def _init_worker():
+    # DEAP creator classes are created at run time, so they may not exist in the (spawned) workers
+    if not hasattr(creator, "FitnessMin"):
+        creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
+    if not hasattr(creator, "Individual"):
+        creator.create("Individual", list, fitness=creator.FitnessMin)
+
+
+def _run_task(task: dict) -> dict:
+    migration = None
+    if task["queues"] is not None:
+        inbox, outbox = task["queues"]
+        migration = Migration(
+            inbox,
+            outbox,
+            interval=task["migration_interval"],
+            size=task["migration_size"],
+        )
+
+    result = run_cluster_experiment(
+        task["params"],
+        None,
+        task["resnet_cols"],
+        verbose=task["verbose"],
+        migration=migration,
+        fitness_engine=get_shared_cluster(task["folder"]),
+    )
+    return {"exp_id": task["exp_id"], "island": task["island"], "result": result}
+
+
+def run_experiment_parallel(
+    params_comb=None,
+    workers: int = None,
+    islands: int = 1,
+    migration_interval: int = DEFAULT_MIGRATION_INTERVAL,
+    migration_size: int = DEFAULT_MIGRATION_SIZE,
+    verbose=False,
+):
+    """
+    Same experiments as run_experiment_v2 (same experiments ids and results files), run by a pool of processes.
+
+    The normalized distances of every cluster are calculated once and shared with the workers as memory mapped
+    .npy files (see save_shared_cluster). The workers only run the GA and return their results: the results
+    CSV and the individuals files are written by this process, in the order the experiments finish.
+
+    :param workers: Number of processes (number of CPUs by default).
+    :param islands: Number of islands (independent populations of "pop_size" individuals) of every experiment,
+    migrating individuals every "migration_interval" generations (see Migration). The result of an experiment
+    is the result of its island with the best fitness.
+    """
+    experiment_dataset = load_experiment_dataset()
+    clusters = experiment_dataset.clusters
+
+    print("Distances data loaded")
+
+    resnet_cols = get_resnet_cols(experiment_dataset.columns)
+    params_comb = gen_params_comb(params_comb)
+
+    shared_folder = Path(tempfile.mkdtemp(prefix="ga_clusters_"))
+    try:
+        clusters_info = {}
+        for cluster_idx, cluster in enumerate(clusters):
+            cluster_norm_distances = normalize_cluster_distances(
+                experiment_dataset, cluster, resnet_cols
+            )
+            cluster_folder = shared_folder.joinpath(str(cluster_idx))
+            save_shared_cluster(cluster_folder, cluster_norm_distances, resnet_cols)
+            clusters_info[cluster] = {
+                "folder": cluster_folder,
+                "total_pairs": len(cluster_norm_distances),
+                "total_persons": cluster_norm_distances.person1.unique().shape[0],
+            }
+
+        print("Clusters distances shared")
+
+        with open(RESULTS_FILE, "w") as f:
+            f.write(RESULTS_V2_HEADER)
+
+        _init_worker()
+
+        # Fork (when available) to avoid importing the experiments module (and creating a results folder) again
+        context = multiprocessing.get_context(
+            "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        )
+        manager = context.Manager() if islands > 1 else None
+
+        tasks = []
+        experiments = {}
+        exp_id = 0
+        for params in params_comb:
+            for cluster in clusters:
+                exp_id += 1
+                experiments[exp_id] = {"params": params, "cluster": cluster, "results": []}
+                queues = (
+                    [manager.Queue() for _ in range(islands)]
+                    if manager is not None
+                    else None
+                )
+                for island in range(islands):
+                    tasks.append(
+                        {
+                            "exp_id": exp_id,
+                            "island": island,
+                            "params": params,
+                            "folder": clusters_info[cluster]["folder"],
+                            "resnet_cols": resnet_cols,
+                            "queues": (
+                                (queues[island], queues[(island + 1) % islands])
+                                if queues is not None
+                                else None
+                            ),
+                            "migration_interval": migration_interval,
+                            "migration_size": migration_size,
+                            "verbose": verbose,
+                        }
+                    )
+
+        # Cluster by cluster, so the workers rarely switch of (memory mapped) cluster
+        tasks.sort(key=lambda t: clusters.index(experiments[t["exp_id"]]["cluster"]))
+
+        send_simple_message(
+            f"Starting DLIB ResNET GA Experiments with {len(params_comb)} combination of parameters ({len(tasks)} tasks)"
+        )
+
+        start_time = time()
+        experimented = 0
+        with context.Pool(processes=workers, initializer=_init_worker) as pool:
+            for task_result in pool.imap_unordered(_run_task, tasks):
+                experiment = experiments[task_result["exp_id"]]
+                experiment["results"].append(task_result["result"])
+                if len(experiment["results"]) < islands:
+                    continue
+
+                cluster = experiment["cluster"]
+                save_cluster_experiment(
+                    task_result["exp_id"],
+                    cluster,
+                    experiment["params"],
+                    clusters_info[cluster]["total_pairs"],
+                    clusters_info[cluster]["total_persons"],
+                    resnet_cols,
+                    min(experiment["results"], key=lambda r: r["best_fitness"]),
+                )
+                del experiments[task_result["exp_id"]]
+
+                experimented += 1
+                if experimented % (10 * len(clusters)) == 0:
+                    message = f"DLIB ResNET GA Experiments:  {experimented}/{exp_id} {round(100*experimented/exp_id,2)}% | Spent {round((time()-start_time)//60,2)} min"
+                    print(message)
+                    _ = send_simple_message(message)
+
+        if manager is not None:
+            manager.shutdown()
+    finally:
+        shutil.rmtree(shared_folder, ignore_errors=True)
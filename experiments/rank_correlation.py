@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+
+
+def group_offsets(group_ids: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Offsets of the groups of an array sorted by group ("n_groups" + 1 values, group g is [offsets[g], offsets[g + 1])).
+    """
+    return np.concatenate(([0], np.cumsum(np.bincount(group_ids, minlength=n_groups))))
+
+
+def __runs_ties(keys: list, group_ids: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Tied pairs (t * (t - 1) / 2 for every run of t equal keys) of each group, for arrays sorted by group and keys.
+    """
+    if len(group_ids) == 0:
+        return np.zeros(n_groups)
+    changes = group_ids[1:] != group_ids[:-1]
+    for key in keys:
+        changes |= key[1:] != key[:-1]
+    starts = np.flatnonzero(np.concatenate(([True], changes)))
+    lengths = np.diff(np.append(starts, len(group_ids))).astype(np.float64)
+    return np.bincount(
+        group_ids[starts], weights=lengths * (lengths - 1) / 2, minlength=n_groups
+    )
+
+
+def count_inversions(
+    values: np.ndarray, group_ids: np.ndarray, n_groups: int
+) -> np.ndarray:
+    """
+    Number of inversions (i < j with values[i] > values[j]) inside every group, for an array sorted by group.
+    All the groups are processed at once with a vectorized bottom-up merge sort: at every level, the
+    inversions between each block and the previous one are counted with a single binary search over
+    the whole array, O(n log^2 n) overall.
+
+    :param values: Non negative integers (e.g. ranks).
+    """
+    values = np.asarray(values, dtype=np.int64)
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    inversions = np.zeros(n_groups)
+    if len(values) < 2:
+        return inversions
+
+    offsets = group_offsets(group_ids, n_groups)
+    positions = np.arange(len(values)) - offsets[group_ids]
+    max_size = int(np.max(np.diff(offsets)))
+    key_step = int(values.max()) + 1
+
+    width = 1
+    while width < max_size:
+        # Blocks of "width" slots inside every group, already sorted
+        blocks = positions // width
+        new_block = np.concatenate(
+            ([True], (group_ids[1:] != group_ids[:-1]) | (blocks[1:] != blocks[:-1]))
+        )
+        block_ids = np.cumsum(new_block) - 1
+        block_starts = np.flatnonzero(new_block)
+        keys = block_ids * key_step + values
+
+        # Elements of the right blocks against the greater values of the left block
+        right = np.flatnonzero(blocks % 2 == 1)
+        left_greater = block_starts[block_ids[right]] - np.searchsorted(
+            keys, (block_ids[right] - 1) * key_step + values[right], side="right"
+        )
+        inversions += np.bincount(
+            group_ids[right], weights=left_greater, minlength=n_groups
+        )
+
+        # Merge the pairs of blocks
+        merged_ids = np.cumsum(
+            np.concatenate(
+                (
+                    [True],
+                    (group_ids[1:] != group_ids[:-1])
+                    | (blocks[1:] // 2 != blocks[:-1] // 2),
+                )
+            )
+        )
+        values = values[np.argsort(merged_ids * key_step + values, kind="stable")]
+        width *= 2
+
+    return inversions
+
+
+def kendall_tau_b(
+    x: np.ndarray, y: np.ndarray, group_ids: np.ndarray, n_groups: int
+) -> np.ndarray:
+    """
+    Kendall tau-b between the x and y of every group (same formula as scipy.stats.kendalltau).
+    Groups with less than 2 elements, or a constant x or y, have a NaN correlation.
+
+    :param x: Non negative integers (e.g. ranks).
+    :param y: Non negative integers (e.g. ranks).
+    :param group_ids: Group of every element (the elements don't need to be sorted by group).
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+
+    sizes = np.bincount(group_ids, minlength=n_groups).astype(np.float64)
+    total = sizes * (sizes - 1) / 2
+
+    order = np.lexsort((y, x, group_ids))
+    tmp_groups, tmp_x, tmp_y = group_ids[order], x[order], y[order]
+    x_ties = __runs_ties([tmp_x], tmp_groups, n_groups)
+    xy_ties = __runs_ties([tmp_x, tmp_y], tmp_groups, n_groups)
+    # Sorted by x (and y for the ties of x), the discordant pairs are the inversions of y
+    discordant = count_inversions(tmp_y, tmp_groups, n_groups)
+
+    order = np.lexsort((y, group_ids))
+    y_ties = __runs_ties([y[order]], group_ids[order], n_groups)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tau = (total - x_ties - y_ties + xy_ties - 2 * discordant) / (
+            np.sqrt(total - x_ties) * np.sqrt(total - y_ties)
+        )
+    tau[(sizes < 2) | (total == x_ties) | (total == y_ties)] = np.nan
+    return np.clip(tau, -1.0, 1.0)
+
+
+class RankCorrelation:
+    """
+    Rank correlation of the img2 sequences of every img1: the img2 sorted by a reference distance (the
+    pairs order) against the img2 sorted by a new distance. As Series.corr(method="kendall") on the
+    sequences of img2 names, the sequences are compared position by position by the names order.
+    The pairs are grouped by img1 once, so every evaluation is a single sort and a single Kendall tau pass.
+    """
+
+    def __init__(self, img1, img2, reference_distances: np.ndarray = None):
+        """
+        :param img2: Names, or integer ids following the names order.
+        :param reference_distances: Distances of the reference order (the pairs order by default).
+        """
+        self.group_ids, self.imgs = pd.factorize(np.asarray(img1))
+        self.n_groups = len(self.imgs)
+        img2 = np.asarray(img2)
+        if not np.issubdtype(img2.dtype, np.integer):
+            img2 = img2.astype(str)
+        _, self.__names_ranks = np.unique(img2, return_inverse=True)
+        self.__names_ranks = self.__names_ranks.reshape(-1)
+
+        # Reference sequences
+        if reference_distances is None:
+            order = np.argsort(self.group_ids, kind="stable")
+        else:
+            order = np.lexsort((np.asarray(reference_distances), self.group_ids))
+        self.__sorted_groups = self.group_ids[order]
+        self.__reference = self.__names_ranks[order]
+        self.sizes = np.bincount(self.group_ids, minlength=self.n_groups)
+
+    def correlations(self, distances: np.ndarray) -> np.ndarray:
+        """
+        Kendall tau-b of every img1 (see imgs) between the reference and the "distances" img2 sequences.
+        """
+        order = np.lexsort((np.asarray(distances), self.group_ids))
+        return kendall_tau_b(
+            self.__reference,
+            self.__names_ranks[order],
+            self.__sorted_groups,
+            self.n_groups,
+        )
+
+    def correlations_series(self, distances: np.ndarray) -> pd.Series:
+        """
+        Same as correlations, indexed by img1.
+        """
+        return pd.Series(self.correlations(distances), index=self.imgs)
@@ -11,6 +11,8 @@ from dataset import (
     get_file_path,
     ls_imgs_names,
 )
+from fr.cached_fr import CachedFr
+from fr.features_cache import flush_features_caches
 from fr.ifr import IFr
 
 from util._telegram import send_simple_message
@@ -112,6 +114,10 @@ def run_fr_experiment(
 
     print("Starting FR Experiment")
 
+    # The reference images are compared with all their morphs, let's encode every image once
+    if not isinstance(ifr, CachedFr) and not ifr.caches_features:
+        ifr = CachedFr(ifr)
+
     morphed_files_names = ls_imgs_names(DATASET_KIND_MORPH)
 
     print(f"{len(morphed_files_names)} morphed images found.")
@@ -119,6 +125,7 @@ def run_fr_experiment(
     results = generate_fr_results(
         make_pairs_generator(morphed_files_names), ifr, backup_file
     )
+    flush_features_caches()
 
     print(f"Saving results at {output_file_path}")
     json.dump(results, open(output_file_path, "w"))
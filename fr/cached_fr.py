@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from fr.features_cache import content_hash, get_features_cache
+from fr.ifr import IFr
+
+DEFAULT_MEMORY_CACHE_BYTES = 256 * 2**20
+
+_FEATURES_KEY = "features"
+
+
+class CachedFr(IFr):
+    """
+    Face recognition algorithm wrapper that memoizes the features of the wrapped algorithm by (resolved) image
+    path and content hash. The features are kept in an in memory LRU cache (evicted by size in bytes) and,
+    optionally, in a persistent features cache, so the images are encoded once across calls and runs.
+    Algorithms that already cache their features (see IFr.caches_features) are never persisted again.
+    The wrapped algorithm must implement calc_distance_from_features.
+    """
+
+    def __init__(
+        self,
+        ifr: IFr,
+        cache_name: str = None,
+        max_bytes: int = DEFAULT_MEMORY_CACHE_BYTES,
+        persistent: bool = True,
+    ):
+        """
+        :param ifr: Face recognition algorithm to wrap.
+        :param cache_name: Name of the persistent features cache ("ifr_<algorithm class>" by default).
+        :param max_bytes: Max size of the in memory features.
+        :param persistent: Also save the features in the persistent features cache (ignored when the algorithm
+        already caches its features).
+        """
+        self.ifr = ifr
+        self.max_bytes = max_bytes
+        self.cache = None
+        if persistent and not ifr.caches_features:
+            cache_name = (
+                f"ifr_{type(ifr).__name__.lower()}" if cache_name is None else cache_name
+            )
+            self.cache = get_features_cache(cache_name)
+
+        self.hits = 0
+        self.misses = 0
+        self.__memory = OrderedDict()
+        self.__memory_bytes = 0
+
+    def __remember(self, key: tuple, features: np.ndarray) -> None:
+        self.__memory[key] = features
+        self.__memory_bytes += features.nbytes
+        while self.__memory_bytes > self.max_bytes and len(self.__memory) > 1:
+            _, evicted = self.__memory.popitem(last=False)
+            self.__memory_bytes -= evicted.nbytes
+
+    def gen_features(self, img_path: Path) -> np.ndarray:
+        img_path = str(Path(img_path).resolve())
+        img_hash = content_hash(img_path)
+        key = (img_path, img_hash)
+
+        features = self.__memory.get(key, None)
+        if features is not None:
+            self.__memory.move_to_end(key)
+            self.hits += 1
+            return features
+
+        cached = (
+            self.cache.get(img_path, content_hash=img_hash)
+            if self.cache is not None
+            else None
+        )
+        if cached is not None and cached.get(_FEATURES_KEY, None) is not None:
+            features = cached[_FEATURES_KEY]
+            self.hits += 1
+        else:
+            features = np.asarray(self.ifr.gen_features(img_path), dtype=np.float32)
+            self.misses += 1
+            if self.cache is not None:
+                self.cache.put(
+                    img_path, {_FEATURES_KEY: features}, content_hash=img_hash
+                )
+
+        self.__remember(key, features)
+        return features
+
+    def calc_distance_from_features(self, img1_features, img2_features):
+        return self.ifr.calc_distance_from_features(img1_features, img2_features)
+
+    def calc_distance(self, img_path_1: Path, img_path_2: Path):
+        return self.calc_distance_from_features(
+            self.gen_features(img_path_1), self.gen_features(img_path_2)
+        )
+
+    def check(
+        self, img_path_1: Path, img_path_2: Path, distance_tolerance: float = 0.6
+    ) -> bool:
+        return self.calc_distance(img_path_1, img_path_2) <= distance_tolerance
+
+    def flush(self) -> None:
+        """
+        Write the pending features to the persistent features cache.
+        """
+        if self.cache is not None:
+            self.cache.flush()
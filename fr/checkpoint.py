@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+_CHECKPOINTS_FOLDER = "checkpoints"
+_LOG_EXTENSION = ".log"
+_SEGMENT_EXTENSION = ".npz"
+
+
+def _signature(names: list, block_size: int) -> str:
+    names_hash = hashlib.blake2b(digest_size=16)
+    names_hash.update(str(block_size).encode())
+    for name in names:
+        names_hash.update(b"\n" + name.encode())
+    return names_hash.hexdigest()
+
+
+class DistancesCheckpoint:
+    """
+    Append-only checkpoint log of the finished row blocks of a distances key. Each finished row block
+    appends one line to the log, so the checkpoint cost does not depend on how many pairs are already done.
+    Optionally, the distances of every row block are also written to an (atomic) segment file that can be
+    replayed into the distances matrix.
+
+    The log is bound to the names (and their order) and the block size of the run, any change starts a new log.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        key: str,
+        names: list,
+        block_size: int,
+        segments: bool = False,
+    ):
+        self.folder = Path(folder, _CHECKPOINTS_FOLDER)
+        self.key = key
+        self.segments = segments
+        self.log_path = self.folder.joinpath(key + _LOG_EXTENSION)
+        self.signature = _signature(names, block_size)
+        self.__finished = {}
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if not self.__load():
+            self.clear()
+
+    def __segment_path(self, row_start: int) -> Path:
+        return self.folder.joinpath(f"{self.key}_{row_start:09d}{_SEGMENT_EXTENSION}")
+
+    def __load(self) -> bool:
+        if not self.log_path.exists():
+            return False
+
+        with open(self.log_path, "rb+") as f:
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                return False
+            if header.get("signature", None) != self.signature:
+                logging.info(f"Names changed, discarding checkpoint {self.log_path}")
+                return False
+
+            valid_end = f.tell()
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break  # Partially written line (interrupted run)
+                valid_end = f.tell()
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.__finished[entry["row_start"]] = entry
+
+            # New entries are appended after the last complete line
+            f.truncate(valid_end)
+
+        logging.info(
+            f"Checkpoint {self.log_path} recovered. {len(self.__finished)} row blocks finished"
+        )
+        return True
+
+    def clear(self) -> None:
+        """
+        Remove the log and segment files and start a new log.
+        """
+        for segment_path in self.folder.glob(f"{self.key}_*{_SEGMENT_EXTENSION}"):
+            segment_path.unlink()
+        self.__finished = {}
+
+        tmp_path = self.log_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"key": self.key, "signature": self.signature}) + "\n")
+        os.replace(tmp_path, self.log_path)
+
+    def is_finished(self, row_start: int) -> bool:
+        return row_start in self.__finished
+
+    def finish_rows(
+        self,
+        row_start: int,
+        row_end: int,
+        rows_idxes: np.ndarray = None,
+        cols_idxes: np.ndarray = None,
+        distances: np.ndarray = None,
+    ) -> None:
+        """
+        Record a finished row block. The distances must already be flushed to the store.
+
+        :param rows_idxes: Store indexes of the rows of the block (only needed with segments).
+        :param cols_idxes: Store indexes of the columns of the block (only needed with segments).
+        :param distances: Distances of the block (only needed with segments).
+        """
+        entry = {"row_start": row_start, "row_end": row_end, "segment": None}
+        if self.segments and distances is not None:
+            segment_path = self.__segment_path(row_start)
+            tmp_path = segment_path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, rows=rows_idxes, cols=cols_idxes, distances=distances)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, segment_path)
+            entry["segment"] = segment_path.name
+
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.__finished[row_start] = entry
+
+    def replay(self, matrix: np.ndarray) -> int:
+        """
+        Write the segments of the finished row blocks back into a (symmetric) distances matrix,
+        only for the blocks that are not complete in the matrix.
+
+        :return: Number of replayed segments.
+        """
+        replayed = 0
+        for entry in self.__finished.values():
+            if entry["segment"] is None:
+                continue
+            segment = np.load(self.folder.joinpath(entry["segment"]))
+            block_idxes = np.ix_(segment["rows"], segment["cols"])
+            if not np.isnan(matrix[block_idxes]).any():
+                continue
+            matrix[block_idxes] = segment["distances"]
+            matrix[np.ix_(segment["cols"], segment["rows"])] = segment["distances"].T
+            replayed += 1
+
+        return replayed
@@ -0,0 +1,299 @@
+import logging
+from math import inf
+from time import time
+
+import numpy as np
+
+from fr.checkpoint import DistancesCheckpoint
+from fr.distances_store import DistancesStore
+
+DEFAULT_BLOCK_SIZE = 512
+DEFAULT_MAX_BLOCK_BYTES = 256 * 2**20  # Max size of the temporary arrays of each block
+
+METRIC_L2 = "l2"
+METRIC_L1 = "l1"
+METRIC_MAE = "mae"
+
+
+def l2_distances(features_1: np.ndarray, features_2: np.ndarray, **_) -> np.ndarray:
+    """
+    Euclidean distances between all rows of two feature matrices (same as face_recognition.face_distance).
+    """
+    features_1 = features_1.astype(np.float64, copy=False)
+    features_2 = features_2.astype(np.float64, copy=False)
+    sqr_distances = (
+        np.einsum("ij,ij->i", features_1, features_1)[:, np.newaxis]
+        + np.einsum("ij,ij->i", features_2, features_2)[np.newaxis, :]
+        - 2.0 * (features_1 @ features_2.T)
+    )
+    np.maximum(sqr_distances, 0.0, out=sqr_distances)
+    return np.sqrt(sqr_distances)
+
+
+def l1_distances(
+    features_1: np.ndarray,
+    features_2: np.ndarray,
+    max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+) -> np.ndarray:
+    """
+    Sum of absolute differences between all rows of two feature matrices.
+    The features dimension is split in chunks to keep the temporary arrays under "max_block_bytes".
+    """
+    features_1 = features_1.reshape(len(features_1), -1)
+    features_2 = features_2.reshape(len(features_2), -1)
+    n_features = features_1.shape[1]
+    pair_bytes = max(len(features_1) * len(features_2) * features_1.itemsize, 1)
+    chunk = int(min(max(max_block_bytes // pair_bytes, 1), n_features))
+
+    distances = np.zeros((len(features_1), len(features_2)), dtype=np.float64)
+    for start in range(0, n_features, chunk):
+        delta = (
+            features_1[:, np.newaxis, start : start + chunk]
+            - features_2[np.newaxis, :, start : start + chunk]
+        )
+        np.abs(delta, out=delta)
+        distances += delta.sum(axis=2)
+
+    return distances
+
+
+def mae_distances(
+    features_1: np.ndarray,
+    features_2: np.ndarray,
+    max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+) -> np.ndarray:
+    """
+    Mean absolute error between all rows of two feature matrices (same as calc_resnet_distance).
+    """
+    n_features = features_1.reshape(len(features_1), -1).shape[1]
+    return (
+        l1_distances(features_1, features_2, max_block_bytes=max_block_bytes)
+        / n_features
+    )
+
+
+def weighted_l1_distances(
+    features_1: np.ndarray,
+    features_2: np.ndarray,
+    weights: np.ndarray,
+    max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+) -> np.ndarray:
+    """
+    Weighted sum of the per part L1 distances, for stacked (images x parts x features) tensors
+    (same as compare_hogs with HOG_OPT_ALL). With a single image as "features_1" it is one row of the matrix.
+    The weights can't be negative, so w * |a - b| = |w * a - w * b|: the parts are scaled by their
+    weights and the whole matrix is calculated as a single L1 distance.
+    """
+    weights = np.asarray(weights, dtype=np.result_type(features_1.dtype, np.float32))
+    if len(weights) != features_1.shape[1] or (weights < 0).any():
+        raise ValueError(
+            f"Invalid weights {weights} for {features_1.shape[1]} parts (they must not be negative)"
+        )
+
+    weights = weights.reshape((1, -1) + (1,) * (features_1.ndim - 2))
+    return l1_distances(
+        features_1 * weights, features_2 * weights, max_block_bytes=max_block_bytes
+    )
+
+
+__METRICS = {
+    METRIC_L2: l2_distances,
+    METRIC_L1: l1_distances,
+    METRIC_MAE: mae_distances,
+}
+
+
+def get_metric(metric: str, weights: np.ndarray = None):
+    if weights is not None:
+        return lambda f1, f2, **kwargs: weighted_l1_distances(f1, f2, weights, **kwargs)
+    return __METRICS[metric]
+
+
+def stack_features(features_lst: list, shape: tuple = None) -> tuple:
+    """
+    Stack a list of per image features (None/False for missing features) into a float32 matrix.
+
+    :param shape: Shape of each image features (inferred from the first valid features by default).
+
+    :return: (features matrix, validity mask)
+    """
+    if shape is None:
+        shape = next(
+            (
+                np.shape(f)
+                for f in features_lst
+                if f is not None and f is not False
+            ),
+            (1,),
+        )
+
+    features = np.zeros((len(features_lst),) + tuple(shape), dtype=np.float32)
+    valid = np.zeros(len(features_lst), dtype=bool)
+    for idx, tmp_features in enumerate(features_lst):
+        if tmp_features is None or tmp_features is False:
+            continue
+        features[idx] = np.asarray(tmp_features, dtype=np.float32).reshape(shape)
+        valid[idx] = True
+
+    return features, valid
+
+
+def iter_upper_blocks(
+    size: int, block_size: int = DEFAULT_BLOCK_SIZE, row_start: int = None
+):
+    """
+    Iterate over the (row_start, row_end, col_start, col_end) tiles of the upper triangle of a size x size matrix.
+
+    :param row_start: Only iterate over the tiles of the row of tiles starting at this row.
+    """
+    rows_starts = (
+        range(0, size, block_size) if row_start is None else [row_start]
+    )
+    for row_start in rows_starts:
+        row_end = min(row_start + block_size, size)
+        for col_start in range(row_start, size, block_size):
+            yield row_start, row_end, col_start, min(col_start + block_size, size)
+
+
+def calc_distances_matrix(
+    features: np.ndarray,
+    metric: str = METRIC_L2,
+    weights: np.ndarray = None,
+    valid: np.ndarray = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+) -> np.ndarray:
+    """
+    Calculate the full (N x N) distances matrix of the stacked features. Each pair is calculated once.
+    Invalid images (missing features) have infinite distances.
+    """
+    distances = np.empty((len(features), len(features)), dtype=np.float32)
+    metric_func = get_metric(metric, weights)
+    for row_start, row_end, col_start, col_end in iter_upper_blocks(
+        len(features), block_size
+    ):
+        block = metric_func(
+            features[row_start:row_end],
+            features[col_start:col_end],
+            max_block_bytes=max_block_bytes,
+        )
+        distances[row_start:row_end, col_start:col_end] = block
+        distances[col_start:col_end, row_start:row_end] = block.T
+
+    if valid is not None:
+        distances[~valid, :] = inf
+        distances[:, ~valid] = inf
+
+    return distances
+
+
+def fill_distances_store(
+    store: DistancesStore,
+    key: str,
+    names: list,
+    features: np.ndarray,
+    metric: str = METRIC_L2,
+    weights: np.ndarray = None,
+    valid: np.ndarray = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+    progress_callback=None,
+    checkpoint: bool = True,
+    checkpoint_segments: bool = False,
+) -> None:
+    """
+    Calculate the distances of all pairs of "names" for a distance key and save them into the store.
+    The work is split in tiles of the upper triangle, already calculated tiles are skipped.
+
+    :param features: Stacked features, one row per name.
+    :param valid: Validity mask (missing features), invalid images get infinite distances.
+    :param progress_callback: Called with (calculated pairs, total pairs) after every row of tiles.
+    :param checkpoint: Record every finished row of tiles in an append-only log, so a restart resumes from the last finished one.
+    :param checkpoint_segments: Also save the distances of every row of tiles into atomic segment files (replayed on restart).
+    """
+    metric_func = get_metric(metric, weights)
+    store_idxes = np.asarray([store.index_of(name) for name in names])
+    matrix = store.matrix(key)
+    if valid is None:
+        valid = np.ones(len(names), dtype=bool)
+
+    rows_checkpoint = None
+    if checkpoint:
+        rows_checkpoint = DistancesCheckpoint(
+            store.folder, key, names, block_size, segments=checkpoint_segments
+        )
+        if rows_checkpoint.replay(matrix):
+            store.flush()
+
+    total_distances = len(names) ** 2
+    calculated_distances = 0
+    for row_start in range(0, len(names), block_size):
+        row_end = min(row_start + block_size, len(names))
+        block_rows = store_idxes[row_start:row_end]
+        calculated_distances += (row_end - row_start) ** 2 + 2 * (
+            row_end - row_start
+        ) * (len(names) - row_end)
+
+        if rows_checkpoint is not None and rows_checkpoint.is_finished(row_start):
+            continue
+
+        for _, _, col_start, col_end in iter_upper_blocks(
+            len(names), block_size, row_start=row_start
+        ):
+            block_cols = store_idxes[col_start:col_end]
+
+            # Already calculated (both halves, a crash can leave a tile half written)
+            if not (
+                np.isnan(matrix[np.ix_(block_rows, block_cols)]).any()
+                or np.isnan(matrix[np.ix_(block_cols, block_rows)]).any()
+            ):
+                continue
+
+            block = metric_func(
+                features[row_start:row_end],
+                features[col_start:col_end],
+                max_block_bytes=max_block_bytes,
+            ).astype(np.float32)
+            block[~valid[row_start:row_end], :] = inf
+            block[:, ~valid[col_start:col_end]] = inf
+
+            matrix[np.ix_(block_rows, block_cols)] = block
+            matrix[np.ix_(block_cols, block_rows)] = block.T
+
+        store.flush()
+        if rows_checkpoint is not None:
+            block_cols = store_idxes[row_start:]
+            rows_checkpoint.finish_rows(
+                row_start,
+                row_end,
+                rows_idxes=block_rows,
+                cols_idxes=block_cols,
+                distances=(
+                    np.asarray(matrix[np.ix_(block_rows, block_cols)])
+                    if checkpoint_segments
+                    else None
+                ),
+            )
+        if progress_callback is not None:
+            progress_callback(calculated_distances, total_distances)
+
+
+def gen_progress_logger(title: str, message_func=None, message_step: float = 3e5):
+    """
+    Generate a progress callback for fill_distances_store, logging every update and
+    calling "message_func" (e.g. send_simple_message) at every "message_step" pairs.
+    """
+    start_time = time()
+    state = {"last_message": 0}
+
+    def progress_callback(calculated_distances: int, total_distances: int):
+        msg = f"{title} calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/max(total_distances, 1))*100, 2)}% | Total time: {int(time() - start_time)} s"
+        logging.info(msg)
+        if (
+            message_func is not None
+            and calculated_distances - state["last_message"] >= message_step
+        ):
+            state["last_message"] = calculated_distances
+            message_func(msg)
+
+    return progress_callback
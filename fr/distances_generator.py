@@ -1,12 +1,8 @@
-import json
 import logging
-from math import inf
 from pathlib import Path
 from time import time
 
-import numpy as np
-
-from dataset import DATASET_KIND_ALIGNED, get_file_path
+from dataset import DATASET_KIND_ALIGNED, find_file_path
 from fr.dlib import (
     DLIB_OPT_ALL,
     DLIB_OPT_EARS,
@@ -28,8 +24,31 @@ from fr.dlib import (
     DLIB_OPT_RIGHT_EYEBROW,
     DLIB_OPT_UPPER_LIP,
     DlibFr,
+    get_dlib_distance_weights,
+)
+from fr.distances_engine import (
+    METRIC_L1,
+    METRIC_L2,
+    fill_distances_store,
+    gen_progress_logger,
+    stack_features,
+)
+from fr.distances_store import DistancesStore, get_distances_store
+from fr.features_cache import (
+    DLIB_FACEPARTS_FEATURES_CACHE,
+    DLIB_FEATURES_CACHE,
+    HOG_FEATURES_CACHE,
+    img_content_hash,
+    import_legacy_json,
+)
+from fr.features_extraction import (
+    DEFAULT_CHUNKSIZE,
+    EXTRACTOR_DLIB,
+    EXTRACTOR_DLIB_FACEPARTS,
+    EXTRACTOR_HOG,
+    dlib_img_hash,
+    extract_features,
 )
-from fr.face_decomposition import decompose_face
 from fr.hog_descriptor import (
     HOG_OPT_ALL,
     HOG_OPT_EARS,
@@ -50,8 +69,14 @@ from fr.hog_descriptor import (
     HOG_OPT_RIGHT_EYE,
     HOG_OPT_RIGHT_EYEBROW,
     HOG_OPT_UPPER_LIP,
-    calc_hog,
-    compare_hogs,
+    calc_img_hogs,
+    get_hog_distance_weights,
+)
+from fr.knn_index import (
+    DEFAULT_TOP_K,
+    KNN_INDEX_EXACT,
+    gen_neighbors,
+    neighbors_path,
 )
 from util._telegram import send_simple_message
 
@@ -151,142 +176,71 @@ __DLIB_FACEPARTS_KEY_TO_OPT = {
 }
 
 
-def get_distances(file_path):
-    try:
-        return json.load(open(file_path, "r"))
-    except FileNotFoundError:
-        distancies = {}
-        json.dump(distancies, open(file_path, "w"))
-        return distancies
-
+def get_distances(file_path) -> DistancesStore:
+    return get_distances_store(file_path=file_path)
 
-def update_distances(new_distances_idx, file_path):
-    json.dump(new_distances_idx, open(file_path, "w"))
 
+def update_distances(new_distances_idx: DistancesStore, file_path):
+    new_distances_idx.flush()
 
-def get_dlib_data():
-    try:
-        return json.load(open(__DLIB_DATA_PATH, "r"))
-    except FileNotFoundError:
-        dlib_data = {}
-        json.dump(dlib_data, open(__DLIB_DATA_PATH, "w"))
-        return dlib_data
 
+def calc_hog_data(img_name: str) -> dict:
+    """
+    Calculate (or recover from the HOG features cache) the HOG features of all face parts options of an image ({<hog key>: features or None}).
+    """
+    hogs = calc_img_hogs(img_name, list(__HOG_KEY_TO_OPT.values()))
+    return {key: hogs[opt] for key, opt in __HOG_KEY_TO_OPT.items()}
 
-def update_dlib_data(new_features_maps):
-    json.dump(new_features_maps, open(__DLIB_DATA_PATH, "w"))
 
-
-def get_hog_data():
-    try:
-        # with open(__HOG_DATA_PATH, "rb") as handle:
-        #     return pickle.load(handle)
-        return json.load(open(__HOG_DATA_PATH, "r"))
-    except FileNotFoundError:
-        hog_data = {}
-        # with open(__HOG_DATA_PATH, "wb") as handle:
-        #     pickle.dump(hog_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        json.dump(hog_data, open(__HOG_DATA_PATH, "w"))
-        return hog_data
-
-
-def update_hog_data(new_hog_data):
-    json.dump(new_hog_data, open(__HOG_DATA_PATH, "w"))
-    # with open(__HOG_DATA_PATH, "wb") as handle:
-    #     pickle.dump(new_hog_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+def calc_faceparts_dlib_data(img_name: str, dlib_fr: DlibFr) -> dict:
+    """
+    Calculate (or recover from the DLIB faceparts features cache) the DLIB features of all face parts options of an image ({<dlib key>: features or None}).
+    """
+    features = dlib_fr.gen_img_facepart_features(
+        img_name, list(__DLIB_FACEPARTS_KEY_TO_OPT.values())
+    )
+    return {key: features[opt] for key, opt in __DLIB_FACEPARTS_KEY_TO_OPT.items()}
 
 
-def gen_dlib_distances(imgs_names: list):
+def gen_dlib_distances(
+    imgs_names: list, workers: int = None, chunksize: int = DEFAULT_CHUNKSIZE
+):
     distances = get_distances(file_path=__DISTANCES_DLIB_PATH)
-    dlib_data = get_dlib_data()
+    dlib_cache = import_legacy_json(
+        DLIB_FEATURES_CACHE,
+        __DLIB_DATA_PATH,
+        hash_func=dlib_img_hash,
+    )
     aligned_imgs_paths = [
-        get_file_path(img_name, dataset_kind=DATASET_KIND_ALIGNED)
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
         for img_name in imgs_names
     ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    distances.add_names(names)
+    distances.add_keys([__DLIB_KEY])
     dlib_fr = DlibFr()
 
-    calculated_distances = 0
-    dlib_data_changed = False
-    total_distances = len(aligned_imgs_paths) ** 2
     start_time = time()
-    start_loop_time = time()
-    for path1 in aligned_imgs_paths:
-
-        tmp_p1 = Path(path1)
-        name_1 = tmp_p1.stem
-
-        # Calculate/Recover img1 features
-        img1_features = dlib_data.get(name_1, None)
-        if img1_features is None:
-            img1_features = dlib_fr.gen_features(path1)
-            dlib_data[name_1] = {__DLIB_KEY: img1_features.tolist()}
-            dlib_data_changed = True
-            logging.info(f"DLIB data calculated (1) for {name_1}")
-        elif img1_features.get(__DLIB_KEY, None) is None:
-            img1_features[__DLIB_KEY] = dlib_fr.gen_features(path1).tolist()
-            dlib_data_changed = True
-            logging.info(f"DLIB data calculated (2) for {name_1}")
-        else:
-            img1_features = img1_features[__DLIB_KEY]
-
-        for path2 in aligned_imgs_paths:
-            start_loop_time = time()
-            tmp_p2 = Path(path2)
-            name_2 = tmp_p2.stem
-            tmp_key_1 = f"{name_1} x {name_2}"
-            tmp_key_2 = f"{name_2} x {name_1}"
-
-            tmp_distances = distances.get(tmp_key_1, {})
-            if not tmp_distances:
-                tmp_distances = distances.get(tmp_key_2, {})
-
-            dlib_distance = tmp_distances.get(__DLIB_KEY, None)
-            if dlib_distance is None:
-
-                # Calculate/Recover img2 features
-                img2_features = dlib_data.get(name_2, None)
-                if img2_features is None:
-                    img2_features = dlib_fr.gen_features(path2)
-                    dlib_data[name_2] = {__DLIB_KEY: img2_features.tolist()}
-                    dlib_data_changed = True
-                    logging.info(f"DLIB data calculated (1) for {name_2}")
-                elif img2_features.get(__DLIB_KEY, None) is None:
-                    img2_features[__DLIB_KEY] = dlib_fr.gen_features(path2).tolist()
-                    dlib_data_changed = True
-                    logging.info(f"DLIB data calculated (2) for {name_2}")
-                else:
-                    img2_features = img2_features[__DLIB_KEY]
-
-                # Calculate distance
-                tmp_distances[__DLIB_KEY] = dlib_fr.calc_distance_from_features(
-                    img1_features=np.asarray(img1_features),
-                    img2_features=np.asarray(img2_features),
-                )
-
-                distances[tmp_key_1] = tmp_distances
-
-            calculated_distances += 1
-            end_loop_time = time()
-            if calculated_distances % 3e5 == 0:
-                send_simple_message(
-                    f"DLIB Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-                )
-
-                # Save results
-                update_distances(distances, file_path=__DISTANCES_DLIB_PATH)
-                if dlib_data_changed:
-                    logging.info("Updating DLIB Data.")
-                    update_dlib_data(dlib_data)
-                    dlib_data_changed = False
-
-        # Inform state
-        logging.info(
-            f"DLIB Distances calculation done for {name_1}. Total time: {int(time() - start_time)} s"
-        )
 
-        logging.info(
-            f"DLIB Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-        )
+    # Extract the missing features in parallel, then recover all of them from the cache
+    extract_features(names, EXTRACTOR_DLIB, workers=workers, chunksize=chunksize)
+    features, valid = dlib_fr.gen_features_batch(aligned_imgs_paths, return_valid=True)
+
+    logging.info("Updating DLIB Data.")
+    dlib_cache.flush()
+
+    # Calculate all distances
+    fill_distances_store(
+        store=distances,
+        key=__DLIB_KEY,
+        names=names,
+        features=features,
+        metric=METRIC_L2,
+        valid=valid,
+        progress_callback=gen_progress_logger(
+            "DLIB Distances", message_func=send_simple_message
+        ),
+    )
 
     # Save final results
     update_distances(distances, file_path=__DISTANCES_DLIB_PATH)
@@ -300,290 +254,113 @@ def gen_dlib_distances(imgs_names: list):
     )
 
 
-def gen_hog_distances(imgs_names: list):
+def gen_dlib_neighbors(
+    imgs_names: list,
+    k: int = DEFAULT_TOP_K,
+    method: str = KNN_INDEX_EXACT,
+    workers: int = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    **index_kwargs,
+):
+    """
+    Calculate the top k DLIB neighbors of every image (e.g. "fr/neighbors_dlib.npz"), without the N x N
+    distances matrix. See fr.knn_index for the methods (KNN_INDEX_EXACT or KNN_INDEX_IVF) and their options.
+    """
+    dlib_cache = import_legacy_json(
+        DLIB_FEATURES_CACHE,
+        __DLIB_DATA_PATH,
+        hash_func=dlib_img_hash,
+    )
+    aligned_imgs_paths = [
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
+        for img_name in imgs_names
+    ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    dlib_fr = DlibFr()
+
+    start_time = time()
+
+    # Extract the missing features in parallel, then recover all of them from the cache
+    extract_features(names, EXTRACTOR_DLIB, workers=workers, chunksize=chunksize)
+    features, valid = dlib_fr.gen_features_batch(aligned_imgs_paths, return_valid=True)
+    dlib_cache.flush()
+
+    gen_neighbors(
+        neighbors_path(__DISTANCES_DLIB_PATH),
+        names,
+        features,
+        valid=valid,
+        k=k,
+        method=method,
+        metric=METRIC_L2,
+        **index_kwargs,
+    )
+
+    logging.info(
+        f"DLIB Neighbors calculation done. Total time: {int(time() - start_time)} s"
+    )
+    send_simple_message(
+        f"DLIB Neighbors calculation done. Total time: {int(time() - start_time)} s"
+    )
+
+
+def gen_hog_distances(
+    imgs_names: list,
+    workers: int = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    threads: bool = False,
+):
     distances = get_distances(file_path=__DISTANCES_HOG_PATH)
-    hog_data = get_hog_data()
+    hog_cache = import_legacy_json(
+        HOG_FEATURES_CACHE,
+        __HOG_DATA_PATH,
+        keys_map={key: str(opt) for key, opt in __HOG_KEY_TO_OPT.items()},
+        hash_func=img_content_hash,
+    )
     aligned_imgs_paths = [
-        get_file_path(img_name, dataset_kind=DATASET_KIND_ALIGNED)
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
         for img_name in imgs_names
     ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    distances.add_names(names)
+    distances.add_keys(list(__HOG_KEY_TO_OPT.keys()))
 
-    calculated_distances = 0
-    hog_data_changed = False
-    total_distances = len(aligned_imgs_paths) ** 2
     start_time = time()
-    start_loop_time = time()
-    for path1 in aligned_imgs_paths:
-        tmp_p1 = Path(path1)
-        name_1 = tmp_p1.stem
-
-        # Calculate/recover HOG data for img1
-        img1_features = hog_data.get(name_1, None)
-        if img1_features is None:
-            # Calculate hog features
-            face_parts = decompose_face(name_1)
-            all_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_ALL)
-            face_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_FACE)
-            left_eye_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_LEFT_EYE)
-            right_eye_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_RIGHT_EYE)
-            eyes_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_EYES)
-            left_eyebrow_features = calc_hog(
-                face_parts=face_parts, opt=HOG_OPT_LEFT_EYEBROW
-            )
-            right_eyebrow_features = calc_hog(
-                face_parts=face_parts, opt=HOG_OPT_RIGHT_EYEBROW
-            )
-            eyebrows_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_EYEBROWS)
-            left_ear_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_LEFT_EAR)
-            right_ear_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_RIGHT_EAR)
-            ears_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_EARS)
-            nose_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_NOSE)
-            lower_lip_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_LOWER_LIP)
-            upper_lip_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_UPPER_LIP)
-            mouth_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_MOUTH)
-            mouth_and_nose_features = calc_hog(
-                face_parts=face_parts, opt=HOG_OPT_MOUTH_AND_NOSE
-            )
-            eyes_and_eyebrows_features = calc_hog(
-                face_parts=face_parts, opt=HOG_OPT_EYES_AND_EYEBROWS
-            )
-            eyes_and_nose_features = calc_hog(
-                face_parts=face_parts, opt=HOG_OPT_EYES_AND_NOSE
-            )
-            full_face_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_FULL_FACE)
-
-            # Save HOG features
-            hog_data[name_1] = {
-                __HOG_KEY: all_features.tolist() if all_features is not None else False,
-                __HOG_FACE_KEY: face_features.tolist()
-                if face_features is not None
-                else False,
-                __HOG_LEFT_EYE_KEY: left_eye_features.tolist()
-                if left_eye_features is not None
-                else False,
-                __HOG_RIGHT_EYE_KEY: right_eye_features.tolist()
-                if right_eye_features is not None
-                else False,
-                __HOG_EYES_KEY: eyes_features.tolist(),
-                __HOG_LEFT_EYEBROW_KEY: left_eyebrow_features.tolist()
-                if left_eyebrow_features is not None
-                else False,
-                __HOG_RIGHT_EYEBROW_KEY: right_eyebrow_features.tolist()
-                if right_eyebrow_features is not None
-                else False,
-                __HOG_EYEBROWS_KEY: eyebrows_features.tolist()
-                if eyebrows_features is not None
-                else False,
-                __HOG_LEFT_EAR_KEY: left_ear_features.tolist()
-                if left_ear_features is not None
-                else False,
-                __HOG_RIGHT_EAR_KEY: right_ear_features.tolist()
-                if right_ear_features is not None
-                else False,
-                __HOG_EARS_KEY: ears_features.tolist()
-                if ears_features is not None
-                else False,
-                __HOG_NOSE_KEY: nose_features.tolist()
-                if nose_features is not None
-                else False,
-                __HOG_LOWER_LIP_KEY: lower_lip_features.tolist()
-                if lower_lip_features is not None
-                else False,
-                __HOG_UPPER_LIP_KEY: upper_lip_features.tolist()
-                if upper_lip_features is not None
-                else False,
-                __HOG_MOUTH_KEY: mouth_features.tolist()
-                if mouth_features is not None
-                else False,
-                __HOG_MOUTH_AND_NOSE_KEY: mouth_and_nose_features.tolist()
-                if mouth_and_nose_features is not None
-                else False,
-                __HOG_EYES_AND_EYEBROWS_KEY: eyes_and_eyebrows_features.tolist()
-                if eyes_and_eyebrows_features is not None
-                else False,
-                __HOG_EYES_AND_NOSE_KEY: eyes_and_nose_features.tolist()
-                if eyes_and_nose_features is not None
-                else False,
-                __HOG_FULL_FACE_KEY: full_face_features.tolist()
-                if full_face_features is not None
-                else False,
-            }
-
-            img1_features = hog_data[name_1]
-
-            hog_data_changed = True
-            logging.info(f"HOG data calculated for {name_1}")
-
-        for path2 in aligned_imgs_paths:
-            start_loop_time = time()
-
-            tmp_p2 = Path(path2)
-            name_2 = tmp_p2.stem
-            tmp_key_1 = f"{name_1} x {name_2}"
-            tmp_key_2 = f"{name_2} x {name_1}"
-
-            # Check for already calculated distances
-            tmp_distances = distances.get(tmp_key_1, {})
-            if not tmp_distances:
-                tmp_distances = distances.get(tmp_key_2, {})
-
-            # Try recover already calculated distance
-            hog_distance = tmp_distances.get(__HOG_KEY, None)
-            if hog_distance is None:
-
-                # Calculate/recover HOG data for img2
-                img2_features = hog_data.get(name_2, None)
-                if img2_features is None:
-                    # Calculate hog features
-                    face_parts = decompose_face(name_2)
-                    all_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_ALL)
-                    face_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_FACE)
-                    left_eye_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_LEFT_EYE
-                    )
-                    right_eye_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_RIGHT_EYE
-                    )
-                    eyes_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_EYES)
-                    left_eyebrow_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_LEFT_EYEBROW
-                    )
-                    right_eyebrow_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_RIGHT_EYEBROW
-                    )
-                    eyebrows_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_EYEBROWS
-                    )
-                    left_ear_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_LEFT_EAR
-                    )
-                    right_ear_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_RIGHT_EAR
-                    )
-                    ears_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_EARS)
-                    nose_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_NOSE)
-                    lower_lip_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_LOWER_LIP
-                    )
-                    upper_lip_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_UPPER_LIP
-                    )
-                    mouth_features = calc_hog(face_parts=face_parts, opt=HOG_OPT_MOUTH)
-                    mouth_and_nose_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_MOUTH_AND_NOSE
-                    )
-                    eyes_and_eyebrows_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_EYES_AND_EYEBROWS
-                    )
-                    eyes_and_nose_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_EYES_AND_NOSE
-                    )
-                    full_face_features = calc_hog(
-                        face_parts=face_parts, opt=HOG_OPT_FULL_FACE
-                    )
-
-                    # Save HOG features
-                    hog_data[name_2] = {
-                        __HOG_KEY: all_features.tolist()
-                        if all_features is not None
-                        else False,
-                        __HOG_FACE_KEY: face_features.tolist()
-                        if face_features is not None
-                        else False,
-                        __HOG_LEFT_EYE_KEY: left_eye_features.tolist()
-                        if left_eye_features is not None
-                        else False,
-                        __HOG_RIGHT_EYE_KEY: right_eye_features.tolist()
-                        if right_eye_features is not None
-                        else False,
-                        __HOG_EYES_KEY: eyes_features.tolist()
-                        if eyes_features is not None
-                        else False,
-                        __HOG_LEFT_EYEBROW_KEY: left_eyebrow_features.tolist()
-                        if left_eyebrow_features is not None
-                        else False,
-                        __HOG_RIGHT_EYEBROW_KEY: right_eyebrow_features.tolist()
-                        if right_eyebrow_features is not None
-                        else False,
-                        __HOG_EYEBROWS_KEY: eyebrows_features.tolist()
-                        if eyebrows_features is not None
-                        else False,
-                        __HOG_LEFT_EAR_KEY: left_ear_features.tolist()
-                        if left_ear_features is not None
-                        else False,
-                        __HOG_RIGHT_EAR_KEY: right_ear_features.tolist()
-                        if right_ear_features is not None
-                        else False,
-                        __HOG_EARS_KEY: ears_features.tolist()
-                        if ears_features is not None
-                        else False,
-                        __HOG_NOSE_KEY: nose_features.tolist()
-                        if nose_features is not None
-                        else False,
-                        __HOG_LOWER_LIP_KEY: lower_lip_features.tolist()
-                        if lower_lip_features is not None
-                        else False,
-                        __HOG_UPPER_LIP_KEY: upper_lip_features.tolist()
-                        if upper_lip_features is not None
-                        else False,
-                        __HOG_MOUTH_KEY: mouth_features.tolist()
-                        if mouth_features is not None
-                        else False,
-                        __HOG_MOUTH_AND_NOSE_KEY: mouth_and_nose_features.tolist()
-                        if mouth_and_nose_features is not None
-                        else False,
-                        __HOG_EYES_AND_EYEBROWS_KEY: eyes_and_eyebrows_features.tolist()
-                        if eyes_and_eyebrows_features is not None
-                        else False,
-                        __HOG_EYES_AND_NOSE_KEY: eyes_and_nose_features.tolist()
-                        if eyes_and_nose_features is not None
-                        else False,
-                        __HOG_FULL_FACE_KEY: full_face_features.tolist()
-                        if full_face_features is not None
-                        else False,
-                    }
-
-                    img2_features = hog_data[name_2]
-
-                    hog_data_changed = True
-                    logging.info(f"HOG data calculated for {name_2}")
-
-                # Calculate distance
-                for key, tmp_features_1 in img1_features.items():
-                    tmp_features_2 = img2_features.get(key)
-                    if tmp_features_1 == False or tmp_features_2 == False:
-                        tmp_distances[key] = inf
-                    else:
-                        tmp_distances[key] = compare_hogs(
-                            hog_1=np.asarray(tmp_features_1),
-                            hog_2=np.asarray(tmp_features_2),
-                            opt=__HOG_KEY_TO_OPT[key],
-                        )
-
-                distances[tmp_key_1] = tmp_distances
-
-            calculated_distances += 1
-            end_loop_time = time()
-            if calculated_distances % 3e5 == 0:
-                send_simple_message(
-                    f"HOG Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-                )
-
-                # Update results
-                update_distances(distances, file_path=__DISTANCES_HOG_PATH)
-
-                # Update HOG Tmp data if needed
-                if hog_data_changed:
-                    logging.info("Updating HOG Data.")
-                    update_hog_data(hog_data)
-                    hog_data_changed = False
-
-        # Inform state
-        logging.info(
-            f"HOG Distances calculation done for {name_1}. Total time: {int(time() - start_time)} s"
-        )
-        logging.info(
-            f"HOG Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
+
+    # Extract the missing HOG data in parallel, then recover all of it from the cache
+    extract_features(
+        names,
+        EXTRACTOR_HOG,
+        opts=list(__HOG_KEY_TO_OPT.values()),
+        workers=workers,
+        chunksize=chunksize,
+        threads=threads,
+    )
+    hog_data = {name: calc_hog_data(name) for name in names}
+
+    logging.info("Updating HOG Data.")
+    hog_cache.flush()
+
+    # Calculate all distances, option by option
+    for key, opt in __HOG_KEY_TO_OPT.items():
+        features, valid = stack_features([hog_data[name][key] for name in names])
+        if opt == HOG_OPT_ALL:
+            weights = get_hog_distance_weights()
+            features = features.reshape(len(names), len(weights), -1)
+        else:
+            weights = None
+
+        fill_distances_store(
+            store=distances,
+            key=key,
+            names=names,
+            features=features,
+            metric=METRIC_L1,
+            weights=weights,
+            valid=valid,
+            progress_callback=gen_progress_logger(
+                f"HOG Distances ({key})", message_func=send_simple_message
+            ),
         )
 
     # Save final results
@@ -598,333 +375,62 @@ def gen_hog_distances(imgs_names: list):
     )
 
 
-def gen_dlib_faceparts_distances(imgs_names: list):
+def gen_dlib_faceparts_distances(
+    imgs_names: list, workers: int = None, chunksize: int = DEFAULT_CHUNKSIZE
+):
     distances = get_distances(file_path=__DISTANCES_DLIB_FACEPARTS_PATH)
-    dlib_data = get_faceparts_dlib_data()
+    dlib_cache = import_legacy_json(
+        DLIB_FACEPARTS_FEATURES_CACHE,
+        __DLIB_FACEPARTS_DATA_PATH,
+        keys_map={key: str(opt) for key, opt in __DLIB_FACEPARTS_KEY_TO_OPT.items()},
+        hash_func=img_content_hash,
+    )
     aligned_imgs_paths = [
-        get_file_path(img_name, dataset_kind=DATASET_KIND_ALIGNED)
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
         for img_name in imgs_names
     ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    distances.add_names(names)
+    distances.add_keys(list(__DLIB_FACEPARTS_KEY_TO_OPT.keys()))
     dlib_fr = DlibFr()
 
-    calculated_distances = 0
-    dlib_data_changed = False
-    total_distances = len(aligned_imgs_paths) ** 2
     start_time = time()
-    start_loop_time = time()
-    for path1 in aligned_imgs_paths:
-        tmp_p1 = Path(path1)
-        name_1 = tmp_p1.stem
-
-        # Calculate/recover DLIB data for img1
-        img1_features = dlib_data.get(name_1, None)
-        if img1_features is None:
-            # Calculate hog features
-            face_parts = decompose_face(name_1)
-            all_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_ALL
-            )
-            face_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_FACE
-            )
-            left_eye_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_LEFT_EYE
-            )
-            right_eye_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_RIGHT_EYE
-            )
-            eyes_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_EYES
-            )
-            left_eyebrow_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_LEFT_EYEBROW
-            )
-            right_eyebrow_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_RIGHT_EYEBROW
-            )
-            eyebrows_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_EYEBROWS
-            )
-            left_ear_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_LEFT_EAR
-            )
-            right_ear_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_RIGHT_EAR
-            )
-            ears_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_EARS
-            )
-            nose_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_NOSE
-            )
-            lower_lip_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_LOWER_LIP
-            )
-            upper_lip_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_UPPER_LIP
-            )
-            mouth_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_MOUTH
-            )
-            mouth_and_nose_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_MOUTH_AND_NOSE
-            )
-            eyes_and_eyebrows_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_EYES_AND_EYEBROWS
-            )
-            eyes_and_nose_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_EYES_AND_NOSE
-            )
-            full_face_features = dlib_fr.gen_facepart_features(
-                face_parts=face_parts, opt=DLIB_OPT_FULL_FACE
-            )
-
-            # Save DLIB features
-            dlib_data[name_1] = {
-                __DLIB_FACEPARTS_KEY: all_features.tolist()
-                if all_features is not None
-                else False,
-                __DLIB_FACEPARTS_FACE_KEY: face_features.tolist()
-                if face_features is not None
-                else False,
-                __DLIB_FACEPARTS_LEFT_EYE_KEY: left_eye_features.tolist()
-                if left_eye_features is not None
-                else False,
-                __DLIB_FACEPARTS_RIGHT_EYE_KEY: right_eye_features.tolist()
-                if right_eye_features is not None
-                else False,
-                __DLIB_FACEPARTS_EYES_KEY: eyes_features.tolist(),
-                __DLIB_FACEPARTS_LEFT_EYEBROW_KEY: left_eyebrow_features.tolist()
-                if left_eyebrow_features is not None
-                else False,
-                __DLIB_FACEPARTS_RIGHT_EYEBROW_KEY: right_eyebrow_features.tolist()
-                if right_eyebrow_features is not None
-                else False,
-                __DLIB_FACEPARTS_EYEBROWS_KEY: eyebrows_features.tolist()
-                if eyebrows_features is not None
-                else False,
-                __DLIB_FACEPARTS_LEFT_EAR_KEY: left_ear_features.tolist()
-                if left_ear_features is not None
-                else False,
-                __DLIB_FACEPARTS_RIGHT_EAR_KEY: right_ear_features.tolist()
-                if right_ear_features is not None
-                else False,
-                __DLIB_FACEPARTS_EARS_KEY: ears_features.tolist()
-                if ears_features is not None
-                else False,
-                __DLIB_FACEPARTS_NOSE_KEY: nose_features.tolist()
-                if nose_features is not None
-                else False,
-                __DLIB_FACEPARTS_LOWER_LIP_KEY: lower_lip_features.tolist()
-                if lower_lip_features is not None
-                else False,
-                __DLIB_FACEPARTS_UPPER_LIP_KEY: upper_lip_features.tolist()
-                if upper_lip_features is not None
-                else False,
-                __DLIB_FACEPARTS_MOUTH_KEY: mouth_features.tolist()
-                if mouth_features is not None
-                else False,
-                __DLIB_FACEPARTS_MOUTH_AND_NOSE_KEY: mouth_and_nose_features.tolist()
-                if mouth_and_nose_features is not None
-                else False,
-                __DLIB_FACEPARTS_EYES_AND_EYEBROWS_KEY: eyes_and_eyebrows_features.tolist()
-                if eyes_and_eyebrows_features is not None
-                else False,
-                __DLIB_FACEPARTS_EYES_AND_NOSE_KEY: eyes_and_nose_features.tolist()
-                if eyes_and_nose_features is not None
-                else False,
-                __DLIB_FACEPARTS_FULL_FACE_KEY: full_face_features.tolist()
-                if full_face_features is not None
-                else False,
-            }
-
-            img1_features = dlib_data[name_1]
-
-            dlib_data_changed = True
-            logging.info(f"HOG data calculated for {name_1}")
-
-        for path2 in aligned_imgs_paths:
-            start_loop_time = time()
-
-            tmp_p2 = Path(path2)
-            name_2 = tmp_p2.stem
-            tmp_key_1 = f"{name_1} x {name_2}"
-            tmp_key_2 = f"{name_2} x {name_1}"
-
-            # Check for already calculated distances
-            tmp_distances = distances.get(tmp_key_1, {})
-            if not tmp_distances:
-                tmp_distances = distances.get(tmp_key_2, {})
-
-            # Try recover already calculated distance
-            hog_distance = tmp_distances.get(__DLIB_FACEPARTS_KEY, None)
-            if hog_distance is None:
-
-                # Calculate/recover HOG data for img2
-                img2_features = dlib_data.get(name_2, None)
-                if img2_features is None:
-                    # Calculate hog features
-                    face_parts = decompose_face(name_2)
-                    all_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_ALL
-                    )
-                    face_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_FACE
-                    )
-                    left_eye_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_LEFT_EYE
-                    )
-                    right_eye_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_RIGHT_EYE
-                    )
-                    eyes_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_EYES
-                    )
-                    left_eyebrow_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_LEFT_EYEBROW
-                    )
-                    right_eyebrow_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_RIGHT_EYEBROW
-                    )
-                    eyebrows_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_EYEBROWS
-                    )
-                    left_ear_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_LEFT_EAR
-                    )
-                    right_ear_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_RIGHT_EAR
-                    )
-                    ears_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_EARS
-                    )
-                    nose_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_NOSE
-                    )
-                    lower_lip_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_LOWER_LIP
-                    )
-                    upper_lip_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_UPPER_LIP
-                    )
-                    mouth_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_MOUTH
-                    )
-                    mouth_and_nose_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_MOUTH_AND_NOSE
-                    )
-                    eyes_and_eyebrows_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_EYES_AND_EYEBROWS
-                    )
-                    eyes_and_nose_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_EYES_AND_NOSE
-                    )
-                    full_face_features = dlib_fr.gen_facepart_features(
-                        face_parts=face_parts, opt=DLIB_OPT_FULL_FACE
-                    )
-
-                    # Save HOG features
-                    dlib_data[name_2] = {
-                        __DLIB_FACEPARTS_KEY: all_features.tolist()
-                        if all_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_FACE_KEY: face_features.tolist()
-                        if face_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_LEFT_EYE_KEY: left_eye_features.tolist()
-                        if left_eye_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_RIGHT_EYE_KEY: right_eye_features.tolist()
-                        if right_eye_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_EYES_KEY: eyes_features.tolist()
-                        if eyes_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_LEFT_EYEBROW_KEY: left_eyebrow_features.tolist()
-                        if left_eyebrow_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_RIGHT_EYEBROW_KEY: right_eyebrow_features.tolist()
-                        if right_eyebrow_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_EYEBROWS_KEY: eyebrows_features.tolist()
-                        if eyebrows_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_LEFT_EAR_KEY: left_ear_features.tolist()
-                        if left_ear_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_RIGHT_EAR_KEY: right_ear_features.tolist()
-                        if right_ear_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_EARS_KEY: ears_features.tolist()
-                        if ears_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_NOSE_KEY: nose_features.tolist()
-                        if nose_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_LOWER_LIP_KEY: lower_lip_features.tolist()
-                        if lower_lip_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_UPPER_LIP_KEY: upper_lip_features.tolist()
-                        if upper_lip_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_MOUTH_KEY: mouth_features.tolist()
-                        if mouth_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_MOUTH_AND_NOSE_KEY: mouth_and_nose_features.tolist()
-                        if mouth_and_nose_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_EYES_AND_EYEBROWS_KEY: eyes_and_eyebrows_features.tolist()
-                        if eyes_and_eyebrows_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_EYES_AND_NOSE_KEY: eyes_and_nose_features.tolist()
-                        if eyes_and_nose_features is not None
-                        else False,
-                        __DLIB_FACEPARTS_FULL_FACE_KEY: full_face_features.tolist()
-                        if full_face_features is not None
-                        else False,
-                    }
-
-                    img2_features = dlib_data[name_2]
-
-                    dlib_data_changed = True
-                    logging.info(f"HOG data calculated for {name_2}")
-
-                # Calculate distance
-                for key, tmp_features_1 in img1_features.items():
-                    tmp_features_2 = img2_features.get(key)
-                    if tmp_features_1 == False or tmp_features_2 == False:
-                        tmp_distances[key] = inf
-                    else:
-                        tmp_distances[key] = dlib_fr.gen_faceparts_distance(
-                            hog_1=np.asarray(tmp_features_1),
-                            hog_2=np.asarray(tmp_features_2),
-                            opt=__DLIB_FACEPARTS_KEY_TO_OPT[key],
-                        )
-
-                distances[tmp_key_1] = tmp_distances
-
-            calculated_distances += 1
-            end_loop_time = time()
-            if calculated_distances % 3e5 == 0:
-                send_simple_message(
-                    f"DLIB Faceparts Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-                )
-
-                # Update results
-                update_distances(distances, file_path=__DISTANCES_DLIB_FACEPARTS_PATH)
-
-                # Update DLIB Faceparts Tmp data if needed
-                if dlib_data_changed:
-                    logging.info("Updating DLIB Faceparts Data.")
-                    update_hog_data(dlib_data)
-                    dlib_data_changed = False
-
-        # Inform state
-        logging.info(
-            f"DLIB Faceparts Distances calculation done for {name_1}. Total time: {int(time() - start_time)} s"
-        )
-        logging.info(
-            f"DLIB Faceparts Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
+
+    # Extract the missing DLIB Faceparts data in parallel, then recover all of it from the cache
+    extract_features(
+        names,
+        EXTRACTOR_DLIB_FACEPARTS,
+        opts=list(__DLIB_FACEPARTS_KEY_TO_OPT.values()),
+        workers=workers,
+        chunksize=chunksize,
+    )
+    dlib_data = {
+        name: calc_faceparts_dlib_data(name, dlib_fr=dlib_fr) for name in names
+    }
+
+    logging.info("Updating DLIB Faceparts Data.")
+    dlib_cache.flush()
+
+    # Calculate all distances, option by option
+    for key, opt in __DLIB_FACEPARTS_KEY_TO_OPT.items():
+        features, valid = stack_features([dlib_data[name][key] for name in names])
+        if opt == DLIB_OPT_ALL:
+            weights = get_dlib_distance_weights()
+            features = features.reshape(len(names), len(weights), -1)
+        else:
+            weights = None
+
+        fill_distances_store(
+            store=distances,
+            key=key,
+            names=names,
+            features=features,
+            metric=METRIC_L1,
+            weights=weights,
+            valid=valid,
+            progress_callback=gen_progress_logger(
+                f"DLIB Faceparts Distances ({key})", message_func=send_simple_message
+            ),
         )
 
     # Save final results
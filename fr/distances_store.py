@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+from math import isnan
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+_MANIFEST_FILE = "manifest.json"
+_MATRIX_EXTENSION = ".npy"
+_DTYPE = "float32"
+_FILL_ROWS_STEP = 1024
+
+
+def _manifest_path(folder: Path) -> Path:
+    return Path(folder, _MANIFEST_FILE)
+
+
+def _matrix_path(folder: Path, key: str) -> Path:
+    return Path(folder, key + _MATRIX_EXTENSION)
+
+
+def _new_matrix(file_path: Path, size: int) -> np.memmap:
+    matrix = np.lib.format.open_memmap(
+        file_path, mode="w+", dtype=_DTYPE, shape=(size, size)
+    )
+
+    # Not calculated distances are kept as NaN
+    for row in range(0, size, _FILL_ROWS_STEP):
+        matrix[row : row + _FILL_ROWS_STEP] = np.nan
+
+    return matrix
+
+
+class DistancesStore:
+    """
+    Columnar distances storage. Images names are mapped to integer ids and every
+    distance key (e.g. "dlib", "hog_eyes", "resnet_nose") is kept as a N x N
+    float32 matrix memory-mapped from disk. A small JSON manifest keeps the
+    names and keys. Not calculated distances are NaN.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        names: list = None,
+        keys: list = None,
+        readonly: bool = False,
+    ):
+        self.folder = Path(folder)
+        self.readonly = readonly
+        self.names = []
+        self.keys = []
+        self.__names_idx = {}
+        self.__matrices = {}
+
+        if _manifest_path(self.folder).exists():
+            manifest = json.load(open(_manifest_path(self.folder), "r"))
+            self.names = manifest["names"]
+            self.keys = manifest["keys"]
+            self.__names_idx = {name: idx for idx, name in enumerate(self.names)}
+        elif readonly:
+            raise FileNotFoundError(f"No distances store found at {self.folder}")
+        else:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self.__save_manifest()
+
+        if names:
+            self.add_names(names)
+        if keys:
+            self.add_keys(keys)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__names_idx
+
+    def __save_manifest(self):
+        tmp_path = _manifest_path(self.folder).with_suffix(".tmp")
+        json.dump(
+            {"names": self.names, "keys": self.keys, "dtype": _DTYPE},
+            open(tmp_path, "w"),
+        )
+        os.replace(tmp_path, _manifest_path(self.folder))
+
+    def index_of(self, name: str) -> int:
+        return self.__names_idx[name]
+
+    def matrix(self, key: str) -> np.memmap:
+        matrix = self.__matrices.get(key, None)
+        if matrix is None:
+            matrix = np.load(
+                _matrix_path(self.folder, key),
+                mmap_mode="r" if self.readonly else "r+",
+            )
+            self.__matrices[key] = matrix
+        return matrix
+
+    def add_keys(self, keys: list) -> None:
+        new_keys = [k for k in keys if k not in self.keys]
+        if not new_keys:
+            return
+
+        for key in new_keys:
+            self.__matrices[key] = _new_matrix(
+                _matrix_path(self.folder, key), len(self.names)
+            )
+
+        self.keys += new_keys
+        self.__save_manifest()
+
+    def add_names(self, names: list) -> None:
+        """
+        Add new images to the store. The matrices are grown (copying the already
+        calculated distances) only when there are new names.
+        """
+        new_names = [n for n in dict.fromkeys(names) if n not in self.__names_idx]
+        if not new_names:
+            return
+
+        old_size = len(self.names)
+        new_size = old_size + len(new_names)
+        for key in self.keys:
+            old_matrix = self.matrix(key)
+            tmp_path = _matrix_path(self.folder, key).with_suffix(".tmp")
+            new_matrix = _new_matrix(tmp_path, new_size)
+            for row in range(0, old_size, _FILL_ROWS_STEP):
+                last_row = min(row + _FILL_ROWS_STEP, old_size)
+                new_matrix[row:last_row, :old_size] = old_matrix[row:last_row]
+            new_matrix.flush()
+            del new_matrix
+            del old_matrix
+            self.__matrices.pop(key, None)
+            os.replace(tmp_path, _matrix_path(self.folder, key))
+
+        for idx, name in enumerate(new_names, start=old_size):
+            self.__names_idx[name] = idx
+        self.names += new_names
+        self.__save_manifest()
+
+    def get(self, name_1: str, name_2: str, key: str) -> float:
+        return float(self.matrix(key)[self.index_of(name_1), self.index_of(name_2)])
+
+    def is_calculated(self, name_1: str, name_2: str, key: str) -> bool:
+        return not isnan(self.get(name_1, name_2, key))
+
+    def set(self, name_1: str, name_2: str, distances: dict) -> None:
+        """
+        Set the distances ({<key>: distance}) of a pair. The matrices are symmetric.
+        """
+        idx_1 = self.index_of(name_1)
+        idx_2 = self.index_of(name_2)
+        for key, distance in distances.items():
+            matrix = self.matrix(key)
+            matrix[idx_1, idx_2] = distance
+            matrix[idx_2, idx_1] = distance
+
+    def flush(self) -> None:
+        for matrix in self.__matrices.values():
+            if not self.readonly:
+                matrix.flush()
+
+    def to_dataframe(
+        self, keys: list = None, names: list = None, upper_triangle: bool = True
+    ) -> pd.DataFrame:
+        """
+        Export the distances as a "long" DataFrame with one row per pair.
+
+        :param keys: Distance keys to export (all by default).
+        :param names: Restrict the pairs to these images (all by default).
+        :param upper_triangle: Export only one entry per pair (img1 before img2 in the store order, self pairs included).
+
+        :return: DataFrame with the columns img1, img2 and one column per key.
+        """
+        keys = self.keys if keys is None else keys
+        if names is None:
+            idxes = np.arange(len(self.names))
+        else:
+            idxes = np.sort([self.index_of(n) for n in names if n in self])
+
+        if upper_triangle:
+            rows, cols = np.triu_indices(len(idxes))
+        else:
+            rows, cols = np.indices((len(idxes), len(idxes))).reshape(2, -1)
+        rows = idxes[rows]
+        cols = idxes[cols]
+
+        data = {}
+        for key in keys:
+            matrix = self.matrix(key)
+            data[key] = np.concatenate(
+                [
+                    matrix[rows[s : s + 2**20], cols[s : s + 2**20]]
+                    for s in range(0, len(rows), 2**20)
+                ]
+                or [np.empty(0, dtype=_DTYPE)]
+            )
+
+        # Drop pairs without any calculated distance
+        calculated = np.zeros(len(rows), dtype=bool)
+        for values in data.values():
+            calculated |= ~np.isnan(values)
+
+        distances = pd.DataFrame(
+            {
+                "img1": pd.Categorical.from_codes(
+                    rows[calculated], categories=self.names
+                ),
+                "img2": pd.Categorical.from_codes(
+                    cols[calculated], categories=self.names
+                ),
+            }
+        )
+        for key, values in data.items():
+            distances[key] = values[calculated]
+
+        return distances
+
+    def pairs_to_dataframe(
+        self, names_1: list, names_2: list, keys: list = None
+    ) -> pd.DataFrame:
+        """
+        Export the distances of the given pairs (e.g. the top k neighbors of every image, see fr.knn_index)
+        without reading the whole matrices.
+
+        :return: DataFrame with the columns img1, img2 and one column per key.
+        """
+        keys = self.keys if keys is None else keys
+        rows = np.asarray([self.index_of(n) for n in names_1], dtype=np.int64)
+        cols = np.asarray([self.index_of(n) for n in names_2], dtype=np.int64)
+
+        distances = pd.DataFrame({"img1": list(names_1), "img2": list(names_2)})
+        for key in keys:
+            matrix = self.matrix(key)
+            distances[key] = np.concatenate(
+                [
+                    matrix[rows[s : s + 2**20], cols[s : s + 2**20]]
+                    for s in range(0, len(rows), 2**20)
+                ]
+                or [np.empty(0, dtype=_DTYPE)]
+            )
+
+        return distances
+
+    @classmethod
+    def from_json(
+        cls, json_path: Path, folder: Path, scalar_key: str = None
+    ) -> "DistancesStore":
+        """
+        Import a legacy JSON distances file ({"<name_1> x <name_2>": {<key>: distance}}).
+        Files with scalar values ({"<name_1> x <name_2>": distance}) are imported under the "scalar_key".
+        """
+        logging.info(f"Importing JSON distances from {json_path} into {folder}")
+        raw_data = json.load(open(json_path, "r"))
+
+        names = {}
+        keys = {}
+        for pair, distances in raw_data.items():
+            name_1, name_2 = pair.split(" x ")
+            names[name_1] = None
+            names[name_2] = None
+            if isinstance(distances, dict):
+                keys.update(dict.fromkeys(distances.keys()))
+            else:
+                keys[scalar_key] = None
+
+        store = cls(folder=folder, names=list(names.keys()), keys=list(keys.keys()))
+        for pair, distances in raw_data.items():
+            name_1, name_2 = pair.split(" x ")
+            if not isinstance(distances, dict):
+                distances = {scalar_key: distances}
+            store.set(name_1, name_2, distances)
+
+        store.flush()
+        return store
+
+
+def get_distances_store(
+    file_path: Path, scalar_key: str = None, readonly: bool = False
+) -> DistancesStore:
+    """
+    Open the distances store related to a (legacy) distances JSON file path
+    (e.g. "fr/distances_dlib.json" -> "fr/distances_dlib/"). If only the JSON file
+    exists, it is imported once into the store.
+    """
+    file_path = Path(file_path)
+    folder = file_path.with_suffix("")
+    if not _manifest_path(folder).exists() and file_path.exists():
+        DistancesStore.from_json(file_path, folder, scalar_key=scalar_key)
+
+    return DistancesStore(folder=folder, readonly=readonly)
+
+
+def load_distances_df(
+    file_path: Path, keys: list = None, scalar_key: str = None
+) -> pd.DataFrame:
+    """
+    Load the distances of a store as a DataFrame (img1, img2, <keys>) without parsing text files.
+    """
+    return get_distances_store(
+        file_path, scalar_key=scalar_key, readonly=True
+    ).to_dataframe(keys=keys)
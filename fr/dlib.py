@@ -1,10 +1,13 @@
+from collections import OrderedDict
 from fr.ifr import IFr
 from pathlib import Path
 import numpy as np
 
 import face_recognition
 
+from dataset import read_image_file
 from fr.face_decomposition import (
+    decompose_face,
     get_ears,
     get_eyebrows,
     get_eyes,
@@ -24,6 +27,18 @@ from fr.face_decomposition import (
     get_rigth_eyebrow,
     get_upper_lip,
 )
+from fr.distances_engine import weighted_l1_distances
+from fr.features_cache import (
+    DLIB_FACEPARTS_FEATURES_CACHE,
+    DLIB_FEATURES_CACHE,
+    get_features_cache,
+    img_content_hash,
+    img_file_hash,
+)
+
+DLIB_FEATURES_SIZE = 128
+DLIB_ENCODINGS_MEMORY_SIZE = 2**16  # Encodings kept in memory by DlibFr (least recently used are dropped)
+DLIB_ALIGNED_FEATURES_KEY = "dlib_aligned"  # Features of the full image box (see DlibFr aligned mode)
 
 __DLIB_DISTANCE_FACE_WEIGHT = 1.0
 __DLIB_DISTANCE_EYES_WEIGHT = 1.0
@@ -74,18 +89,193 @@ __calc_dlib_funcs = {
 }
 
 
+__dlib_distance_weights = np.array(
+    [
+        __DLIB_DISTANCE_FACE_WEIGHT,
+        __DLIB_DISTANCE_EYES_WEIGHT,
+        __DLIB_DISTANCE_EYEBROWS_WEIGHT,
+        __DLIB_DISTANCE_EARS_WEIGHT,
+        __DLIB_DISTANCE_NOSE_WEIGHT,
+        __DLIB_DISTANCE_MOUTH_WEIGHT,
+    ]
+)
+
+
+def get_dlib_distance_weights() -> np.ndarray:
+    """
+    Weights of the face, eyes, eyebrows, ears, nose and mouth parts for the DLIB_OPT_ALL distance.
+    """
+    return __dlib_distance_weights.copy()
+
+
+def set_dlib_distance_weights(weights) -> None:
+    """
+    Change (at runtime) the weights of the face, eyes, eyebrows, ears, nose and mouth parts for the DLIB_OPT_ALL distance.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape != __dlib_distance_weights.shape or (weights < 0).any():
+        raise ValueError(
+            f"Invalid DLIB distance weights {weights} (6 not negative weights expected)"
+        )
+    __dlib_distance_weights[:] = weights
+
+
+def calc_dlib_facepart_features(face_parts: dict, opt: int):
+    if opt == DLIB_OPT_ALL:
+        face = get_face(face_parts)
+        eyes = get_eyes(face_parts)
+        eyebrows = get_eyebrows(face_parts)
+        ears = get_ears(face_parts)
+        nose = get_nose(face_parts)
+        mouth = get_mouth(face_parts)
+
+        if any(
+            [
+                face is None,
+                eyes is None,
+                eyebrows is None,
+                ears is None,
+                nose is None,
+                mouth is None,
+            ]
+        ):
+            return None
+
+        face_dlib = face_recognition.face_encodings(face)[0]
+        eyes_dlib = face_recognition.face_encodings(eyes)[0]
+        eyebrows_dlib = face_recognition.face_encodings(eyebrows)[0]
+        ears_dlib = face_recognition.face_encodings(ears)[0]
+        nose_dlib = face_recognition.face_encodings(nose)[0]
+        mouth_dlib = face_recognition.face_encodings(mouth)[0]
+
+        seg_dlibs = np.vstack(
+            (face_dlib, eyes_dlib, eyebrows_dlib, ears_dlib, nose_dlib, mouth_dlib)
+        )
+
+        return seg_dlibs
+    else:
+        # Use the function to get the face parts according to the option
+        face_elements = __calc_dlib_funcs[opt](face_parts)
+        if face_elements is None:
+            return None
+        else:
+            face_elements_dlib = face_recognition.face_encodings(face_elements)[0]
+            return face_elements_dlib
+
+
 class DlibFr(IFr):
     """
     Face recognition algorithm that uses DLIB's HOG + Linear SVM method
     """
 
-    def gen_features(self, img_path: Path):
+    caches_features = True  # DLIB features cache
+
+    def __init__(
+        self,
+        aligned: bool = False,
+        encodings_memory_size: int = DLIB_ENCODINGS_MEMORY_SIZE,
+    ):
+        """
+        :param aligned: The images are aligned faces, the face detection is skipped and the whole image is
+        encoded. The features are cached apart from the ones of the detected faces (DLIB_ALIGNED_FEATURES_KEY).
+        :param encodings_memory_size: Encodings kept in memory.
+        """
+        self.aligned = aligned
+        # In memory encodings by image content hash (empty for the images without a face)
+        self.__encodings = OrderedDict()
+        self.__encodings_memory_size = encodings_memory_size
+
+    def __remember_encoding(self, img_hash: str, encoding: np.ndarray) -> None:
+        self.__encodings[img_hash] = encoding
+        if len(self.__encodings) > self.__encodings_memory_size:
+            self.__encodings.popitem(last=False)
+
+    def gen_encoding(self, img_path: Path, face_location: tuple = None) -> tuple:
+        """
+        Encode the face of an image. The face is only detected when its location is not known
+        (in aligned mode, the face box is the whole image).
+
+        :param face_location: Face box (top, right, bottom, left).
+
+        :return: (features, face location). None and None if there is no face.
+        """
         try:
-            tmp_img = face_recognition.load_image_file(img_path)
-            return face_recognition.face_encodings(tmp_img)[0]
+            tmp_img = np.asarray(read_image_file(img_path).convert("RGB"))
+            if face_location is None and self.aligned:
+                face_location = (0, tmp_img.shape[1], tmp_img.shape[0], 0)
+            elif face_location is None:
+                face_location = face_recognition.face_locations(tmp_img)[0]
+            features = face_recognition.face_encodings(
+                tmp_img, known_face_locations=[face_location]
+            )[0]
+            return features, face_location
         except IndexError:
             print(f"Error reading features from {img_path}")
-            return np.zeros(128)
+            return None, None
+
+    def gen_features(self, img_path: Path, use_cache: bool = True):
+        """
+        Generate the image features, reading from/writing to the DLIB features cache
+        (keyed by the image name and invalidated when the image content changes).
+        """
+        return self.gen_features_batch([img_path], use_cache=use_cache)[0]
+
+    def gen_features_batch(
+        self,
+        imgs_paths: list,
+        face_locations: list = None,
+        use_cache: bool = True,
+        return_valid: bool = False,
+    ):
+        """
+        Generate the features of a batch of aligned images, reading from/writing to the DLIB features cache,
+        so each image is encoded once. The faces are only detected for the images without a known location
+        (and never in aligned mode).
+
+        :param face_locations: Face box (top, right, bottom, left) or None of each image.
+        :param return_valid: Also return the mask of the images with a face (the features of the images without
+        a face are cached as missing).
+
+        :return: Float32 matrix (<number of images>, DLIB_FEATURES_SIZE), zeros for the images without a face.
+        """
+        features = np.zeros((len(imgs_paths), DLIB_FEATURES_SIZE), dtype=np.float32)
+        valid = np.ones(len(imgs_paths), dtype=bool)
+        cache = get_features_cache(DLIB_FEATURES_CACHE)
+        features_key = DLIB_ALIGNED_FEATURES_KEY if self.aligned else DLIB_FEATURES_CACHE
+
+        for idx, img_path in enumerate(imgs_paths):
+            face_location = None if face_locations is None else face_locations[idx]
+            if not use_cache:
+                encoding = self.gen_encoding(img_path, face_location)[0]
+                if encoding is None:
+                    valid[idx] = False
+                else:
+                    features[idx] = encoding
+                continue
+
+            img_hash = img_file_hash(img_path)
+            encoding = self.__encodings.get(img_hash, None)
+            if encoding is not None:
+                self.__encodings.move_to_end(img_hash)
+            else:
+                img_name = Path(img_path).stem
+                cached = cache.get(img_name, content_hash=img_hash) or {}
+                if features_key in cached:
+                    encoding = cached[features_key]
+                else:
+                    encoding = self.gen_encoding(img_path, face_location)[0]
+                    cache.put(img_name, {features_key: encoding}, content_hash=img_hash)
+                # Zeros are the missing encodings cached before they were cached as missing
+                if encoding is None or not np.any(encoding):
+                    encoding = np.empty(0, dtype=np.float32)
+                self.__remember_encoding(img_hash, np.asarray(encoding, dtype=np.float32))
+
+            if encoding.size == 0:
+                valid[idx] = False
+                continue
+            features[idx] = encoding
+
+        return (features, valid) if return_valid else features
 
     def calc_distance(self, img_path_1: Path, img_path_2: Path):
         features_1 = self.gen_features(img_path_1)
@@ -100,7 +290,7 @@ class DlibFr(IFr):
 
     def calc_distances(self, ref_img_path: Path, imgs_to_compare: Path):
         ref_features = self.gen_features(ref_img_path)
-        features_batch = [self.gen_features(i) for i in imgs_to_compare]
+        features_batch = self.gen_features_batch(imgs_to_compare)
 
         results = face_recognition.face_distance(features_batch, ref_features)
         return results
@@ -116,61 +306,64 @@ class DlibFr(IFr):
         )
         return results[0]
 
-    def gen_facepart_features(self, face_parts: dict, opt: int):
-        if opt == DLIB_OPT_ALL:
-            face = get_face(face_parts)
-            eyes = get_eyes(face_parts)
-            eyebrows = get_eyebrows(face_parts)
-            ears = get_ears(face_parts)
-            nose = get_nose(face_parts)
-            mouth = get_mouth(face_parts)
-
-            if any(
-                [
-                    face is None,
-                    eyes is None,
-                    eyebrows is None,
-                    ears is None,
-                    nose is None,
-                    mouth is None,
-                ]
-            ):
-                return None
-
-            face_dlib = face_recognition.face_encodings(face)[0]
-            eyes_dlib = face_recognition.face_encodings(eyes)[0]
-            eyebrows_dlib = face_recognition.face_encodings(eyebrows)[0]
-            ears_dlib = face_recognition.face_encodings(ears)[0]
-            nose_dlib = face_recognition.face_encodings(nose)[0]
-            mouth_dlib = face_recognition.face_encodings(mouth)[0]
-
-            seg_dlibs = np.vstack(
-                (face_dlib, eyes_dlib, eyebrows_dlib, ears_dlib, nose_dlib, mouth_dlib)
-            )
-
-            return seg_dlibs
-        else:
-            # Use the function to get the face parts according to the option
-            face_elements = __calc_dlib_funcs[opt](face_parts)
-            if face_elements is None:
-                return None
-            else:
-                face_elements_dlib = face_recognition.face_encodings(face_elements)[0]
-                return face_elements_dlib
+    def gen_facepart_features(self, face_parts: dict, opt: int, img_name: str = None):
+        """
+        Generate the DLIB features of a face parts option. When "img_name" is given,
+        the features are read from/written to the DLIB faceparts features cache.
+        """
+        if img_name is None:
+            return calc_dlib_facepart_features(face_parts, opt)
+
+        cache = get_features_cache(DLIB_FACEPARTS_FEATURES_CACHE)
+        img_hash = img_content_hash(img_name)
+        cached = cache.get(img_name, content_hash=img_hash)
+        if cached is not None and str(opt) in cached:
+            return cached[str(opt)]
+
+        features = calc_dlib_facepart_features(face_parts, opt)
+        cache.put(img_name, {str(opt): features}, content_hash=img_hash)
+        return features
+
+    def gen_img_facepart_features(
+        self, img_name: str, opts: list, use_cache: bool = True
+    ) -> dict:
+        """
+        Generate (or recover from the DLIB faceparts features cache) the features of several options of an image.
+        The face is only decomposed when some option is not cached.
+
+        :return: Dict with the features of each option ({<opt>: features or None}).
+        """
+        if not use_cache:
+            face_parts = decompose_face(img_name)
+            return {opt: calc_dlib_facepart_features(face_parts, opt) for opt in opts}
+
+        cache = get_features_cache(DLIB_FACEPARTS_FEATURES_CACHE)
+        img_hash = img_content_hash(img_name)
+        cached = cache.get(img_name, content_hash=img_hash) or {}
+
+        face_parts = None
+        features = {}
+        new_features = {}
+        for opt in opts:
+            if str(opt) in cached:
+                features[opt] = cached[str(opt)]
+                continue
+            if face_parts is None:
+                face_parts = decompose_face(img_name)
+            features[opt] = calc_dlib_facepart_features(face_parts, opt)
+            new_features[str(opt)] = features[opt]
+
+        if new_features:
+            cache.put(img_name, new_features, content_hash=img_hash)
+
+        return features
 
     def gen_faceparts_distance(self, dlib_1: np.array, dlib_2: np.array, opt: int):
-        hog_abs_delta = np.abs(dlib_1 - dlib_2)
         if opt == DLIB_OPT_ALL:
-            acc_weighted_delta = 0.0
-            acc_weighted_delta += __DLIB_DISTANCE_FACE_WEIGHT * hog_abs_delta[0].sum()
-            acc_weighted_delta += __DLIB_DISTANCE_EYES_WEIGHT * hog_abs_delta[1].sum()
-            acc_weighted_delta += (
-                __DLIB_DISTANCE_EYEBROWS_WEIGHT * hog_abs_delta[2].sum()
-            )
-            acc_weighted_delta += __DLIB_DISTANCE_EARS_WEIGHT * hog_abs_delta[3].sum()
-            acc_weighted_delta += __DLIB_DISTANCE_NOSE_WEIGHT * hog_abs_delta[4].sum()
-            acc_weighted_delta += __DLIB_DISTANCE_MOUTH_WEIGHT * hog_abs_delta[5].sum()
-
-            return acc_weighted_delta
+            return weighted_l1_distances(
+                np.asarray(dlib_1)[np.newaxis],
+                np.asarray(dlib_2)[np.newaxis],
+                get_dlib_distance_weights(),
+            )[0, 0]
         else:
-            return hog_abs_delta.sum()
+            return np.abs(dlib_1 - dlib_2).sum()
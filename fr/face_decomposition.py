@@ -1,13 +1,23 @@
+from collections.abc import Mapping
+from functools import lru_cache
 from turtle import right
 
 import numpy as np
 from matplotlib import use
 from PIL import Image
 
-from dataset import DATASET_KIND_ALIGNED, DATASET_KIND_SEG_MAP, get_file_path
+from dataset import (
+    DATASET_KIND_ALIGNED,
+    DATASET_KIND_SEG_MAP,
+    find_image,
+    image_version,
+    read_aligned,
+    read_seg_map,
+)
 
 __DEFAULT_WIDTH = 512
 __DEFAULT_HEIGHT = 512
+__FACE_PARTS_CACHE_SIZE = 32
 __BACKGROUND_CLASS = 0
 __FACE_CLASS = 1
 __LEFT_EYE_BROW_CLASS = 2
@@ -23,26 +33,164 @@ __NECK_CLASS = 14
 __SHOULDER_CLASS = 16
 __HAIR_CLASS = 17
 
+__EYES_CLASSES = [__LEFT_EYE_CLASS, __RIGHT_EYE_CLASS]
+__EYEBROWS_CLASSES = [__LEFT_EYE_BROW_CLASS, __RIGHT_EYE_BROW_CLASS]
+__EARS_CLASSES = [__LEFT_EAR_CLASS, __RIGHT_EAR_CLASS]
+__MOUTH_CLASSES = [__UPPER_LIP_CLASS, __LOWER_LIP_CLASS]
+__MOUTH_AND_NOSE_CLASSES = [__UPPER_LIP_CLASS, __LOWER_LIP_CLASS, __NOSE_CLASS]
+__EYES_AND_EYEBROWS_CLASSES = [
+    __LEFT_EYE_CLASS,
+    __RIGHT_EYE_CLASS,
+    __LEFT_EYE_BROW_CLASS,
+    __RIGHT_EYE_BROW_CLASS,
+]
+__EYES_AND_NOSE_CLASSES = [__LEFT_EYE_CLASS, __RIGHT_EYE_CLASS, __NOSE_CLASS]
+__FULL_FACE_CLASSES = [
+    __FACE_CLASS,
+    __LEFT_EYE_CLASS,
+    __RIGHT_EYE_CLASS,
+    __LEFT_EYE_BROW_CLASS,
+    __RIGHT_EYE_BROW_CLASS,
+    __NOSE_CLASS,
+    __UPPER_LIP_CLASS,
+    __LOWER_LIP_CLASS,
+]
+
 __DEFAULT_HOG_WIDTH = 64
 __DEFAULT_HOG_HEIGHT = 128
 
 
-def decompose_face(img_name: str) -> dict:
-    seg_map = np.load(get_file_path(img_name, DATASET_KIND_SEG_MAP, ".npy"))
-    original_img = Image.open(get_file_path(img_name, DATASET_KIND_ALIGNED, ".png"))
+class FaceParts(Mapping):
+    """
+    Face decomposition computed in a single pass over the segmentation map (one stable argsort + bincount).
+    For every class only its bounding box and the masked crop of the image are kept. It works as a drop-in
+    for the legacy {<class>: <full size image>} dicts, the full size images are built on demand.
+
+    Composite regions (e.g. eyes and nose) and their cropped ROIs are built lazily from the class crops and
+    cached, so every descriptor can ask for any face parts option without recomputing it. The cached arrays
+    are shared and must not be modified.
+    """
+
+    def __init__(self, img_array: np.ndarray, seg_map: np.ndarray):
+        self.shape = img_array.shape
+        self.__crops = {}
+        self.__bboxes = {}
+        self.__regions = {}
+        self.__rois = {}
+
+        labels = np.asarray(seg_map).ravel()
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels)
+        ends = np.cumsum(counts)
+        width = seg_map.shape[1]
+
+        for seg_class in np.flatnonzero(counts):
+            idxes = order[ends[seg_class] - counts[seg_class] : ends[seg_class]]
+            rows = idxes // width  # Sorted, the argsort is stable
+            cols = idxes % width
+            y_min, y_max = rows[0], rows[-1]
+            x_min, x_max = cols.min(), cols.max()
+
+            crop = np.zeros(
+                (y_max - y_min + 1, x_max - x_min + 1) + self.shape[2:],
+                dtype=img_array.dtype,
+            )
+            crop[rows - y_min, cols - x_min] = img_array[rows, cols]
+
+            self.__crops[int(seg_class)] = crop
+            self.__bboxes[int(seg_class)] = (int(y_min), int(y_max), int(x_min), int(x_max))
+
+    def __getitem__(self, seg_class) -> np.ndarray:
+        crop = self.__crops[seg_class]
+        y_min, _, x_min, _ = self.__bboxes[seg_class]
+        face_seg = np.zeros(self.shape, dtype=crop.dtype)
+        face_seg[y_min : y_min + crop.shape[0], x_min : x_min + crop.shape[1]] = crop
+        return face_seg
+
+    def __iter__(self):
+        return iter(self.__crops)
+
+    def __len__(self):
+        return len(self.__crops)
+
+    def class_bbox(self, seg_class) -> tuple:
+        """
+        Bounding box (y_min, y_max, x_min, x_max) of the class pixels, limits included.
+        """
+        return self.__bboxes[seg_class]
+
+    def region(self, seg_classes: list) -> np.ndarray:
+        """
+        Image with the pixels of the given classes, limited to the union of their bounding boxes
+        (the same as adding the full size images and cropping the blank borders).
+        """
+        key = tuple(seg_classes)
+        mixed = self.__regions.get(key, None)
+        if mixed is not None:
+            return mixed
+
+        bboxes = [self.__bboxes[c] for c in seg_classes]
+        y_min = min(b[0] for b in bboxes)
+        y_max = max(b[1] for b in bboxes)
+        x_min = min(b[2] for b in bboxes)
+        x_max = max(b[3] for b in bboxes)
+
+        mixed = np.zeros(
+            (y_max - y_min + 1, x_max - x_min + 1) + self.shape[2:],
+            dtype=self.__crops[seg_classes[0]].dtype,
+        )
+        for seg_class, bbox in zip(seg_classes, bboxes):
+            crop = self.__crops[seg_class]
+            mixed[
+                bbox[0] - y_min : bbox[0] - y_min + crop.shape[0],
+                bbox[2] - x_min : bbox[2] - x_min + crop.shape[1],
+            ] += crop
+
+        self.__regions[key] = mixed
+        return mixed
+
+    def roi(self, seg_classes: list, use_hog_proportion: bool = False) -> np.ndarray:
+        """
+        Cropped ROI (see crop_roi) of the region of the given classes.
+        """
+        key = (tuple(seg_classes), use_hog_proportion)
+        roi = self.__rois.get(key, None)
+        if roi is None:
+            roi = crop_roi(
+                img_array=self.region(seg_classes),
+                use_hog_proportion=use_hog_proportion,
+            )
+            self.__rois[key] = roi
+        return roi
+
+
+def __read_face(img_name: str) -> tuple:
+    # Packed images are read from the dataset shards
+    seg_map = read_seg_map(*find_image(img_name, DATASET_KIND_SEG_MAP), img_name)
+    original_img = read_aligned(*find_image(img_name, DATASET_KIND_ALIGNED), img_name)
     original_img = original_img.resize(
         (__DEFAULT_WIDTH, __DEFAULT_HEIGHT), Image.LANCZOS
     )
-    original_img_array = np.array(original_img)
+    return np.array(original_img), seg_map
 
-    face_parts = {}
-    for seg_class in np.unique(seg_map):
-        tmp_face_seg = np.zeros(original_img_array.shape).astype(np.uint8)
-        tmp_idxes = np.where(seg_map == seg_class)
-        tmp_face_seg[tmp_idxes] = original_img_array[tmp_idxes]
-        face_parts[seg_class] = tmp_face_seg
 
-    return face_parts
+@lru_cache(maxsize=__FACE_PARTS_CACHE_SIZE)
+def __decompose_face_cached(img_name: str, files_mtimes: tuple) -> FaceParts:
+    original_img_array, seg_map = __read_face(img_name)
+    return FaceParts(original_img_array, seg_map)
+
+
+def decompose_face(img_name: str) -> FaceParts:
+    """
+    Decompose the face of an image into its parts. The decomposition (and the regions built from it) is
+    memoized for the last images, so the descriptors asking for the same image share it. It is recalculated
+    if the aligned image or the segmentation map change.
+    """
+    files_mtimes = (
+        image_version(img_name, DATASET_KIND_ALIGNED),
+        image_version(img_name, DATASET_KIND_SEG_MAP),
+    )
+    return __decompose_face_cached(img_name, files_mtimes)
 
 
 def decompose_face_no_blank(
@@ -56,23 +204,14 @@ def decompose_face_no_blank(
 
     :return: A dictionary with the face parts, where the key is the class of the part and the value is the image of the part.
     """
-    seg_map = np.load(get_file_path(img_name, DATASET_KIND_SEG_MAP, ".npy"))
-    original_img = Image.open(get_file_path(img_name, DATASET_KIND_ALIGNED, ".png"))
-    original_img = original_img.resize(
-        (__DEFAULT_WIDTH, __DEFAULT_HEIGHT), Image.LANCZOS
-    )
-    original_img_array = np.array(original_img)
+    original_img_array, seg_map = __read_face(img_name)
+    decomposition = FaceParts(original_img_array, seg_map)
 
     face_parts = {}
-    for seg_class in np.unique(seg_map):
+    for seg_class in decomposition:
         try:
-            tmp_idxes = np.where(seg_map == seg_class)
-
             # Get ROI crop limits
-            y_min = tmp_idxes[0].min()
-            y_max = tmp_idxes[0].max()
-            x_min = tmp_idxes[1].min()
-            x_max = tmp_idxes[1].max()
+            y_min, y_max, x_min, x_max = decomposition.class_bbox(seg_class)
 
             # Get ROI size
             roi_width = x_max - x_min
@@ -150,12 +289,38 @@ def crop_roi(img_array: np.ndarray, use_hog_proportion) -> np.ndarray:
     return cropped_img
 
 
+def __mixed_region(face_parts: dict, seg_classes: list) -> np.ndarray:
+    """
+    Image with the pixels of the given classes. For FaceParts it is already limited to the
+    bounding box of the classes, so crop_roi does not scan the full size image.
+    """
+    if isinstance(face_parts, FaceParts):
+        return face_parts.region(seg_classes)
+
+    mixed = face_parts[seg_classes[0]].copy()
+    for seg_class in seg_classes[1:]:
+        mixed += face_parts[seg_class]
+    return mixed
+
+
+def __region_roi(
+    face_parts: dict, seg_classes: list, use_hog_proportion: bool
+) -> np.ndarray:
+    if isinstance(face_parts, FaceParts):
+        return face_parts.roi(seg_classes, use_hog_proportion=use_hog_proportion)
+
+    return crop_roi(
+        img_array=__mixed_region(face_parts, seg_classes),
+        use_hog_proportion=use_hog_proportion,
+    )
+
+
 def get_face(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        face = face_parts[__FACE_CLASS]
         if no_blank:
-            return face
-        return crop_roi(img_array=face, use_hog_proportion=use_hog_proportion)
+            return face_parts[__FACE_CLASS]
+
+        return __region_roi(face_parts, [__FACE_CLASS], use_hog_proportion)
     except Exception:
         return None
 
@@ -164,38 +329,28 @@ def get_left_eye(
     face_parts: dict, use_hog_proportion=False, target_shape=(128, 128), no_blank=False
 ):
     try:
-        left_eye = face_parts[__LEFT_EYE_CLASS]
-
         if no_blank:
-            return left_eye
-        else:
-            return crop_roi(img_array=left_eye, use_hog_proportion=use_hog_proportion)
+            return face_parts[__LEFT_EYE_CLASS]
+
+        return __region_roi(face_parts, [__LEFT_EYE_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_right_eye(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        right_eye = face_parts[__RIGHT_EYE_CLASS]
-
         if no_blank:
-            return right_eye
+            return face_parts[__RIGHT_EYE_CLASS]
 
-        return crop_roi(img_array=right_eye, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__RIGHT_EYE_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_eyes(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-
         if not no_blank:
-            left_eye = face_parts[__LEFT_EYE_CLASS]
-            right_eye = face_parts[__RIGHT_EYE_CLASS]
-
-            mixed = left_eye + right_eye
-
-            return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+            return __region_roi(face_parts, __EYES_CLASSES, use_hog_proportion)
         else:
             # TODO
             # tmp_img = Image.fromarray(mixed)
@@ -208,219 +363,160 @@ def get_eyes(face_parts: dict, use_hog_proportion=False, no_blank=False):
 
 def get_left_eyebrow(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_eyebrow = face_parts[__LEFT_EYE_BROW_CLASS]
-
         if no_blank:
-            return left_eyebrow
+            return face_parts[__LEFT_EYE_BROW_CLASS]
 
-        return crop_roi(img_array=left_eyebrow, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__LEFT_EYE_BROW_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_rigth_eyebrow(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        right_eyebrow = face_parts[__RIGHT_EYE_BROW_CLASS]
-
         if no_blank:
-            return right_eyebrow
+            return face_parts[__RIGHT_EYE_BROW_CLASS]
 
-        return crop_roi(img_array=right_eyebrow, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__RIGHT_EYE_BROW_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_eyebrows(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_eyebrow = face_parts[__LEFT_EYE_BROW_CLASS]
-        right_eyebrow = face_parts[__RIGHT_EYE_BROW_CLASS]
-
-        mixed = left_eyebrow + right_eyebrow
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __EYEBROWS_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=left_eyebrow.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__LEFT_EYE_BROW_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __EYEBROWS_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_left_ear(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_ear = face_parts[__LEFT_EAR_CLASS]
-
         if no_blank:
-            return left_ear
+            return face_parts[__LEFT_EAR_CLASS]
 
-        return crop_roi(img_array=left_ear, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__LEFT_EAR_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_right_ear(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        right_ear = face_parts[__RIGHT_EAR_CLASS]
-
         if no_blank:
-            return right_ear
+            return face_parts[__RIGHT_EAR_CLASS]
 
-        return crop_roi(img_array=right_ear, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__RIGHT_EAR_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_ears(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_ear = face_parts[__LEFT_EAR_CLASS]
-        right_ear = face_parts[__RIGHT_EAR_CLASS]
-
-        mixed = left_ear + right_ear
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __EARS_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=left_ear.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__LEFT_EAR_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __EARS_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_nose(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        nose = face_parts[__NOSE_CLASS]
-
         if no_blank:
-            return nose
+            return face_parts[__NOSE_CLASS]
 
-        return crop_roi(img_array=nose, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__NOSE_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_lower_lip(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        lower_lip = face_parts[__LOWER_LIP_CLASS]
-
         if no_blank:
-            return lower_lip
+            return face_parts[__LOWER_LIP_CLASS]
 
-        return crop_roi(img_array=lower_lip, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__LOWER_LIP_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_upper_lip(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        upper_lip = face_parts[__UPPER_LIP_CLASS]
-
         if no_blank:
-            return upper_lip
+            return face_parts[__UPPER_LIP_CLASS]
 
-        return crop_roi(img_array=upper_lip, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, [__UPPER_LIP_CLASS], use_hog_proportion)
     except Exception:
         return None
 
 
 def get_mouth(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        upper_lip = face_parts[__UPPER_LIP_CLASS]
-        lower_lip = face_parts[__LOWER_LIP_CLASS]
-
-        mixed = upper_lip + lower_lip
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __MOUTH_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=upper_lip.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__UPPER_LIP_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __MOUTH_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_mouth_and_nose(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        upper_lip = face_parts[__UPPER_LIP_CLASS]
-        lower_lip = face_parts[__LOWER_LIP_CLASS]
-        nose = face_parts[__NOSE_CLASS]
-
-        mixed = upper_lip + lower_lip + nose
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __MOUTH_AND_NOSE_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=upper_lip.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__UPPER_LIP_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __MOUTH_AND_NOSE_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_eyes_and_eyebrows(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_eye = face_parts[__LEFT_EYE_CLASS]
-        right_eye = face_parts[__RIGHT_EYE_CLASS]
-        left_eyebrow = face_parts[__LEFT_EYE_BROW_CLASS]
-        right_eyebrow = face_parts[__RIGHT_EYE_BROW_CLASS]
-
-        mixed = left_eye + right_eye + left_eyebrow + right_eyebrow
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __EYES_AND_EYEBROWS_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=left_eye.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__LEFT_EYE_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __EYES_AND_EYEBROWS_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_eyes_and_nose(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        left_eye = face_parts[__LEFT_EYE_CLASS]
-        right_eye = face_parts[__RIGHT_EYE_CLASS]
-        nose = face_parts[__NOSE_CLASS]
-
-        mixed = left_eye + right_eye + nose
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __EYES_AND_NOSE_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=left_eye.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__LEFT_EYE_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __EYES_AND_NOSE_CLASSES, use_hog_proportion)
     except Exception:
         return None
 
 
 def get_full_face(face_parts: dict, use_hog_proportion=False, no_blank=False):
     try:
-        face = face_parts[__FACE_CLASS]
-        left_eye = face_parts[__LEFT_EYE_CLASS]
-        right_eye = face_parts[__RIGHT_EYE_CLASS]
-        left_eyebrow = face_parts[__LEFT_EYE_BROW_CLASS]
-        right_eyebrow = face_parts[__RIGHT_EYE_BROW_CLASS]
-        nose = face_parts[__NOSE_CLASS]
-        upper_lip = face_parts[__UPPER_LIP_CLASS]
-        lower_lip = face_parts[__LOWER_LIP_CLASS]
-
-        mixed = face
-        mixed += left_eye
-        mixed += right_eye
-        mixed += left_eyebrow
-        mixed += right_eyebrow
-        mixed += nose
-        mixed += upper_lip
-        mixed += lower_lip
-
         if no_blank:
+            mixed = __mixed_region(face_parts, __FULL_FACE_CLASSES)
             tmp_img = Image.fromarray(mixed)
-            tmp_img = tmp_img.resize(size=face.shape[:2])
+            tmp_img = tmp_img.resize(size=face_parts[__FACE_CLASS].shape[:2])
             return np.array(tmp_img)
 
-        return crop_roi(img_array=mixed, use_hog_proportion=use_hog_proportion)
+        return __region_roi(face_parts, __FULL_FACE_CLASSES, use_hog_proportion)
     except Exception:
         return None
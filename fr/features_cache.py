@@ -0,0 +1,538 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from dataset import (
+    DATASET_KIND_ALIGNED,
+    DATASET_KIND_SEG_MAP,
+    find_file_path,
+    find_packed_image,
+    get_shards_reader,
+    image_version,
+    load_seg_map,
+    read_seg_map,
+    sample_key,
+    split_file_path,
+)
+
+FEATURES_CACHE_ROOT = Path("fr", "features")
+
+DLIB_FEATURES_CACHE = "dlib"
+DLIB_FACEPARTS_FEATURES_CACHE = "dlib_faceparts"
+HOG_FEATURES_CACHE = "hog"
+RESNET_FEATURES_CACHE = "resnet"
+RESNET_FACEPARTS_FEATURES_CACHE = "resnet_faceparts"
+RESNET_FACEPARTS_NB_FEATURES_CACHE = "resnet_faceparts_nb"
+
+FEATURES_STORAGE_FLOAT32 = "float32"
+FEATURES_STORAGE_FLOAT16 = "float16"
+FEATURES_STORAGE_INT8 = "int8"  # Symmetric int8 quantization with a float32 scale by features vector
+FEATURES_STORAGES = [
+    FEATURES_STORAGE_FLOAT32,
+    FEATURES_STORAGE_FLOAT16,
+    FEATURES_STORAGE_INT8,
+]
+
+_INDEX_FILE = "index.jsonl"
+_SHARD_PREFIX = "shard_"
+_SHARD_EXTENSION = ".npz"
+_DEFAULT_SHARD_SIZE = 1000
+_MAX_OPEN_SHARDS = 16  # Shards kept open by a cache (least recently used are closed)
+_DTYPE = np.float32
+_SCALE_SUFFIX = ".scale"
+
+
+@lru_cache(maxsize=2**16)
+def _hash_files(files_stats: tuple) -> str:
+    img_hash = hashlib.blake2b(digest_size=16)
+    for file_path, _, _ in files_stats:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                img_hash.update(chunk)
+    return img_hash.hexdigest()
+
+
+def _seg_map_digest(seg_map: np.ndarray) -> str:
+    seg_map_hash = hashlib.blake2b(digest_size=16)
+    seg_map_hash.update(str(seg_map.shape).encode())
+    seg_map_hash.update(np.ascontiguousarray(seg_map).tobytes())
+    return seg_map_hash.hexdigest()
+
+
+@lru_cache(maxsize=2**16)
+def _hash_seg_map(file_stats: tuple) -> str:
+    return _seg_map_digest(load_seg_map(file_stats[0]))
+
+
+# The hashes of the packed images are memoized by image and version (see image_version).
+# They are the same as the hashes of the loose files.
+@lru_cache(maxsize=2**16)
+def _hash_packed_img(dataset: str, person_name: str, img_name: str, _: tuple) -> str:
+    data = get_shards_reader(dataset, DATASET_KIND_ALIGNED).read(
+        sample_key(person_name, img_name)
+    )
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=2**16)
+def _hash_packed_seg_map(dataset: str, person_name: str, img_name: str, _: tuple) -> str:
+    return _seg_map_digest(read_seg_map(dataset, person_name, img_name))
+
+
+def _file_stats(file_path) -> tuple:
+    stat = os.stat(file_path)
+    return str(file_path), stat.st_mtime_ns, stat.st_size
+
+
+def content_hash(*files_paths) -> str:
+    """
+    Hash of the content of the files. The hash is memoized by path, size and modification time,
+    so the files are read again only when they change.
+    """
+    return _hash_files(tuple(_file_stats(p) for p in files_paths))
+
+
+def img_content_hash(img_name: str, with_seg_map: bool = True) -> str:
+    """
+    Hash of the aligned image (and its segmentation map) used to invalidate the cached features.
+    The segmentation map is hashed decoded, so migrating it to another storage format keeps the hash.
+    """
+    packed_img = find_packed_image(img_name, DATASET_KIND_ALIGNED)
+    if packed_img is not None:
+        img_hash = _hash_packed_img(
+            *packed_img, img_name, image_version(img_name, DATASET_KIND_ALIGNED)
+        )
+    else:
+        img_hash = content_hash(find_file_path(img_name, DATASET_KIND_ALIGNED))
+    if not with_seg_map:
+        return img_hash
+
+    packed_seg_map = find_packed_image(img_name, DATASET_KIND_SEG_MAP)
+    if packed_seg_map is not None:
+        seg_map_hash = _hash_packed_seg_map(
+            *packed_seg_map, img_name, image_version(img_name, DATASET_KIND_SEG_MAP)
+        )
+    else:
+        seg_map_hash = _hash_seg_map(
+            _file_stats(find_file_path(img_name, DATASET_KIND_SEG_MAP))
+        )
+    return hashlib.blake2b(
+        (img_hash + seg_map_hash).encode(), digest_size=16
+    ).hexdigest()
+
+
+def img_file_hash(file_path: Path) -> str:
+    """
+    Content hash of an image file. The aligned images of the datasets are hashed by name with img_content_hash
+    (without segmentation map), so packed images are hashed from the shards. The hash is the same in both cases.
+    """
+    location = split_file_path(file_path)
+    if location is not None and location[1] == DATASET_KIND_ALIGNED:
+        return img_content_hash(location[3], with_seg_map=False)
+    return content_hash(file_path)
+
+
+def encode_features(features: np.ndarray, storage: str = FEATURES_STORAGE_FLOAT32) -> dict:
+    """
+    Encode a features vector for storage.
+
+    :return: Dict with the stored arrays ({"": data} plus {".scale": scale} for int8).
+    """
+    features = np.asarray(features, dtype=_DTYPE)
+    if storage == FEATURES_STORAGE_FLOAT32 or not features.size:
+        return {"": features}
+    if storage == FEATURES_STORAGE_FLOAT16:
+        return {"": features.astype(np.float16)}
+    if storage == FEATURES_STORAGE_INT8:
+        max_abs = np.abs(features).max() if features.size else 0.0
+        scale = np.asarray(max_abs / 127.0 if max_abs > 0 else 1.0, dtype=_DTYPE)
+        quantized = np.clip(np.rint(features / scale), -127, 127).astype(np.int8)
+        return {"": quantized, _SCALE_SUFFIX: scale}
+    raise ValueError(f"Invalid features storage: {storage}")
+
+
+def decode_features(arrays: dict) -> np.ndarray:
+    """
+    Decode the stored arrays of a features vector (see encode_features) as float32.
+    """
+    features = arrays[""].astype(_DTYPE)
+    if _SCALE_SUFFIX in arrays:
+        features *= arrays[_SCALE_SUFFIX]
+    return features
+
+
+def reduce_features_precision(
+    features: np.ndarray, storage: str = FEATURES_STORAGE_FLOAT32
+) -> np.ndarray:
+    """
+    Features as they are recovered after being stored with the given storage.
+    """
+    return decode_features(encode_features(features, storage=storage))
+
+
+class FeaturesCache:
+    """
+    Binary cache of per image features. Each entry is a dict of float32 arrays
+    ({<features key>: array}) stored in .npz shards. An append-only JSON lines index
+    maps the image names to their shard and content hash: the lines of an image with the same
+    content hash are merged (the latest keys win), a line with another content hash replaces them.
+    Only the new keys of an entry are written, and the cache is compacted (see compact) when most of
+    the stored entries are no longer used.
+    Missing features (e.g. a face part not found) are stored as empty arrays and returned as None.
+    Optionally, the features are stored as float16 or int8 (see encode_features) and decoded as float32.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        shard_size: int = _DEFAULT_SHARD_SIZE,
+        storage: str = FEATURES_STORAGE_FLOAT32,
+    ):
+        if storage not in FEATURES_STORAGES:
+            raise ValueError(f"Invalid features storage: {storage}")
+        self.folder = Path(folder)
+        self.shard_size = shard_size
+        self.storage = storage
+        self.__index = {}  # {<img name>: {"hash": <content hash>, "parts": [<index line>]}}
+        self.__pending = {}
+        self.__shards = OrderedDict()
+        self.__next_shard = 0
+        self.__live_parts = 0
+        self.__dead_parts = 0
+
+        index_path = self.folder.joinpath(_INDEX_FILE)
+        if index_path.exists():
+            with open(index_path, "rb+") as f:
+                valid_end = 0
+                for line in iter(f.readline, b""):
+                    if not line.endswith(b"\n"):
+                        break  # Partially written line (interrupted run)
+                    valid_end = f.tell()
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.__add_part(entry)
+                    self.__next_shard = max(self.__next_shard, entry["shard"] + 1)
+
+                # New entries are appended after the last complete line
+                f.truncate(valid_end)
+
+    def __len__(self):
+        return len(self.names())
+
+    def __contains__(self, img_name: str) -> bool:
+        return img_name in self.__pending or img_name in self.__index
+
+    def names(self) -> list:
+        return list(dict.fromkeys(list(self.__index.keys()) + list(self.__pending.keys())))
+
+    def __shard_path(self, shard: int) -> Path:
+        return self.folder.joinpath(f"{_SHARD_PREFIX}{shard:06d}{_SHARD_EXTENSION}")
+
+    def __shard(self, shard: int):
+        tmp_shard = self.__shards.get(shard, None)
+        if tmp_shard is None:
+            tmp_shard = np.load(self.__shard_path(shard))
+            self.__shards[shard] = tmp_shard
+            if len(self.__shards) > _MAX_OPEN_SHARDS:
+                self.__shards.popitem(last=False)[1].close()
+        else:
+            self.__shards.move_to_end(shard)
+        return tmp_shard
+
+    def __add_part(self, entry: dict) -> None:
+        """
+        Add an index line to the entry of its image, dropping the parts whose keys are all overwritten.
+        """
+        indexed = self.__index.get(entry["name"], None)
+        if indexed is None or indexed["hash"] != entry["hash"]:
+            if indexed is not None:
+                self.__live_parts -= len(indexed["parts"])
+                self.__dead_parts += len(indexed["parts"])
+            indexed = {"hash": entry["hash"], "parts": []}
+            self.__index[entry["name"]] = indexed
+
+        keys = set(entry["keys"])
+        parts = [p for p in indexed["parts"] if not set(p["keys"]) <= keys]
+        self.__live_parts += len(parts) + 1 - len(indexed["parts"])
+        self.__dead_parts += len(indexed["parts"]) - len(parts)
+        indexed["parts"] = parts + [entry]
+
+    def __read_part(self, entry: dict, raw: bool = False) -> dict:
+        """
+        Features of an index line. With "raw", the stored arrays ({<array name>: array}) without decoding.
+        """
+        shard = self.__shard(entry["shard"])
+        features = {}
+        for key in entry["keys"]:
+            tmp_key = f"{entry['entry']}/{key}"
+            tmp_features = shard[tmp_key]
+            tmp_arrays = {"": tmp_features}
+            if tmp_key + _SCALE_SUFFIX in shard:
+                tmp_arrays[_SCALE_SUFFIX] = shard[tmp_key + _SCALE_SUFFIX]
+
+            if raw:
+                features[key] = tmp_arrays
+            elif not tmp_features.size:
+                features[key] = None
+            elif tmp_features.dtype == _DTYPE:
+                features[key] = tmp_features
+            else:
+                features[key] = decode_features(tmp_arrays)
+        return features
+
+    def __entry_hash(self, img_name: str) -> tuple:
+        """
+        (True, content hash) of the current entry of an image, (False, None) if there is no entry.
+        """
+        pending = self.__pending.get(img_name, None)
+        if pending is not None:
+            return True, pending["hash"]
+        indexed = self.__index.get(img_name, None)
+        if indexed is not None:
+            return True, indexed["hash"]
+        return False, None
+
+    def get(self, img_name: str, content_hash: str = None) -> dict:
+        """
+        Recover the cached features of an image.
+
+        :param content_hash: When provided, entries calculated from a different content are ignored.
+
+        :return: Dict with the features ({<features key>: array or None}) or None if there is no valid entry.
+        """
+        found, entry_hash = self.__entry_hash(img_name)
+        if not found:
+            return None
+        if content_hash is not None and entry_hash != content_hash:
+            return None
+
+        features = {}
+        indexed = self.__index.get(img_name, None)
+        if indexed is not None and indexed["hash"] == entry_hash:
+            for entry in indexed["parts"]:
+                features.update(self.__read_part(entry))
+
+        pending = self.__pending.get(img_name, None)
+        if pending is not None:
+            features.update(
+                {k: (v if v.size else None) for k, v in pending["features"].items()}
+            )
+        return features
+
+    def put(self, img_name: str, features: dict, content_hash: str = None) -> None:
+        """
+        Save the features ({<features key>: array or None}) of an image. The new keys are merged with
+        the already cached ones when the content hash is the same (or not provided).
+        """
+        found, entry_hash = self.__entry_hash(img_name)
+        if content_hash is None and found:
+            content_hash = entry_hash
+
+        features = {
+            k: (
+                reduce_features_precision(v, self.storage)
+                if v is not None
+                else np.empty(0, dtype=_DTYPE)
+            )
+            for k, v in features.items()
+        }
+        pending = self.__pending.get(img_name, None)
+        if pending is not None and pending["hash"] == content_hash:
+            pending["features"].update(features)
+        else:
+            self.__pending[img_name] = {"hash": content_hash, "features": features}
+
+        if len(self.__pending) >= self.shard_size:
+            self.flush()
+
+    def __write_shard(self, shard: int, arrays: dict) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        shard_path = self.__shard_path(shard)
+        tmp_path = shard_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, shard_path)
+
+    def flush(self) -> None:
+        """
+        Write the pending entries into a new shard (atomically) and append them to the index.
+        The cache is compacted when most of its stored entries are no longer used.
+        """
+        self.__flush_pending()
+        if self.__dead_parts > max(self.__live_parts, self.shard_size):
+            self.compact()
+
+    def __flush_pending(self) -> None:
+        if not self.__pending:
+            return
+
+        shard = self.__next_shard
+        arrays = {}
+        entries = []
+        for entry_idx, (img_name, pending) in enumerate(self.__pending.items()):
+            for key, value in pending["features"].items():
+                for suffix, array in encode_features(value, self.storage).items():
+                    arrays[f"{entry_idx}/{key}{suffix}"] = array
+            entries.append(
+                {
+                    "name": img_name,
+                    "hash": pending["hash"],
+                    "shard": shard,
+                    "entry": entry_idx,
+                    "keys": list(pending["features"].keys()),
+                }
+            )
+        self.__write_shard(shard, arrays)
+
+        with open(self.folder.joinpath(_INDEX_FILE), "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+        for entry in entries:
+            self.__add_part(entry)
+        self.__next_shard += 1
+        self.__pending = {}
+        logging.info(f"{len(entries)} features saved at {self.__shard_path(shard)}")
+
+    def compact(self) -> None:
+        """
+        Rewrite the used entries (one by image, with all its keys) into new shards and a new index,
+        and remove the old shards. The stored arrays are copied as they are (without decoding them).
+        """
+        self.__flush_pending()
+        old_shards = range(self.__next_shard)
+
+        shard = self.__next_shard
+        arrays = {}
+        entries = []
+        for img_name, indexed in self.__index.items():
+            stored = {}
+            for entry in indexed["parts"]:
+                stored.update(self.__read_part(entry, raw=True))
+
+            entry_idx = len(entries) % self.shard_size
+            for key, tmp_arrays in stored.items():
+                for suffix, array in tmp_arrays.items():
+                    arrays[f"{entry_idx}/{key}{suffix}"] = array
+            entries.append(
+                {
+                    "name": img_name,
+                    "hash": indexed["hash"],
+                    "shard": shard,
+                    "entry": entry_idx,
+                    "keys": list(stored.keys()),
+                }
+            )
+            if entry_idx == self.shard_size - 1:
+                self.__write_shard(shard, arrays)
+                shard += 1
+                arrays = {}
+        if arrays:
+            self.__write_shard(shard, arrays)
+            shard += 1
+
+        index_path = self.folder.joinpath(_INDEX_FILE)
+        tmp_index_path = index_path.with_suffix(".tmp")
+        with open(tmp_index_path, "w") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_index_path, index_path)
+
+        self.close()
+        for old_shard in old_shards:
+            self.__shard_path(old_shard).unlink(missing_ok=True)
+
+        self.__index = {}
+        self.__live_parts = 0
+        self.__dead_parts = 0
+        for entry in entries:
+            self.__add_part(entry)
+        self.__next_shard = shard
+        logging.info(f"{len(entries)} features compacted at {self.folder}")
+
+    def close(self) -> None:
+        """
+        Close the open shards (they are opened again when needed).
+        """
+        for tmp_shard in self.__shards.values():
+            tmp_shard.close()
+        self.__shards = OrderedDict()
+
+    def import_json(
+        self, json_path: Path, key: str = None, keys_map: dict = None, hash_func=None
+    ) -> None:
+        """
+        Import a legacy JSON features file ({<img name>: {<key>: features or False}} or {<img name>: features}).
+
+        :param key: Features key for files with a single features list by image.
+        :param keys_map: Map from the JSON keys to the cache keys (JSON keys are kept by default).
+        :param hash_func: Function to calculate the content hash of an image from its name.
+        """
+        keys_map = {} if keys_map is None else keys_map
+        for img_name, features in json.load(open(json_path, "r")).items():
+            if not isinstance(features, dict):
+                features = {key: features}
+            features = {
+                keys_map.get(k, k): (None if v is False or v is None else v)
+                for k, v in features.items()
+            }
+            try:
+                tmp_hash = hash_func(img_name) if hash_func is not None else None
+            except FileNotFoundError:
+                continue
+            self.put(img_name, features, content_hash=tmp_hash)
+        self.flush()
+
+
+__features_caches = {}
+
+
+def get_features_cache(name: str, storage: str = None) -> FeaturesCache:
+    """
+    Get the (process wide) features cache of a descriptor, e.g. get_features_cache(HOG_FEATURES_CACHE).
+
+    :param storage: Storage of the new features (float32 by default). The stored features are always
+    decoded with the storage they were written with.
+    """
+    cache = __features_caches.get(name, None)
+    if cache is None:
+        cache = FeaturesCache(FEATURES_CACHE_ROOT.joinpath(name))
+        __features_caches[name] = cache
+    if storage is not None:
+        if storage not in FEATURES_STORAGES:
+            raise ValueError(f"Invalid features storage: {storage}")
+        cache.storage = storage
+    return cache
+
+
+def import_legacy_json(
+    name: str, json_path: Path, key: str = None, keys_map: dict = None, hash_func=None
+) -> FeaturesCache:
+    """
+    Import once a legacy JSON features file (e.g. "fr/hog_data.json") into an empty features cache.
+    The current images are assumed to be the ones the JSON features were calculated from.
+    """
+    cache = get_features_cache(name)
+    if len(cache) == 0 and Path(json_path).exists():
+        logging.info(f"Importing JSON features from {json_path} into {cache.folder}")
+        cache.import_json(json_path, key=key, keys_map=keys_map, hash_func=hash_func)
+    return cache
+
+
+def flush_features_caches() -> None:
+    for cache in __features_caches.values():
+        cache.flush()
+
+
+atexit.register(flush_features_caches)
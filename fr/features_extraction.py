@@ -0,0 +1,171 @@
+import logging
+import os
+import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from time import time
+
+from dataset import DATASET_KIND_ALIGNED, find_file_path
+from fr.dlib import DLIB_ALIGNED_FEATURES_KEY, DlibFr
+from fr.features_cache import (
+    DLIB_FACEPARTS_FEATURES_CACHE,
+    DLIB_FEATURES_CACHE,
+    HOG_FEATURES_CACHE,
+    get_features_cache,
+    img_content_hash,
+)
+from fr.hog_descriptor import calc_img_hogs
+
+EXTRACTOR_DLIB = "dlib"
+EXTRACTOR_DLIB_ALIGNED = "dlib_aligned"  # DLIB features of the whole aligned images (see DlibFr aligned mode)
+EXTRACTOR_DLIB_FACEPARTS = "dlib_faceparts"
+EXTRACTOR_HOG = "hog"
+
+DEFAULT_CHUNKSIZE = 8
+DEFAULT_LOG_STEP = 1000
+
+
+def dlib_img_hash(img_name: str) -> str:
+    """
+    Content hash of the DLIB features of an aligned image (the same as DlibFr, see img_file_hash).
+    """
+    return img_content_hash(img_name, with_seg_map=False)
+
+
+def __extract_dlib(task: tuple, aligned: bool) -> tuple:
+    img_name, img_hash, _ = task
+    try:
+        features = DlibFr(aligned=aligned).gen_encoding(
+            find_file_path(img_name, DATASET_KIND_ALIGNED)
+        )[0]
+    except Exception:
+        logging.error(f"Error extracting DLIB features for {img_name}")
+        logging.error(traceback.format_exc())
+        return img_name, img_hash, None
+
+    features_key = DLIB_ALIGNED_FEATURES_KEY if aligned else DLIB_FEATURES_CACHE
+    return img_name, img_hash, {features_key: features}
+
+
+def _extract_dlib(task: tuple) -> tuple:
+    return __extract_dlib(task, aligned=False)
+
+
+def _extract_dlib_aligned(task: tuple) -> tuple:
+    return __extract_dlib(task, aligned=True)
+
+
+def _extract_dlib_faceparts(task: tuple) -> tuple:
+    img_name, img_hash, opts = task
+    try:
+        features = DlibFr().gen_img_facepart_features(img_name, opts, use_cache=False)
+    except Exception:
+        logging.error(f"Error extracting DLIB Faceparts features for {img_name}")
+        logging.error(traceback.format_exc())
+        return img_name, img_hash, None
+
+    return img_name, img_hash, {str(opt): f for opt, f in features.items()}
+
+
+def _extract_hog(task: tuple) -> tuple:
+    img_name, img_hash, opts = task
+    try:
+        hogs = calc_img_hogs(img_name, opts, use_cache=False)
+    except Exception:
+        logging.error(f"Error extracting HOG features for {img_name}")
+        logging.error(traceback.format_exc())
+        return img_name, img_hash, None
+
+    return img_name, img_hash, {str(opt): f for opt, f in hogs.items()}
+
+
+# Extractor -> (features cache, worker function, content hash function)
+__EXTRACTORS = {
+    EXTRACTOR_DLIB: (DLIB_FEATURES_CACHE, _extract_dlib, dlib_img_hash),
+    EXTRACTOR_DLIB_ALIGNED: (DLIB_FEATURES_CACHE, _extract_dlib_aligned, dlib_img_hash),
+    EXTRACTOR_DLIB_FACEPARTS: (
+        DLIB_FACEPARTS_FEATURES_CACHE,
+        _extract_dlib_faceparts,
+        img_content_hash,
+    ),
+    EXTRACTOR_HOG: (HOG_FEATURES_CACHE, _extract_hog, img_content_hash),
+}
+
+
+def extract_features(
+    imgs_names: list,
+    extractor: str,
+    opts: list = None,
+    workers: int = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    log_step: int = DEFAULT_LOG_STEP,
+    threads: bool = False,
+) -> int:
+    """
+    Extract the features of the images that are not (validly) cached yet, fanning the work out over a process pool.
+    The workers only calculate the features, the results are streamed into the features cache by this process.
+
+    :param extractor: EXTRACTOR_DLIB, EXTRACTOR_DLIB_ALIGNED, EXTRACTOR_DLIB_FACEPARTS or EXTRACTOR_HOG.
+    :param opts: Face parts options to extract (faceparts extractors only).
+    :param workers: Number of processes (all CPUs by default). With 1 worker the extraction runs in this process.
+    :param chunksize: Number of images sent to a worker at once.
+    :param threads: Use a thread pool instead of a process pool (for the extractors that release the GIL, e.g. HOG).
+
+    :return: Number of images whose features were extracted.
+    """
+    cache_name, extract_func, hash_func = __EXTRACTORS[extractor]
+    cache = get_features_cache(cache_name)
+    if extractor == EXTRACTOR_DLIB:
+        keys = [DLIB_FEATURES_CACHE]
+    elif extractor == EXTRACTOR_DLIB_ALIGNED:
+        keys = [DLIB_ALIGNED_FEATURES_KEY]
+    else:
+        keys = [str(o) for o in opts]
+    workers = os.cpu_count() if workers is None else workers
+
+    # Only the images without valid cached features are extracted
+    tasks = []
+    for img_name in dict.fromkeys(imgs_names):
+        try:
+            img_hash = hash_func(img_name)
+        except FileNotFoundError:
+            logging.error(f"Files not found for {img_name}, features not extracted")
+            continue
+
+        cached = cache.get(img_name, content_hash=img_hash)
+        if cached is None or any(k not in cached for k in keys):
+            tasks.append((img_name, img_hash, opts))
+
+    if not tasks:
+        return 0
+
+    logging.info(
+        f"Extracting {extractor} features for {len(tasks)} images ({workers} {'threads' if threads else 'workers'})"
+    )
+    start_time = time()
+    extracted = 0
+
+    def store_results(results):
+        nonlocal extracted
+        for count, (img_name, img_hash, features) in enumerate(results, start=1):
+            if features is not None:
+                cache.put(img_name, features, content_hash=img_hash)
+                extracted += 1
+            if count % log_step == 0:
+                logging.info(
+                    f"{extractor} features extraction update. {count}/{len(tasks)} | Total time: {int(time() - start_time)} s"
+                )
+
+    if workers > 1:
+        pool_class = ThreadPool if threads else Pool
+        with pool_class(processes=workers) as pool:
+            store_results(pool.imap_unordered(extract_func, tasks, chunksize=chunksize))
+    else:
+        store_results(map(extract_func, tasks))
+
+    cache.flush()
+    logging.info(
+        f"{extractor} features extraction done. {extracted}/{len(tasks)} | Total time: {int(time() - start_time)} s"
+    )
+
+    return extracted
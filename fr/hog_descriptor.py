@@ -1,8 +1,15 @@
+import logging
+import os
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from cv2 import HOGDescriptor
 from PIL import Image, ImageOps
 
 from fr.face_decomposition import (
+    decompose_face,
     get_ears,
     get_eyebrows,
     get_eyes,
@@ -22,8 +29,11 @@ from fr.face_decomposition import (
     get_rigth_eyebrow,
     get_upper_lip,
 )
+from fr.distances_engine import weighted_l1_distances
+from fr.features_cache import HOG_FEATURES_CACHE, get_features_cache, img_content_hash
 
 __HOG_DEFAULT_SIZE = (64, 128)
+HOG_FEATURES_SIZE = 3780  # Default HOGDescriptor features for a 64x128 window
 __HOG_DISTANCE_FACE_WEIGHT = 1.0
 __HOG_DISTANCE_EYES_WEIGHT = 1.0
 __HOG_DISTANCE_EYEBROWS_WEIGHT = 1.0
@@ -72,6 +82,52 @@ __calc_hog_funcs = {
     HOG_OPT_FULL_FACE: get_full_face,
 }
 
+# Rows of the HOG matrix of an image (see calc_hog_matrix)
+HOG_PARTS_OPTS = list(__calc_hog_funcs.keys())
+__HOG_ROWS = {opt: row for row, opt in enumerate(HOG_PARTS_OPTS)}
+# Rows stacked (in this order) for HOG_OPT_ALL
+__HOG_ALL_OPTS = [
+    HOG_OPT_FACE,
+    HOG_OPT_EYES,
+    HOG_OPT_EYEBROWS,
+    HOG_OPT_EARS,
+    HOG_OPT_NOSE,
+    HOG_OPT_MOUTH,
+]
+
+__hog_local = threading.local()
+
+
+__hog_distance_weights = np.array(
+    [
+        __HOG_DISTANCE_FACE_WEIGHT,
+        __HOG_DISTANCE_EYES_WEIGHT,
+        __HOG_DISTANCE_EYEBROWS_WEIGHT,
+        __HOG_DISTANCE_EARS_WEIGHT,
+        __HOG_DISTANCE_NOSE_WEIGHT,
+        __HOG_DISTANCE_MOUTH_WEIGHT,
+    ]
+)
+
+
+def get_hog_distance_weights() -> np.ndarray:
+    """
+    Weights of the face, eyes, eyebrows, ears, nose and mouth parts for the HOG_OPT_ALL distance.
+    """
+    return __hog_distance_weights.copy()
+
+
+def set_hog_distance_weights(weights) -> None:
+    """
+    Change (at runtime) the weights of the face, eyes, eyebrows, ears, nose and mouth parts for the HOG_OPT_ALL distance.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape != __hog_distance_weights.shape or (weights < 0).any():
+        raise ValueError(
+            f"Invalid HOG distance weights {weights} (6 not negative weights expected)"
+        )
+    __hog_distance_weights[:] = weights
+
 
 def adjust_img_to_hog(img_array: np.array):
     return np.asarray(
@@ -81,72 +137,191 @@ def adjust_img_to_hog(img_array: np.array):
     )
 
 
-def calc_hog(face_parts: dict, opt: int):
+def adjust_imgs_to_hog(imgs: list) -> np.ndarray:
+    """
+    Adjust a batch of images (of any size) to the HOG size and to grayscale.
 
-    if opt == HOG_OPT_ALL:
-        face = get_face(face_parts, use_hog_proportion=True)
-        eyes = get_eyes(face_parts, use_hog_proportion=True)
-        eyebrows = get_eyebrows(face_parts, use_hog_proportion=True)
-        ears = get_ears(face_parts, use_hog_proportion=True)
-        nose = get_nose(face_parts, use_hog_proportion=True)
-        mouth = get_mouth(face_parts, use_hog_proportion=True)
-
-        if any(
-            [
-                face is None,
-                eyes is None,
-                eyebrows is None,
-                ears is None,
-                nose is None,
-                mouth is None,
-            ]
-        ):
-            return None
-
-        # Adjust images to HOG size and to grayscale
-        face = adjust_img_to_hog(face)
-        eyes = adjust_img_to_hog(eyes)
-        eyebrows = adjust_img_to_hog(eyebrows)
-        ears = adjust_img_to_hog(ears)
-        nose = adjust_img_to_hog(nose)
-        mouth = adjust_img_to_hog(mouth)
+    :return: uint8 array (<number of images>, <HOG height>, <HOG width>).
+    """
+    batch = np.empty(
+        (len(imgs), __HOG_DEFAULT_SIZE[1], __HOG_DEFAULT_SIZE[0]), dtype=np.uint8
+    )
+    for idx, img in enumerate(imgs):
+        batch[idx] = adjust_img_to_hog(img)
+    return batch
 
+
+def __get_hog_descriptor() -> HOGDescriptor:
+    # One descriptor by thread (creating it on every call is expensive)
+    hog = getattr(__hog_local, "hog", None)
+    if hog is None:
         hog = HOGDescriptor()
-        face_hog = hog.compute(face)
-        eyes_hog = hog.compute(eyes)
-        eyebrows_hog = hog.compute(eyebrows)
-        ears_hog = hog.compute(ears)
-        nose_hog = hog.compute(nose)
-        mouth_hog = hog.compute(mouth)
-
-        seg_hogs = np.vstack(
-            (face_hog, eyes_hog, eyebrows_hog, ears_hog, nose_hog, mouth_hog)
-        )
+        __hog_local.hog = hog
+    return hog
 
-        return seg_hogs
-    else:
-        # Use the function to get the face parts according to the option
-        face_elements = __calc_hog_funcs[opt](face_parts, use_hog_proportion=True)
-        if face_elements is None:
-            return None
+
+def calc_hog_matrix(face_parts: dict, opts: list = None) -> tuple:
+    """
+    Calculate the HOG features of the face parts options of a face at once. Each region is
+    resized and described only once, HOG_OPT_ALL is made of the rows of its face parts.
+
+    :param opts: Options to calculate (all by default). The rows of the other options are left invalid.
+
+    :return: (features, valid). Float32 matrix (len(HOG_PARTS_OPTS), HOG_FEATURES_SIZE) with a row by
+    face parts option (zeros for the missing parts) and bool mask of the valid rows.
+    """
+    opts = HOG_PARTS_OPTS if opts is None else opts
+    rows_opts = []
+    for opt in opts:
+        for tmp_opt in __HOG_ALL_OPTS if opt == HOG_OPT_ALL else [opt]:
+            if tmp_opt not in rows_opts:
+                rows_opts.append(tmp_opt)
+
+    features = np.zeros((len(HOG_PARTS_OPTS), HOG_FEATURES_SIZE), dtype=np.float32)
+    valid = np.zeros(len(HOG_PARTS_OPTS), dtype=bool)
+
+    rows = []
+    regions = []
+    for opt in rows_opts:
+        region = __calc_hog_funcs[opt](face_parts, use_hog_proportion=True)
+        if region is not None:
+            rows.append(__HOG_ROWS[opt])
+            regions.append(region)
+
+    if regions:
+        hog = __get_hog_descriptor()
+        for row, img in zip(rows, adjust_imgs_to_hog(regions)):
+            features[row] = hog.compute(img).ravel()
+        valid[rows] = True
+
+    return features, valid
+
+
+def hog_matrix_to_opts(features: np.ndarray, valid: np.ndarray, opts: list) -> dict:
+    """
+    Split a HOG matrix (see calc_hog_matrix) into the features of each option.
+
+    :return: Dict with the features of each option ({<opt>: features or None}).
+    """
+    hogs = {}
+    for opt in opts:
+        if opt == HOG_OPT_ALL:
+            rows = [__HOG_ROWS[o] for o in __HOG_ALL_OPTS]
+            hogs[opt] = features[rows] if valid[rows].all() else None
         else:
-            face_elements = adjust_img_to_hog(face_elements)
-            hog = HOGDescriptor()
-            face_elements_hog = hog.compute(face_elements)
-            return face_elements_hog
+            row = __HOG_ROWS[opt]
+            hogs[opt] = features[row] if valid[row] else None
+    return hogs
+
+
+def __calc_hog(face_parts: dict, opt: int):
+    features, valid = calc_hog_matrix(face_parts, [opt])
+    return hog_matrix_to_opts(features, valid, [opt])[opt]
+
+
+def __calc_img_hog_matrix(img_name: str) -> tuple:
+    try:
+        return (img_name, *calc_hog_matrix(decompose_face(img_name)))
+    except Exception:
+        logging.error(f"Error calculating the HOG matrix of {img_name}")
+        logging.error(traceback.format_exc())
+        return img_name, None, None
+
+
+def iter_hog_matrices(imgs_names: list, workers: int = None):
+    """
+    Calculate the HOG matrices (see calc_hog_matrix) of a list of images in a thread pool
+    (OpenCV and PIL release the GIL while they work).
+
+    :param workers: Number of threads (all CPUs by default). With 1 worker the images are processed in this thread.
+
+    :return: Generator of (img_name, features, valid), in the images order.
+    Features and valid are None for the images that could not be processed.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1:
+        yield from map(__calc_img_hog_matrix, imgs_names)
+        return
+
+    with ThreadPool(processes=workers) as pool:
+        yield from pool.imap(__calc_img_hog_matrix, imgs_names)
+
+
+def calc_hog_matrices(imgs_names: list, workers: int = None) -> tuple:
+    """
+    Calculate the HOG matrices of a list of images (see iter_hog_matrices).
+
+    :return: (features, valid). Float32 array (<number of images>, len(HOG_PARTS_OPTS), HOG_FEATURES_SIZE)
+    and bool mask (<number of images>, len(HOG_PARTS_OPTS)).
+    """
+    features = np.zeros(
+        (len(imgs_names), len(HOG_PARTS_OPTS), HOG_FEATURES_SIZE), dtype=np.float32
+    )
+    valid = np.zeros((len(imgs_names), len(HOG_PARTS_OPTS)), dtype=bool)
+    for idx, (_, img_features, img_valid) in enumerate(
+        iter_hog_matrices(imgs_names, workers=workers)
+    ):
+        if img_features is not None:
+            features[idx] = img_features
+            valid[idx] = img_valid
+    return features, valid
+
+
+def calc_hog(face_parts: dict, opt: int, img_name: str = None):
+    """
+    Calculate the HOG features of a face parts option. When "img_name" is given,
+    the features are read from/written to the HOG features cache.
+    """
+    if img_name is None:
+        return __calc_hog(face_parts, opt)
+
+    cache = get_features_cache(HOG_FEATURES_CACHE)
+    img_hash = img_content_hash(img_name)
+    cached = cache.get(img_name, content_hash=img_hash)
+    if cached is not None and str(opt) in cached:
+        return cached[str(opt)]
+
+    hog = __calc_hog(face_parts, opt)
+    cache.put(img_name, {str(opt): hog}, content_hash=img_hash)
+    return hog
+
+
+def calc_img_hogs(img_name: str, opts: list, use_cache: bool = True) -> dict:
+    """
+    Calculate (or recover from the HOG features cache) the HOG features of several options of an image.
+    The face is only decomposed when some option is not cached.
+
+    :return: Dict with the features of each option ({<opt>: features or None}).
+    """
+    if not use_cache:
+        features, valid = calc_hog_matrix(decompose_face(img_name), opts)
+        return hog_matrix_to_opts(features, valid, opts)
+
+    cache = get_features_cache(HOG_FEATURES_CACHE)
+    img_hash = img_content_hash(img_name)
+    cached = cache.get(img_name, content_hash=img_hash) or {}
+
+    hogs = {opt: cached[str(opt)] for opt in opts if str(opt) in cached}
+    missing_opts = [opt for opt in opts if str(opt) not in cached]
+    if missing_opts:
+        features, valid = calc_hog_matrix(decompose_face(img_name), missing_opts)
+        new_hogs = hog_matrix_to_opts(features, valid, missing_opts)
+        cache.put(
+            img_name,
+            {str(opt): hog for opt, hog in new_hogs.items()},
+            content_hash=img_hash,
+        )
+        hogs.update(new_hogs)
+
+    return hogs
 
 
 def compare_hogs(hog_1: np.array, hog_2: np.array, opt: int):
-    hog_abs_delta = np.abs(hog_1 - hog_2)
     if opt == HOG_OPT_ALL:
-        acc_weighted_delta = 0.0
-        acc_weighted_delta += __HOG_DISTANCE_FACE_WEIGHT * hog_abs_delta[0].sum()
-        acc_weighted_delta += __HOG_DISTANCE_EYES_WEIGHT * hog_abs_delta[1].sum()
-        acc_weighted_delta += __HOG_DISTANCE_EYEBROWS_WEIGHT * hog_abs_delta[2].sum()
-        acc_weighted_delta += __HOG_DISTANCE_EARS_WEIGHT * hog_abs_delta[3].sum()
-        acc_weighted_delta += __HOG_DISTANCE_NOSE_WEIGHT * hog_abs_delta[4].sum()
-        acc_weighted_delta += __HOG_DISTANCE_MOUTH_WEIGHT * hog_abs_delta[5].sum()
-
-        return acc_weighted_delta
+        return weighted_l1_distances(
+            np.asarray(hog_1)[np.newaxis],
+            np.asarray(hog_2)[np.newaxis],
+            __hog_distance_weights,
+        )[0, 0]
     else:
-        return hog_abs_delta.sum()
+        return np.abs(hog_1 - hog_2).sum()
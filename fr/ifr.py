@@ -3,6 +3,9 @@ from pathlib import Path
 
 
 class IFr(abc.ABC):
+    # The algorithm already caches its features (so it doesn't need to be wrapped by CachedFr)
+    caches_features = False
+
     @abc.abstractmethod
     def gen_features(img_path: Path):
         raise NotImplementedError
@@ -14,3 +17,9 @@ class IFr(abc.ABC):
     @abc.abstractmethod
     def check(img_path_1: Path, img_path_2: Path, distance_tolerance: float) -> bool:
         raise NotImplementedError
+
+    def calc_distance_from_features(self, img1_features, img2_features):
+        """
+        Distance between the features of two images (needed to cache the features, see CachedFr).
+        """
+        raise NotImplementedError
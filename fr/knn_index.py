@@ -0,0 +1,394 @@
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fr.distances_engine import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_MAX_BLOCK_BYTES,
+    METRIC_L2,
+    get_metric,
+    l2_distances,
+)
+
+KNN_INDEX_EXACT = "exact"  # Blocked brute force
+KNN_INDEX_IVF = "ivf"  # Inverted file: k-means lists, only the closest "n_probe" lists are searched
+KNN_INDEXES = [KNN_INDEX_EXACT, KNN_INDEX_IVF]
+
+DEFAULT_TOP_K = 25
+DEFAULT_N_PROBE = 8
+DEFAULT_TRAIN_SIZE = 20000
+DEFAULT_KMEANS_ITERATIONS = 20
+
+_NO_NEIGHBOR = -1
+
+
+def merge_top_k(
+    best_idxes: np.ndarray,
+    best_distances: np.ndarray,
+    idxes: np.ndarray,
+    distances: np.ndarray,
+    k: int,
+) -> tuple:
+    """
+    Merge the current top k of several queries with new candidates (one row per query).
+
+    :return: (idxes, distances) of the new top k, not sorted.
+    """
+    all_idxes = np.concatenate([best_idxes, idxes], axis=1)
+    all_distances = np.concatenate([best_distances, distances], axis=1)
+    if all_distances.shape[1] <= k:
+        return all_idxes, all_distances
+
+    top = np.argpartition(all_distances, k - 1, axis=1)[:, :k]
+    return (
+        np.take_along_axis(all_idxes, top, axis=1),
+        np.take_along_axis(all_distances, top, axis=1),
+    )
+
+
+class KnnIndex:
+    """
+    Exact k nearest neighbors index over stacked features (one row per image), calculated as a blocked brute
+    force: only the top k of every query is kept, so the N x N distances matrix is never built.
+    Invalid images (missing features) are never returned as neighbors.
+    """
+
+    def __init__(
+        self,
+        features: np.ndarray,
+        valid: np.ndarray = None,
+        metric: str = METRIC_L2,
+        weights: np.ndarray = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+    ):
+        self.features = np.asarray(features, dtype=np.float32)
+        self.valid = (
+            np.ones(len(self.features), dtype=bool)
+            if valid is None
+            else np.asarray(valid, dtype=bool)
+        )
+        self.metric = metric
+        self.block_size = block_size
+        self.max_block_bytes = max_block_bytes
+        self._metric_func = get_metric(metric, weights)
+        self._valid_idxes = np.flatnonzero(self.valid)
+
+    def __len__(self):
+        return len(self.features)
+
+    def _distances(self, queries: np.ndarray, idxes: np.ndarray) -> np.ndarray:
+        return self._metric_func(
+            queries, self.features[idxes], max_block_bytes=self.max_block_bytes
+        )
+
+    def _candidates(self, queries: np.ndarray):
+        """
+        Iterate over the (queries rows, candidates idxes) to compare.
+        """
+        all_rows = np.arange(len(queries))
+        for start in range(0, len(self._valid_idxes), self.block_size):
+            yield all_rows, self._valid_idxes[start : start + self.block_size]
+
+    def search(
+        self, queries: np.ndarray, k: int = DEFAULT_TOP_K, query_idxes: np.ndarray = None
+    ) -> tuple:
+        """
+        Search the k nearest neighbors of the queries (stacked features, one row per query).
+
+        :param query_idxes: Index of each query in the index (or -1), to exclude the query itself from its neighbors.
+
+        :return: (idxes, distances) matrices (queries x k), sorted by distance. Missing neighbors are -1 with infinite distance.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        best_idxes = [np.full((0, k), _NO_NEIGHBOR, dtype=np.int64)]
+        best_distances = [np.full((0, k), np.inf, dtype=np.float32)]
+
+        for start in range(0, len(queries), self.block_size):
+            block_queries = queries[start : start + self.block_size]
+            block_idxes = np.full((len(block_queries), 0), _NO_NEIGHBOR, dtype=np.int64)
+            block_distances = np.full((len(block_queries), 0), np.inf, dtype=np.float32)
+
+            for rows, idxes in self._candidates(block_queries):
+                if len(rows) == 0 or len(idxes) == 0:
+                    continue
+                distances = self._distances(block_queries[rows], idxes).astype(
+                    np.float32
+                )
+                candidates = np.broadcast_to(idxes, distances.shape)
+                if query_idxes is not None:
+                    tmp_query_idxes = np.asarray(query_idxes)[start + rows]
+                    distances[candidates == tmp_query_idxes[:, np.newaxis]] = np.inf
+
+                # Pad the rows without candidates, so every row has the same number of entries
+                if len(rows) < len(block_queries):
+                    padded_distances = np.full(
+                        (len(block_queries), distances.shape[1]), np.inf, dtype=np.float32
+                    )
+                    padded_distances[rows] = distances
+                    padded_candidates = np.full(
+                        padded_distances.shape, _NO_NEIGHBOR, dtype=np.int64
+                    )
+                    padded_candidates[rows] = candidates
+                    distances, candidates = padded_distances, padded_candidates
+
+                block_idxes, block_distances = merge_top_k(
+                    block_idxes, block_distances, candidates, distances, k
+                )
+
+            block_idxes, block_distances = self.__sort_top_k(
+                block_idxes, block_distances, k
+            )
+            best_idxes.append(block_idxes)
+            best_distances.append(block_distances)
+
+        return np.concatenate(best_idxes), np.concatenate(best_distances)
+
+    @staticmethod
+    def __sort_top_k(idxes: np.ndarray, distances: np.ndarray, k: int) -> tuple:
+        if idxes.shape[1] < k:
+            idxes = np.pad(
+                idxes, ((0, 0), (0, k - idxes.shape[1])), constant_values=_NO_NEIGHBOR
+            )
+            distances = np.pad(
+                distances, ((0, 0), (0, k - distances.shape[1])), constant_values=np.inf
+            )
+
+        order = np.lexsort((idxes, distances), axis=1)
+        idxes = np.take_along_axis(idxes, order, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
+        idxes[np.isinf(distances)] = _NO_NEIGHBOR
+        return idxes, distances
+
+    def self_neighbors(self, k: int = DEFAULT_TOP_K) -> tuple:
+        """
+        k nearest neighbors of every indexed image (the image itself excluded). Invalid images have no neighbors.
+
+        :return: (idxes, distances) matrices (images x k), see search.
+        """
+        idxes = np.full((len(self), k), _NO_NEIGHBOR, dtype=np.int64)
+        distances = np.full((len(self), k), np.inf, dtype=np.float32)
+        idxes[self._valid_idxes], distances[self._valid_idxes] = self.search(
+            self.features[self._valid_idxes], k=k, query_idxes=self._valid_idxes
+        )
+        return idxes, distances
+
+
+def kmeans(
+    features: np.ndarray,
+    n_clusters: int,
+    n_iter: int = DEFAULT_KMEANS_ITERATIONS,
+    seed: int = 0,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> tuple:
+    """
+    Lloyd's k-means of the rows of a features matrix.
+
+    :return: (centroids, labels)
+    """
+    features = features.reshape(len(features), -1)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(features))
+    centroids = features[rng.choice(len(features), n_clusters, replace=False)].astype(
+        np.float32
+    )
+
+    labels = np.zeros(len(features), dtype=np.int64)
+    for _ in range(n_iter):
+        labels = np.concatenate(
+            [
+                l2_distances(features[s : s + block_size], centroids).argmin(axis=1)
+                for s in range(0, len(features), block_size)
+            ]
+        )
+        sums = np.zeros(centroids.shape, dtype=np.float64)
+        np.add.at(sums, labels, features)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # Empty clusters keep their centroid
+        new_centroids = centroids.copy()
+        new_centroids[counts > 0] = sums[counts > 0] / counts[counts > 0, np.newaxis]
+        if np.allclose(new_centroids, centroids):
+            break
+        centroids = new_centroids
+
+    return centroids, labels
+
+
+class IvfKnnIndex(KnnIndex):
+    """
+    Approximate k nearest neighbors index (inverted file). The valid images are split in "n_lists" k-means
+    lists and every query is only compared with the images of its "n_probe" closest lists.
+    With n_probe == n_lists it is the exact search.
+    """
+
+    def __init__(
+        self,
+        features: np.ndarray,
+        valid: np.ndarray = None,
+        metric: str = METRIC_L2,
+        weights: np.ndarray = None,
+        n_lists: int = None,
+        n_probe: int = DEFAULT_N_PROBE,
+        train_size: int = DEFAULT_TRAIN_SIZE,
+        n_iter: int = DEFAULT_KMEANS_ITERATIONS,
+        seed: int = 0,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_block_bytes: int = DEFAULT_MAX_BLOCK_BYTES,
+    ):
+        super().__init__(
+            features,
+            valid=valid,
+            metric=metric,
+            weights=weights,
+            block_size=block_size,
+            max_block_bytes=max_block_bytes,
+        )
+        valid_features = self.features[self._valid_idxes]
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(valid_features)))
+        n_lists = max(min(n_lists, len(valid_features)), 1)
+        self.n_probe = max(min(n_probe, n_lists), 1)
+
+        if len(valid_features) == 0:
+            self.centroids = np.zeros((0,) + self.features.shape[1:], dtype=np.float32)
+            self.lists = []
+            return
+
+        rng = np.random.default_rng(seed)
+        train_features = valid_features
+        if len(valid_features) > train_size:
+            train_features = valid_features[
+                rng.choice(len(valid_features), train_size, replace=False)
+            ]
+        centroids, _ = kmeans(
+            train_features, n_lists, n_iter=n_iter, seed=seed, block_size=block_size
+        )
+        self.centroids = centroids.reshape((len(centroids),) + self.features.shape[1:])
+
+        labels = self.__closest_lists(valid_features, 1)[:, 0]
+        self.lists = [self._valid_idxes[labels == l] for l in range(len(centroids))]
+        logging.info(
+            f"IVF index of {len(valid_features)} images: {len(self.lists)} lists, probing {self.n_probe}"
+        )
+
+    def __closest_lists(self, queries: np.ndarray, n_probe: int) -> np.ndarray:
+        distances = self._metric_func(
+            queries, self.centroids, max_block_bytes=self.max_block_bytes
+        )
+        if n_probe >= distances.shape[1]:
+            return np.argsort(distances, axis=1)
+        return np.argpartition(distances, n_probe - 1, axis=1)[:, :n_probe]
+
+    def _candidates(self, queries: np.ndarray):
+        if not self.lists:
+            return
+        probes = self.__closest_lists(queries, self.n_probe)
+        for list_idx, idxes in enumerate(self.lists):
+            rows = np.flatnonzero((probes == list_idx).any(axis=1))
+            for start in range(0, len(idxes), self.block_size):
+                yield rows, idxes[start : start + self.block_size]
+
+
+def build_knn_index(
+    features: np.ndarray,
+    valid: np.ndarray = None,
+    method: str = KNN_INDEX_EXACT,
+    metric: str = METRIC_L2,
+    weights: np.ndarray = None,
+    **kwargs,
+) -> KnnIndex:
+    """
+    Build a k nearest neighbors index (KNN_INDEX_EXACT or KNN_INDEX_IVF, see their classes for the options).
+    """
+    if method == KNN_INDEX_EXACT:
+        return KnnIndex(features, valid=valid, metric=metric, weights=weights, **kwargs)
+    if method == KNN_INDEX_IVF:
+        return IvfKnnIndex(
+            features, valid=valid, metric=metric, weights=weights, **kwargs
+        )
+    raise ValueError(f"Invalid k nearest neighbors index: {method}")
+
+
+def neighbors_path(file_path: Path) -> Path:
+    """
+    Neighbors file related to a (legacy) distances JSON file path
+    (e.g. "fr/distances_dlib.json" -> "fr/neighbors_dlib.npz").
+    """
+    file_path = Path(file_path)
+    return file_path.with_name(
+        file_path.stem.replace("distances", "neighbors", 1) + ".npz"
+    )
+
+
+def save_neighbors(
+    file_path: Path, names: list, idxes: np.ndarray, distances: np.ndarray
+) -> None:
+    """
+    Save the top k neighbors lists of a set of images (atomically).
+    """
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = file_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            names=np.asarray(names, dtype=str),
+            idxes=np.asarray(idxes, dtype=np.int64),
+            distances=np.asarray(distances, dtype=np.float32),
+        )
+    os.replace(tmp_path, file_path)
+
+
+def load_neighbors(file_path: Path) -> tuple:
+    """
+    Load the neighbors lists saved with save_neighbors.
+
+    :return: (names, idxes, distances)
+    """
+    with np.load(file_path) as data:
+        return data["names"].tolist(), data["idxes"], data["distances"]
+
+
+def neighbors_to_df(
+    names: list, idxes: np.ndarray, distances: np.ndarray, key: str = "distance"
+) -> pd.DataFrame:
+    """
+    Export the neighbors lists as a "long" DataFrame (img1, img2, <key>), sorted by img1 and distance.
+    """
+    rows, ranks = np.nonzero(idxes != _NO_NEIGHBOR)
+    return pd.DataFrame(
+        {
+            "img1": pd.Categorical.from_codes(rows, categories=names),
+            "img2": pd.Categorical.from_codes(idxes[rows, ranks], categories=names),
+            key: distances[rows, ranks],
+        }
+    )
+
+
+def gen_neighbors(
+    file_path: Path,
+    names: list,
+    features: np.ndarray,
+    valid: np.ndarray = None,
+    k: int = DEFAULT_TOP_K,
+    method: str = KNN_INDEX_EXACT,
+    metric: str = METRIC_L2,
+    weights: np.ndarray = None,
+    **kwargs,
+) -> tuple:
+    """
+    Calculate the top k neighbors lists of every image and save them.
+
+    :return: (idxes, distances), see KnnIndex.self_neighbors.
+    """
+    index = build_knn_index(
+        features, valid=valid, method=method, metric=metric, weights=weights, **kwargs
+    )
+    idxes, distances = index.self_neighbors(k=k)
+    save_neighbors(file_path, names, idxes, distances)
+    logging.info(f"Top {k} neighbors of {len(names)} images saved at {file_path}")
+    return idxes, distances
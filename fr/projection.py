@@ -0,0 +1,319 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from fr.distances_engine import stack_features
+from fr.features_cache import FeaturesCache, content_hash, get_features_cache
+
+PROJECTION_PCA = "pca"
+PROJECTION_RANDOM = "random"  # Gaussian random projection (Johnson-Lindenstrauss)
+PROJECTIONS = [PROJECTION_PCA, PROJECTION_RANDOM]
+
+DEFAULT_N_COMPONENTS = 64
+DEFAULT_SAMPLE_SIZE = 5000
+DEFAULT_ERROR_PAIRS = 100000
+_ERROR_PAIRS_CHUNK = 4096
+
+_PROJECTIONS_FILE = "projections.npz"
+_REPORT_FILE = "projections_report.json"
+_DTYPE = np.float32
+
+
+class FeaturesProjection:
+    """
+    Linear projection of features vectors into a low dimensional space: (features - mean) @ components.
+    """
+
+    def __init__(
+        self,
+        method: str,
+        mean: np.ndarray,
+        components: np.ndarray,
+        explained_variance: float = None,
+    ):
+        self.method = method
+        self.mean = np.asarray(mean, dtype=_DTYPE)
+        self.components = np.asarray(components, dtype=_DTYPE)
+        self.explained_variance = explained_variance
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[1]
+
+    @staticmethod
+    def fit(
+        features: np.ndarray,
+        n_components: int = DEFAULT_N_COMPONENTS,
+        method: str = PROJECTION_PCA,
+        seed: int = 0,
+    ):
+        """
+        Fit a projection on a sample of features vectors (one by row).
+        """
+        features = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+        n_features = features.shape[1]
+        n_components = min(n_components, n_features)
+
+        if method == PROJECTION_PCA:
+            mean = features.mean(axis=0)
+            _, singular_values, vt = np.linalg.svd(
+                features - mean, full_matrices=False
+            )
+            variances = singular_values**2
+            n_components = min(n_components, len(vt))
+            return FeaturesProjection(
+                method,
+                mean,
+                vt[:n_components].T,
+                explained_variance=float(
+                    variances[:n_components].sum() / max(variances.sum(), 1e-12)
+                ),
+            )
+
+        if method == PROJECTION_RANDOM:
+            rng = np.random.default_rng(seed)
+            components = rng.standard_normal((n_features, n_components)) / np.sqrt(
+                n_components
+            )
+            return FeaturesProjection(method, np.zeros(n_features), components)
+
+        raise ValueError(f"Invalid projection method: {method}")
+
+    def project(self, features: np.ndarray) -> np.ndarray:
+        """
+        Project a features vector, or a matrix of features vectors (one by row).
+        """
+        features = np.asarray(features, dtype=_DTYPE)
+        if features.ndim > 1:
+            features = features.reshape(len(features), -1)
+        return (features - self.mean) @ self.components
+
+
+def projection_name(method: str, n_components: int) -> str:
+    """
+    Name of a projection (e.g. "pca64"), used to name its features cache and distances.
+    """
+    return f"{method}{n_components}"
+
+
+def projected_distances_path(file_path: Path, projection: str = None) -> Path:
+    """
+    Distances file path of the projected features (e.g. "fr/distances_resnet_faceparts_pca64.json").
+    Without projection, the path of the full features distances.
+    """
+    file_path = Path(file_path)
+    if projection is None:
+        return file_path
+    return file_path.with_name(f"{file_path.stem}_{projection}{file_path.suffix}")
+
+
+def get_projected_cache(cache_name: str, projection: str) -> FeaturesCache:
+    """
+    Features cache of the projected features, next to the full features one (e.g. "resnet_faceparts_pca64").
+    """
+    return get_features_cache(f"{cache_name}_{projection}")
+
+
+def save_projections(folder: Path, projections: dict) -> None:
+    """
+    Save the projections of several features keys ({<features key>: FeaturesProjection}).
+    """
+    arrays = {}
+    for key, projection in projections.items():
+        arrays[f"{key}/mean"] = projection.mean
+        arrays[f"{key}/components"] = projection.components
+        arrays[f"{key}/method"] = np.array(projection.method)
+        arrays[f"{key}/explained_variance"] = np.array(
+            np.nan
+            if projection.explained_variance is None
+            else projection.explained_variance
+        )
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    tmp_path = folder.joinpath(_PROJECTIONS_FILE + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, folder.joinpath(_PROJECTIONS_FILE))
+
+
+def load_projections(folder: Path) -> dict:
+    """
+    Load the projections saved with save_projections (empty dict if there are none).
+    """
+    file_path = Path(folder, _PROJECTIONS_FILE)
+    if not file_path.exists():
+        return {}
+
+    projections = {}
+    with np.load(file_path) as data:
+        for key in {name.rsplit("/", 1)[0] for name in data.files}:
+            explained_variance = float(data[f"{key}/explained_variance"])
+            projections[key] = FeaturesProjection(
+                str(data[f"{key}/method"]),
+                data[f"{key}/mean"],
+                data[f"{key}/components"],
+                explained_variance=(
+                    None if np.isnan(explained_variance) else explained_variance
+                ),
+            )
+    return projections
+
+
+def projection_error_report(
+    features: np.ndarray,
+    projected_features: np.ndarray,
+    n_pairs: int = DEFAULT_ERROR_PAIRS,
+    seed: int = 0,
+) -> dict:
+    """
+    Compare the MAE distances of random pairs of images in the full and the projected spaces.
+
+    :return: Dict with the Pearson and Kendall correlations between both distances and the mean
+    relative error of the projected distances (after fitting the best scale between both spaces).
+    """
+    from scipy.stats import kendalltau
+
+    rng = np.random.default_rng(seed)
+    idxes_1 = rng.integers(0, len(features), n_pairs)
+    idxes_2 = rng.integers(0, len(features), n_pairs)
+    pairs = idxes_1 != idxes_2
+    idxes_1, idxes_2 = idxes_1[pairs], idxes_2[pairs]
+
+    def pairs_distances(tmp_features):
+        tmp_features = tmp_features.reshape(len(tmp_features), -1)
+        return np.concatenate(
+            [
+                np.abs(
+                    tmp_features[idxes_1[start : start + _ERROR_PAIRS_CHUNK]]
+                    - tmp_features[idxes_2[start : start + _ERROR_PAIRS_CHUNK]]
+                ).mean(axis=1)
+                for start in range(0, len(idxes_1), _ERROR_PAIRS_CHUNK)
+            ]
+        )
+
+    full_distances = pairs_distances(features)
+    projected_distances = pairs_distances(projected_features)
+    scale = (full_distances @ projected_distances) / max(
+        projected_distances @ projected_distances, 1e-12
+    )
+    relative_error = np.abs(scale * projected_distances - full_distances) / np.maximum(
+        full_distances, 1e-12
+    )
+
+    return {
+        "pairs": int(len(full_distances)),
+        "pearson": float(np.corrcoef(full_distances, projected_distances)[0, 1]),
+        "kendall_tau": float(kendalltau(full_distances, projected_distances)[0]),
+        "mean_relative_error": float(relative_error.mean()),
+    }
+
+
+def fit_projections(
+    features_by_key: dict,
+    n_components: int = DEFAULT_N_COMPONENTS,
+    method: str = PROJECTION_PCA,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    seed: int = 0,
+) -> tuple:
+    """
+    Fit a projection for each features key on a sample of its (valid) features and report its error.
+
+    :param features_by_key: Dict with the features matrix of each key ({<features key>: (images x features)}).
+
+    :return: (projections, reports), dicts by features key.
+    """
+    rng = np.random.default_rng(seed)
+    projections = {}
+    reports = {}
+    for key, features in features_by_key.items():
+        sample = features
+        if len(features) > sample_size:
+            sample = features[rng.choice(len(features), sample_size, replace=False)]
+
+        projection = FeaturesProjection.fit(
+            sample, n_components=n_components, method=method, seed=seed
+        )
+        projections[key] = projection
+        reports[key] = projection_error_report(
+            sample, projection.project(sample), seed=seed
+        )
+        reports[key]["explained_variance"] = projection.explained_variance
+        logging.info(
+            f"Projection {projection_name(method, projection.n_components)} of {key}: {reports[key]}"
+        )
+
+    return projections, reports
+
+
+def project_features(
+    features_data: dict,
+    cache_name: str,
+    method: str = PROJECTION_PCA,
+    n_components: int = DEFAULT_N_COMPONENTS,
+    hash_func=None,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    seed: int = 0,
+) -> dict:
+    """
+    Project the features of several images ({<img name>: {<features key>: features or None}}) and store them
+    in the projected features cache, next to the full features cache "cache_name". The projections are fitted
+    (on a sample of the given features) the first time and saved with the projected features, along with
+    their error report (see projection_error_report).
+
+    :param hash_func: Function to calculate the content hash of an image from its name.
+
+    :return: Dict with the projected features of each image ({<img name>: {<features key>: features or None}}).
+    """
+    name = projection_name(method, n_components)
+    cache = get_projected_cache(cache_name, name)
+    projections = load_projections(cache.folder)
+    if not projections:
+        keys = list(dict.fromkeys(k for f in features_data.values() for k in f.keys()))
+        features_by_key = {}
+        for key in keys:
+            features, valid = stack_features(
+                [features_data[img_name].get(key, None) for img_name in features_data]
+            )
+            features_by_key[key] = features[valid]
+        projections, reports = fit_projections(
+            features_by_key,
+            n_components=n_components,
+            method=method,
+            sample_size=sample_size,
+            seed=seed,
+        )
+        save_projections(cache.folder, projections)
+        json.dump(reports, open(cache.folder.joinpath(_REPORT_FILE), "w"), indent=2)
+
+    # The projected features are bound to the projections they were calculated with
+    projections_hash = content_hash(cache.folder.joinpath(_PROJECTIONS_FILE))
+
+    projected_data = {}
+    for img_name, features in features_data.items():
+        img_hash = hash_func(img_name) if hash_func is not None else ""
+        img_hash = hashlib.blake2b(
+            (img_hash + projections_hash).encode(), digest_size=16
+        ).hexdigest()
+        cached = cache.get(img_name, content_hash=img_hash)
+        if cached is not None and all(k in cached for k in features):
+            projected_data[img_name] = cached
+            continue
+
+        projected = {
+            key: (
+                projections[key].project(value)
+                if value is not None and key in projections
+                else None
+            )
+            for key, value in features.items()
+        }
+        cache.put(img_name, projected, content_hash=img_hash)
+        projected_data[img_name] = projected
+
+    cache.flush()
+    return projected_data
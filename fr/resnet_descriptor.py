@@ -1,15 +1,34 @@
-import json
 import logging
+import os
+import shutil
+import threading
 import traceback
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from time import time
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_hub as hub
-from PIL import Image
 
-from dataset import DATASET_KIND_ALIGNED, get_file_path
+from dataset import (
+    DATASET_KIND_ALIGNED,
+    find_file_path,
+    find_image,
+    read_aligned,
+)
+from fr.distances_engine import (
+    METRIC_MAE,
+    mae_distances,
+    fill_distances_store,
+    gen_progress_logger,
+    stack_features,
+)
+from fr.distances_store import get_distances_store
+from fr.knn_index import (
+    DEFAULT_TOP_K,
+    KNN_INDEX_EXACT,
+    gen_neighbors,
+    neighbors_path,
+)
 from fr.face_decomposition import (
     decompose_face,
     decompose_face_no_blank,
@@ -32,6 +51,22 @@ from fr.face_decomposition import (
     get_rigth_eyebrow,
     get_upper_lip,
 )
+from fr.projection import (
+    DEFAULT_N_COMPONENTS,
+    project_features,
+    projected_distances_path,
+    projection_name,
+)
+from fr.features_cache import (
+    FEATURES_STORAGE_FLOAT32,
+    FEATURES_STORAGES,
+    RESNET_FACEPARTS_FEATURES_CACHE,
+    RESNET_FACEPARTS_NB_FEATURES_CACHE,
+    RESNET_FEATURES_CACHE,
+    get_features_cache,
+    img_content_hash,
+    import_legacy_json,
+)
 from util._telegram import send_simple_message
 
 __DISTANCES_RESNET_PATH = Path("fr", "distances_resnet.json")
@@ -43,33 +78,247 @@ __DISTANCES_TF_RESNET_FACEPARTS_NB_PATH = Path(
 )
 __RESNET_FACEPARTS_NB_DATA_PATH = Path("fr", "resnet_faceparts_data_nb.json")
 
+__RESNET_KEY = "resnet"
+__RESNET_FACEPARTS_KEYS = [
+    "resnet_ears",
+    "resnet_eyebrows",
+    "resnet_eyes",
+    "resnet_eyes_and_eyebrows",
+    "resnet_eyes_and_nose",
+    "resnet_face",
+    "resnet_full_face",
+    "resnet_left_ear",
+    "resnet_left_eye",
+    "resnet_left_eyebrow",
+    "resnet_lower_lip",
+    "resnet_mouth",
+    "resnet_mouth_and_nose",
+    "resnet_nose",
+    "resnet_right_ear",
+    "resnet_right_eye",
+    "resnet_rigth_eyebrow",
+    "resnet_upper_lip",
+]
+
+__RESNET_INPUT_SIZE = 224
+DEFAULT_BATCH_SIZE = 256  # Face part crops by model batch
+DEFAULT_LOG_STEP = 1000
+
 __MODEL_URL = "https://tfhub.dev/google/imagenet/resnet_v2_50/feature_vector/5"
 
-__resnet_model = tf.keras.Sequential(
-    [
-        hub.KerasLayer(__MODEL_URL, trainable=False),  # Can be True, see below.
-    ]
-)
+__MODEL_CACHE_PATH = Path("fr", "models", "resnet_v2_50_feature_vector_5")
+__SAVED_MODEL_FILE = "saved_model.pb"
+
+RESNET_PRECISION_FLOAT32 = "float32"
+RESNET_PRECISION_FLOAT16 = "float16"  # TFLite model with float16 weights
+RESNET_PRECISION_INT8 = "int8"  # TFLite model with dynamic range (int8 weights) quantization
+RESNET_PRECISIONS = [
+    RESNET_PRECISION_FLOAT32,
+    RESNET_PRECISION_FLOAT16,
+    RESNET_PRECISION_INT8,
+]
+
+__resnet_model = None
+__tflite_models = {}
+__resnet_mode = {
+    "precision": RESNET_PRECISION_FLOAT32,
+    "storage": FEATURES_STORAGE_FLOAT32,
+}
+
+
+def __cache_hub_module() -> Path:
+    """
+    Download the TF-Hub module into the local models cache (only the first time).
+    """
+    if __MODEL_CACHE_PATH.joinpath(__SAVED_MODEL_FILE).exists():
+        return __MODEL_CACHE_PATH
+
+    import tensorflow_hub as hub
+
+    logging.info(f"Downloading {__MODEL_URL} into {__MODEL_CACHE_PATH}")
+    tmp_path = __MODEL_CACHE_PATH.with_name(__MODEL_CACHE_PATH.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(hub.resolve(__MODEL_URL), tmp_path)
+    os.replace(tmp_path, __MODEL_CACHE_PATH)
+    return __MODEL_CACHE_PATH
+
+
+def get_resnet_model():
+    """
+    Get the ResNET model, loading it on first use. The TF-Hub module is loaded from the local
+    models cache, so the network is only needed the first time (or copy the SavedModel folder
+    into the cache on air-gapped machines).
+    """
+    global __resnet_model
+    if __resnet_model is None:
+        import tensorflow as tf
+        import tensorflow_hub as hub
+
+        model = tf.keras.Sequential(
+            [
+                hub.KerasLayer(
+                    str(__cache_hub_module()), trainable=False
+                ),  # Can be True, see below.
+            ]
+        )
+        model.build([None, __RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE, 3])  # Batch input shape.
+        __resnet_model = model
+
+    return __resnet_model
+
+
+def warmup_resnet_model(batch_size: int = 1) -> None:
+    """
+    Load the ResNET model of the current precision (see set_resnet_mode) and run it once, so the first real
+    inference does not pay the loading and tracing time.
+    """
+    __infer(
+        np.zeros(
+            (batch_size, __RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE, 3), dtype=np.float32
+        )
+    )
 
-__resnet_model.build([None, 224, 224, 3])  # Batch input shape.
 
+class TfliteModel:
+    """
+    TFLite version of the ResNET model, called as the Keras model (with a batch of images) but returning numpy arrays.
+    """
+
+    def __init__(self, model_path: Path, num_threads: int = None):
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(
+            model_path=str(model_path),
+            num_threads=os.cpu_count() if num_threads is None else num_threads,
+        )
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.input_shape = None
+        self.lock = threading.Lock()  # The interpreter can't be used by several threads at once
+
+    def __call__(self, batch, training=False) -> np.ndarray:
+        batch = np.asarray(batch, dtype=np.float32)
+        with self.lock:
+            if batch.shape != self.input_shape:
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.input_shape = batch.shape
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def get_tflite_model(precision: str) -> TfliteModel:
+    """
+    Get the reduced precision (RESNET_PRECISION_FLOAT16 or RESNET_PRECISION_INT8) TFLite ResNET model.
+    The model is converted once and saved in the local models cache.
+    """
+    model = __tflite_models.get(precision, None)
+    if model is not None:
+        return model
+
+    if precision not in (RESNET_PRECISION_FLOAT16, RESNET_PRECISION_INT8):
+        raise ValueError(f"Invalid TFLite ResNET precision: {precision}")
+
+    model_path = __MODEL_CACHE_PATH.with_name(
+        f"{__MODEL_CACHE_PATH.name}_{precision}.tflite"
+    )
+    if not model_path.exists():
+        import tensorflow as tf
+
+        logging.info(f"Converting the ResNET model to TFLite ({precision})")
+        converter = tf.lite.TFLiteConverter.from_keras_model(get_resnet_model())
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if precision == RESNET_PRECISION_FLOAT16:
+            converter.target_spec.supported_types = [tf.float16]
+        tmp_path = model_path.with_suffix(".tmp")
+        tmp_path.write_bytes(converter.convert())
+        os.replace(tmp_path, model_path)
+
+    model = TfliteModel(model_path)
+    __tflite_models[precision] = model
+    return model
+
+
+def set_resnet_mode(
+    precision: str = RESNET_PRECISION_FLOAT32,
+    storage: str = FEATURES_STORAGE_FLOAT32,
+) -> None:
+    """
+    Select the precision of the ResNET inference and the storage of the ResNET features (see FEATURES_STORAGES).
+    The features of the reduced precision modes are cached apart (e.g. "resnet_int8_int8"), so they are never
+    mixed with the full precision ones.
+    """
+    if precision not in RESNET_PRECISIONS or storage not in FEATURES_STORAGES:
+        raise ValueError(f"Invalid ResNET mode: {precision}, {storage}")
+    __resnet_mode["precision"] = precision
+    __resnet_mode["storage"] = storage
+
+
+def get_resnet_mode() -> tuple:
+    """
+    :return: (precision, storage) of the ResNET features.
+    """
+    return __resnet_mode["precision"], __resnet_mode["storage"]
+
+
+def __resnet_cache_name(name: str) -> str:
+    precision, storage = get_resnet_mode()
+    if precision == RESNET_PRECISION_FLOAT32 and storage == FEATURES_STORAGE_FLOAT32:
+        return name
+    return f"{name}_{precision}_{storage}"
+
+
+def __resnet_cache(name: str):
+    return get_features_cache(__resnet_cache_name(name), storage=get_resnet_mode()[1])
+
+
+def __resnet_import_legacy_json(name: str, json_path: Path, **kwargs):
+    # The legacy JSON features are full precision ones
+    if __resnet_cache_name(name) != name:
+        return __resnet_cache(name)
+    return import_legacy_json(name, json_path, **kwargs)
+
+
+def __infer(batch) -> np.ndarray:
+    precision = get_resnet_mode()[0]
+    if precision == RESNET_PRECISION_FLOAT32:
+        return get_resnet_model()(batch, training=False).numpy()
+    return get_tflite_model(precision)(batch)
+
+
+def calc_features(img_name: str) -> np.ndarray:
+    """
+    Calculate the ResNET features of an aligned image, reading from/writing to the ResNET features cache.
+    """
+    cache = __resnet_cache(RESNET_FEATURES_CACHE)
+    img_hash = img_content_hash(img_name, with_seg_map=False)
+    cached = cache.get(img_name, content_hash=img_hash)
+    if cached is not None and __RESNET_KEY in cached:
+        return cached[__RESNET_KEY]
 
-def calc_features(img_name: str) -> list:
     img_data = np.array(
-        Image.open(get_file_path(img_name, DATASET_KIND_ALIGNED, ".png"))
+        read_aligned(*find_image(img_name, DATASET_KIND_ALIGNED), img_name)
     )
 
+    import tensorflow as tf
+
     img = tf.image.convert_image_dtype(img_data, tf.float32)
     img = tf.image.resize_with_crop_or_pad(img, 224, 224)
     img = img.numpy()
 
     batch = img[np.newaxis]  # Just add one dimension
-    features = __resnet_model(batch)
+    features = __infer(batch)
 
-    return features.numpy().tolist()
+    cache.put(img_name, {__RESNET_KEY: features}, content_hash=img_hash)
+    return features
 
 
-def calc_facepart_features(img_name: str, no_blank=False) -> dict:
+def __gen_facepart_crops(img_name: str, no_blank=False) -> list:
+    """
+    Decompose the face of an image into the crops of all face parts (in __RESNET_FACEPARTS_KEYS order,
+    None for the missing parts).
+    """
     if no_blank:
         tmp_face_parts = decompose_face_no_blank(img_name)
     else:
@@ -97,165 +346,401 @@ def calc_facepart_features(img_name: str, no_blank=False) -> dict:
         "resnet_rigth_eyebrow": get_rigth_eyebrow(tmp_face_parts, no_blank=no_blank),
         "resnet_upper_lip": get_upper_lip(tmp_face_parts, no_blank=no_blank),
     }
+    return [face_parts[key] for key in __RESNET_FACEPARTS_KEYS]
+
 
-    for facepart_key, img_data in face_parts.items():
+def __faceparts_cache(no_blank=False):
+    return __resnet_cache(
+        RESNET_FACEPARTS_NB_FEATURES_CACHE if no_blank else RESNET_FACEPARTS_FEATURES_CACHE
+    )
+
+
+def calc_facepart_features(img_name: str, no_blank=False) -> dict:
+    """
+    Calculate the ResNET features of all face parts of an image ({<resnet key>: features}),
+    reading from/writing to the ResNET faceparts features cache.
+    """
+    cache = __faceparts_cache(no_blank=no_blank)
+    img_hash = img_content_hash(img_name)
+    cached = cache.get(img_name, content_hash=img_hash)
+    if cached is not None and all(k in cached for k in __RESNET_FACEPARTS_KEYS):
+        return cached
+
+    import tensorflow as tf
+
+    crops = []
+    for img_data in __gen_facepart_crops(img_name, no_blank=no_blank):
         try:
             tmp_facepart = tf.image.convert_image_dtype(img_data, tf.float32)
-            tmp_facepart = tf.image.resize_with_crop_or_pad(tmp_facepart, 224, 224)
+            tmp_facepart = tf.image.resize_with_crop_or_pad(
+                tmp_facepart, __RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE
+            )
             tmp_facepart = tmp_facepart.numpy()
         except ValueError:
-            tmp_facepart = np.zeros((224, 224, 3))
+            tmp_facepart = np.zeros((__RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE, 3))
 
-        face_parts[facepart_key] = tmp_facepart
+        crops.append(tmp_facepart)
 
-    batch = np.stack(list(face_parts.values()), axis=0)
-    facepart_features = __resnet_model(batch)
+    batch = np.stack(crops, axis=0)
+    facepart_features = __infer(batch)
 
-    features_dict = {}
-    for facepart_name, features in zip(face_parts.keys(), facepart_features):
-        features_dict[facepart_name] = features.numpy().tolist()
+    features_dict = dict(zip(__RESNET_FACEPARTS_KEYS, facepart_features))
 
+    cache.put(img_name, features_dict, content_hash=img_hash)
     return features_dict
 
 
+def __preprocess_facepart(img_idx, part_idx, crop):
+    import tensorflow as tf
+
+    crop = tf.image.convert_image_dtype(crop, tf.float32)
+    crop = tf.image.resize_with_crop_or_pad(
+        crop, __RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE
+    )
+    return img_idx, part_idx, crop
+
+
+def extract_facepart_features(
+    imgs_names: list,
+    no_blank=False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = None,
+    log_step: int = DEFAULT_LOG_STEP,
+) -> int:
+    """
+    Extract the ResNET features of the face parts of the images that are not (validly) cached yet.
+    The faces are decomposed by a pool of threads, the crops are preprocessed in a tf.data pipeline
+    (parallel map and prefetch) and fed to the model in batches of "batch_size" crops, so the model
+    does not wait for the preprocessing. The features are streamed into the ResNET faceparts features cache.
+
+    :param workers: Number of threads decomposing the faces (all CPUs by default).
+
+    :return: Number of images whose features were extracted.
+    """
+    cache = __faceparts_cache(no_blank=no_blank)
+    workers = os.cpu_count() if workers is None else workers
+
+    # Only the images without valid cached features are extracted
+    names = []
+    hashes = []
+    for img_name in dict.fromkeys(imgs_names):
+        try:
+            img_hash = img_content_hash(img_name)
+        except FileNotFoundError:
+            logging.error(f"Files not found for {img_name}, features not extracted")
+            continue
+
+        cached = cache.get(img_name, content_hash=img_hash)
+        if cached is None or any(k not in cached for k in __RESNET_FACEPARTS_KEYS):
+            names.append(img_name)
+            hashes.append(img_hash)
+
+    if not names:
+        return 0
+
+    import tensorflow as tf
+
+    def decompose(img_name: str) -> list:
+        try:
+            return __gen_facepart_crops(img_name, no_blank=no_blank)
+        except Exception:
+            logging.error(f"Error decomposing {img_name} | no_blank={no_blank}")
+            logging.error(traceback.format_exc())
+            return None
+
+    def gen_crops():
+        blank_crop = np.zeros((__RESNET_INPUT_SIZE, __RESNET_INPUT_SIZE, 3), np.uint8)
+        with ThreadPool(processes=workers) as pool:
+            for img_idx, crops in enumerate(pool.imap(decompose, names)):
+                if crops is None:
+                    continue
+                for part_idx, crop in enumerate(crops):
+                    # The missing (or empty, e.g. one pixel tall) parts are described as blank images
+                    if crop is None or crop.size == 0 or crop.ndim != 3:
+                        crop = blank_crop
+                    yield img_idx, part_idx, crop
+
+    dataset = tf.data.Dataset.from_generator(
+        gen_crops,
+        output_signature=(
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+            tf.TensorSpec(shape=(None, None, 3), dtype=tf.uint8),
+        ),
+    )
+    dataset = (
+        dataset.map(__preprocess_facepart, num_parallel_calls=tf.data.AUTOTUNE)
+        .apply(tf.data.experimental.ignore_errors())
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+    logging.info(
+        f"Extracting ResNET facepart features for {len(names)} images (no_blank={no_blank})"
+    )
+    start_time = time()
+    extracted = 0
+    pending = {}
+    failed = set()
+    for imgs_idxes, parts_idxes, batch in dataset:
+        try:
+            batch_features = __infer(batch)
+        except Exception:
+            # Only the images of the batch are lost, not the whole extraction
+            batch_failed = set(imgs_idxes.numpy().tolist())
+            logging.error(
+                f"Error extracting ResNET facepart features of {[names[i] for i in batch_failed]}"
+            )
+            logging.error(traceback.format_exc())
+            failed |= batch_failed
+            for img_idx in batch_failed:
+                pending.pop(img_idx, None)
+            continue
+
+        for img_idx, part_idx, features in zip(
+            imgs_idxes.numpy(), parts_idxes.numpy(), batch_features
+        ):
+            if img_idx in failed:
+                continue
+            img_features = pending.setdefault(img_idx, {})
+            img_features[__RESNET_FACEPARTS_KEYS[part_idx]] = features
+            if len(img_features) < len(__RESNET_FACEPARTS_KEYS):
+                continue
+
+            cache.put(names[img_idx], pending.pop(img_idx), content_hash=hashes[img_idx])
+            extracted += 1
+            if extracted % log_step == 0:
+                logging.info(
+                    f"ResNET facepart features extraction update. {extracted}/{len(names)} | Total time: {int(time() - start_time)} s"
+                )
+
+    if pending:
+        logging.error(
+            f"Incomplete ResNET facepart features, not cached: {[names[i] for i in pending]}"
+        )
+
+    cache.flush()
+    logging.info(
+        f"ResNET facepart features extraction done. {extracted}/{len(names)} | Total time: {int(time() - start_time)} s"
+    )
+
+    return extracted
+
+
 def calc_resnet_distance(features_1: np.ndarray, features_2: np.ndarray) -> float:
     return np.absolute(
         features_1 - features_2
     ).mean()  # Simple Mean Absolute Error (MAE)
 
 
-def get_json_dict(file_path: Path) -> dict:
+def __gather_mode_features(
+    imgs_names: list, precision: str, storage: str, facepart_key: str = None
+) -> tuple:
+    previous_mode = get_resnet_mode()
+    set_resnet_mode(precision=precision, storage=storage)
     try:
-        return json.load(open(file_path, "r"))
-    except FileNotFoundError:
-        dict_data = {}
-        json.dump(dict_data, open(file_path, "w"))
-        return dict_data
-
-
-def update_json_dict(new_dict_data: dict, file_path: Path) -> None:
-    json.dump(new_dict_data, open(file_path, "w"))
+        features_lst = []
+        for img_name in imgs_names:
+            try:
+                if facepart_key is None:
+                    features_lst.append(calc_features(img_name))
+                else:
+                    features_lst.append(calc_facepart_features(img_name)[facepart_key])
+            except FileNotFoundError:
+                features_lst.append(None)
+    finally:
+        set_resnet_mode(*previous_mode)
+
+    return stack_features(features_lst)
+
+
+def check_resnet_mode(
+    imgs_names: list,
+    precision: str,
+    storage: str = FEATURES_STORAGE_FLOAT32,
+    facepart_key: str = None,
+    top_k: int = 10,
+) -> dict:
+    """
+    Report how much the calc_resnet_distance ranks change with a reduced precision mode (see set_resnet_mode)
+    against the full precision one. For every image, the other images are ranked by distance with both modes.
+
+    :param facepart_key: Compare the features of a face part (e.g. "resnet_eyes") instead of the whole image ones.
+
+    :return: Dict with the mean Kendall tau between the ranks of both modes ("kendall_tau"), the ratio of images
+    with the same nearest image ("top_1"), the mean overlap of the "top_k" nearest images ("top_k") and the mean
+    and max absolute distance errors.
+    """
+    from scipy.stats import kendalltau
+
+    full_features, full_valid = __gather_mode_features(
+        imgs_names, RESNET_PRECISION_FLOAT32, FEATURES_STORAGE_FLOAT32, facepart_key
+    )
+    reduced_features, reduced_valid = __gather_mode_features(
+        imgs_names, precision, storage, facepart_key
+    )
+    valid = full_valid & reduced_valid
+    if valid.sum() < 2:
+        raise ValueError("At least 2 images with features are needed to compare the ranks")
+    full_distances = mae_distances(full_features[valid], full_features[valid])
+    reduced_distances = mae_distances(reduced_features[valid], reduced_features[valid])
+
+    n_imgs = len(full_distances)
+    k = min(top_k, n_imgs - 1)
+    taus = []
+    top_1 = 0
+    top_k_overlap = 0.0
+    for idx in range(n_imgs):
+        others = np.arange(n_imgs) != idx
+        full_row = full_distances[idx, others]
+        reduced_row = reduced_distances[idx, others]
+        taus.append(kendalltau(full_row, reduced_row)[0])
+        full_ranking = np.argsort(full_row, kind="stable")
+        reduced_ranking = np.argsort(reduced_row, kind="stable")
+        top_1 += full_ranking[0] == reduced_ranking[0]
+        top_k_overlap += len(np.intersect1d(full_ranking[:k], reduced_ranking[:k])) / k
+
+    distances_error = np.abs(full_distances - reduced_distances)
+    report = {
+        "precision": precision,
+        "storage": storage,
+        "images": int(n_imgs),
+        "kendall_tau": float(np.nanmean(taus)),
+        "top_1": top_1 / n_imgs,
+        "top_k": top_k_overlap / n_imgs,
+        "mean_distance_error": float(distances_error.mean()),
+        "max_distance_error": float(distances_error.max()),
+    }
+    logging.info(f"ResNET mode check: {report}")
+    return report
 
 
 def gen_resnet_distances(imgs_names: list):
-    distances = get_json_dict(file_path=__DISTANCES_RESNET_PATH)
-    resnet_data = get_json_dict(file_path=__RESNET_DATA_PATH)
+    distances = get_distances_store(
+        file_path=__DISTANCES_RESNET_PATH, scalar_key=__RESNET_KEY
+    )
+    resnet_cache = __resnet_import_legacy_json(
+        RESNET_FEATURES_CACHE,
+        __RESNET_DATA_PATH,
+        key=__RESNET_KEY,
+        hash_func=lambda name: img_content_hash(name, with_seg_map=False),
+    )
     aligned_imgs_paths = [
-        get_file_path(img_name, dataset_kind=DATASET_KIND_ALIGNED)
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
         for img_name in imgs_names
     ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    distances.add_names(names)
+    distances.add_keys([__RESNET_KEY])
 
-    calculated_distances = 0
-    resnet_data_changed = False
-    total_distances = len(aligned_imgs_paths) ** 2
     start_time = time()
-    start_loop_time = time()
-    for path1 in aligned_imgs_paths:
-        tmp_p1 = Path(path1)
-        name_1 = tmp_p1.stem
 
-        # Calculate/recover ResNET data for img1
-        img1_features = resnet_data.get(name_1, None)
-        if img1_features is None:
-
-            try:
-                # Calculate features using ResNET data for img1
-                img1_features = calc_features(img_name=name_1)
-
-                # Save TF ResNET features
-                resnet_data[name_1] = img1_features
+    # Calculate/recover ResNET data for all images
+    resnet_data = {}
+    for name in names:
+        try:
+            resnet_data[name] = calc_features(img_name=name)
+        except FileNotFoundError:
+            logging.error(f"Error calculating ResNET features for {name}")
+            logging.error(traceback.format_exc())
+
+    logging.info("Updating ResNET Data.")
+    resnet_cache.flush()
+
+    # Calculate all distances
+    features, valid = stack_features([resnet_data.get(name, None) for name in names])
+    fill_distances_store(
+        store=distances,
+        key=__RESNET_KEY,
+        names=names,
+        features=features,
+        metric=METRIC_MAE,
+        valid=valid,
+        progress_callback=gen_progress_logger(
+            "ResNET Distances", message_func=send_simple_message
+        ),
+    )
 
-                resnet_data_changed = True
-                logging.info(f"ResNET data calculated for {name_1}")
-            except FileNotFoundError:
-                logging.error(f"Error calculating ResNET features for {name_1}")
-                logging.error(traceback.format_exc())
-                continue
+    # Final messages
+    logging.info(
+        f"ResNET Distances calculation done. Total time: {int(time() - start_time)} s"
+    )
+    send_simple_message(
+        f"ResNET Distances calculation done. Total time: {int(time() - start_time)} s"
+    )
 
-        for path2 in aligned_imgs_paths:
-            start_loop_time = time()
-
-            tmp_p2 = Path(path2)
-            name_2 = tmp_p2.stem
-            tmp_key_1 = f"{name_1} x {name_2}"
-            tmp_key_2 = f"{name_2} x {name_1}"
-
-            # Check for already calculated distances
-            resnet_distance = distances.get(tmp_key_1, None)
-            if resnet_distance is None:
-                resnet_distance = distances.get(tmp_key_2, None)
-
-            # Try recover already calculated distance
-            if resnet_distance is None:
-
-                # Calculate/recover Features data for img2
-                img2_features = resnet_data.get(name_2, None)
-                if img2_features is None:
-                    try:
-                        # Calculate features using ResNET data for img2
-                        img2_features = calc_features(img_name=name_2)
-
-                        # Save ResNET features
-                        resnet_data[name_2] = img2_features
-
-                        resnet_data_changed = True
-                        logging.info(f"ResNET data calculated for {name_2}")
-                    except FileNotFoundError:
-                        logging.error(f"Error calculating ResNET features for {name_2}")
-                        logging.error(traceback.format_exc())
-                        continue
-
-                # Calculate distance
-                distances[tmp_key_1] = calc_resnet_distance(
-                    features_1=np.asarray(img1_features),
-                    features_2=np.asarray(img2_features),
-                )
-            calculated_distances += 1
-            end_loop_time = time()
-            if calculated_distances % 3e5 == 0:
-                send_simple_message(
-                    f"TF ResNET distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-                )
 
-                # Update distances
-                update_json_dict(
-                    new_dict_data=distances, file_path=__DISTANCES_RESNET_PATH
-                )
+def gen_resnet_neighbors(
+    imgs_names: list,
+    k: int = DEFAULT_TOP_K,
+    method: str = KNN_INDEX_EXACT,
+    **index_kwargs,
+):
+    """
+    Calculate the top k ResNET neighbors of every image (e.g. "fr/neighbors_resnet.npz"), without the N x N
+    distances matrix. See fr.knn_index for the methods (KNN_INDEX_EXACT or KNN_INDEX_IVF) and their options.
+    """
+    resnet_cache = __resnet_import_legacy_json(
+        RESNET_FEATURES_CACHE,
+        __RESNET_DATA_PATH,
+        key=__RESNET_KEY,
+        hash_func=lambda name: img_content_hash(name, with_seg_map=False),
+    )
+    names = [
+        Path(find_file_path(img_name, DATASET_KIND_ALIGNED)).stem
+        for img_name in imgs_names
+    ]
 
-                # Update ResNET tmp data if needed
-                if resnet_data_changed:
-                    logging.info("Updating ResNET Data.")
-                    update_json_dict(
-                        new_dict_data=resnet_data, file_path=__RESNET_DATA_PATH
-                    )
-                    resnet_data_changed = False
-
-        # Inform state
-        logging.info(
-            f"ResNET Distances calculation done for {name_1}. Total time: {int(time() - start_time)} s"
-        )
-        logging.info(
-            f"ResNET Distances calculation update. {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-        )
+    start_time = time()
 
-    # Save final results
-    update_json_dict(new_dict_data=distances, file_path=__DISTANCES_RESNET_PATH)
-    update_json_dict(new_dict_data=resnet_data, file_path=__RESNET_DATA_PATH)
+    resnet_data = {}
+    for name in names:
+        try:
+            resnet_data[name] = calc_features(img_name=name)
+        except FileNotFoundError:
+            logging.error(f"Error calculating ResNET features for {name}")
+            logging.error(traceback.format_exc())
+    resnet_cache.flush()
+
+    features, valid = stack_features([resnet_data.get(name, None) for name in names])
+    gen_neighbors(
+        neighbors_path(__DISTANCES_RESNET_PATH),
+        names,
+        features,
+        valid=valid,
+        k=k,
+        method=method,
+        metric=METRIC_MAE,
+        **index_kwargs,
+    )
 
-    # Final messages
     logging.info(
-        f"ResNET Distances calculation done. Total time: {int(time() - start_time)} s"
+        f"ResNET Neighbors calculation done. Total time: {int(time() - start_time)} s"
     )
     send_simple_message(
-        f"ResNET Distances calculation done. Total time: {int(time() - start_time)} s"
+        f"ResNET Neighbors calculation done. Total time: {int(time() - start_time)} s"
     )
 
 
-def gen_resnet_faceparts_distances(imgs_names: list, no_blank=False):
-    tmp_distances_file = (
+def gen_resnet_faceparts_distances(
+    imgs_names: list,
+    no_blank=False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    projection: str = None,
+    n_components: int = DEFAULT_N_COMPONENTS,
+):
+    """
+    :param projection: Calculate the distances in a reduced space (PROJECTION_PCA or PROJECTION_RANDOM)
+    of "n_components" dimensions. They are saved apart (e.g. "fr/distances_resnet_faceparts_pca64.json").
+    """
+    tmp_projection_name = (
+        projection_name(projection, n_components) if projection is not None else None
+    )
+    tmp_distances_file = projected_distances_path(
         __DISTANCES_TF_RESNET_FACEPARTS_PATH
         if not no_blank
-        else __DISTANCES_TF_RESNET_FACEPARTS_NB_PATH
+        else __DISTANCES_TF_RESNET_FACEPARTS_NB_PATH,
+        tmp_projection_name,
     )
     tmp_resnet_data_file = (
         __RESNET_FACEPARTS_DATA_PATH
@@ -263,132 +748,70 @@ def gen_resnet_faceparts_distances(imgs_names: list, no_blank=False):
         else __RESNET_FACEPARTS_NB_DATA_PATH
     )
 
-    distances = get_json_dict(file_path=tmp_distances_file)
-    resnet_data = get_json_dict(file_path=tmp_resnet_data_file)
+    distances = get_distances_store(file_path=tmp_distances_file)
+    resnet_cache = __resnet_import_legacy_json(
+        RESNET_FACEPARTS_NB_FEATURES_CACHE if no_blank else RESNET_FACEPARTS_FEATURES_CACHE,
+        tmp_resnet_data_file,
+        hash_func=img_content_hash,
+    )
 
     aligned_imgs_paths = [
-        get_file_path(img_name, dataset_kind=DATASET_KIND_ALIGNED)
+        find_file_path(img_name, DATASET_KIND_ALIGNED)
         for img_name in imgs_names
     ]
+    names = [Path(path).stem for path in aligned_imgs_paths]
+    distances.add_names(names)
+    distances.add_keys(__RESNET_FACEPARTS_KEYS)
 
-    calculated_distances = 0
-    resnet_data_changed = False
-    total_distances = len(aligned_imgs_paths) ** 2
     start_time = time()
-    start_loop_time = time()
-    for path1 in aligned_imgs_paths:
-        tmp_p1 = Path(path1)
-        name_1 = tmp_p1.stem
-
-        # Calculate/recover TF ResNET data for img1
-        img1_features = resnet_data.get(name_1, None)
-        if img1_features is None:
-
-            try:
-                # Calculate FacePart features using TF ResNET data for img1
-                img1_features = calc_facepart_features(
-                    img_name=name_1, no_blank=no_blank
-                )
 
-                # Save ResNET features
-                resnet_data[name_1] = img1_features
-
-                resnet_data_changed = True
-                logging.info(
-                    f"ResNET Faceparts data calculated for {name_1} | no_blank={no_blank}"
-                )
-            except FileNotFoundError:
-                logging.error(
-                    f"Error calculating ResNET facepart features for {name_1} | no_blank={no_blank}"
-                )
-                logging.error(traceback.format_exc())
-                continue
-
-        for path2 in aligned_imgs_paths:
-            start_loop_time = time()
-
-            tmp_p2 = Path(path2)
-            name_2 = tmp_p2.stem
-            tmp_key_1 = f"{name_1} x {name_2}"
-            tmp_key_2 = f"{name_2} x {name_1}"
-
-            # Check for already calculated distances
-            tmp_distances = distances.get(tmp_key_1, {})
-            if not tmp_distances:
-                tmp_distances = distances.get(tmp_key_2, {})
-
-            # Try recover already calculated distance
-            resnet_distance = tmp_distances.get(list(img1_features.keys())[0], None)
-            if resnet_distance is None:
-
-                img2_features = resnet_data.get(name_2, None)
-                if img2_features is None:
-                    try:
-                        # Calculate FacePart features using TF ResNET data for img2
-                        img2_features = calc_facepart_features(
-                            img_name=name_2, no_blank=no_blank
-                        )
-
-                        # Save TF ResNET features
-                        resnet_data[name_2] = img2_features
-
-                        resnet_data_changed = True
-                        logging.info(
-                            f"ResNET Faceparts data calculated for {name_2} | no_blank={no_blank}"
-                        )
-                    except FileNotFoundError:
-                        logging.error(
-                            f"Error calculating facepart features for {name_2} | no_blank={no_blank}"
-                        )
-                        logging.error(traceback.format_exc())
-                        continue
-
-                # Calculate distance
-                for key, tmp_features_1 in img1_features.items():
-                    tmp_features_2 = img2_features.get(key)
-                    tmp_distances[key] = calc_resnet_distance(
-                        features_1=np.asarray(tmp_features_1),
-                        features_2=np.asarray(tmp_features_2),
-                    )
-
-                distances[tmp_key_1] = tmp_distances
-
-            calculated_distances += 1
-            end_loop_time = time()
-            if calculated_distances % 3e5 == 0:
-                send_simple_message(
-                    f"TF ResNET Faceparts Distances calculation update (no_blank={no_blank}). {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
-                )
-
-                # Update results
-                update_json_dict(
-                    new_dict_data=distances,
-                    file_path=tmp_distances_file,
-                )
+    # Extract the missing features in a streaming pipeline, then recover all of them from the cache
+    extract_facepart_features(names, no_blank=no_blank, batch_size=batch_size)
+    resnet_data = {}
+    for name in names:
+        try:
+            resnet_data[name] = calc_facepart_features(img_name=name, no_blank=no_blank)
+        except FileNotFoundError:
+            logging.error(
+                f"Error calculating ResNET facepart features for {name} | no_blank={no_blank}"
+            )
+            logging.error(traceback.format_exc())
+
+    logging.info(f"Updating ResNET Faceparts Data. (no_blank={no_blank})")
+    resnet_cache.flush()
+
+    if projection is not None:
+        logging.info(f"Projecting ResNET Faceparts Data ({tmp_projection_name})")
+        resnet_data = project_features(
+            resnet_data,
+            __resnet_cache_name(
+                RESNET_FACEPARTS_NB_FEATURES_CACHE
+                if no_blank
+                else RESNET_FACEPARTS_FEATURES_CACHE
+            ),
+            method=projection,
+            n_components=n_components,
+            hash_func=img_content_hash,
+        )
 
-                # Update TF ResNET Faceparts Tmp data if needed
-                if resnet_data_changed:
-                    logging.info(
-                        f"Updating ResNET Faceparts Data. (no_blank={no_blank})"
-                    )
-                    update_json_dict(
-                        new_dict_data=resnet_data,
-                        file_path=tmp_resnet_data_file,
-                    )
-                    resnet_data_changed = False
-
-        # Inform state
-        logging.info(
-            f"ResNET Faceparts Distances calculation done for {name_1} (no_blank={no_blank}). Total time: {int(time() - start_time)} s"
+    # Calculate all distances, face part by face part
+    for key in __RESNET_FACEPARTS_KEYS:
+        features, valid = stack_features(
+            [resnet_data.get(name, {}).get(key, None) for name in names]
         )
-        logging.info(
-            f"ResNET Faceparts Distances calculation update (no_blank={no_blank}). {calculated_distances}/{total_distances} -- {round((calculated_distances/total_distances)*100, 2)}% | Total time: {int(time() - start_time)} s | Last loop time: {round(end_loop_time - start_loop_time, 4)} s"
+        fill_distances_store(
+            store=distances,
+            key=key,
+            names=names,
+            features=features,
+            metric=METRIC_MAE,
+            valid=valid,
+            progress_callback=gen_progress_logger(
+                f"TF ResNET Faceparts Distances ({key}, no_blank={no_blank}, projection={tmp_projection_name})",
+                message_func=send_simple_message,
+            ),
         )
 
-    # Save final results
-    update_json_dict(new_dict_data=distances, file_path=tmp_distances_file)
-    update_json_dict(new_dict_data=resnet_data, file_path=tmp_resnet_data_file)
-
     # Final messages
     logging.info(
         f"ResNET Faceparts Distances calculation done (no_blank={no_blank}). Total time: {int(time() - start_time)} s"
@@ -4,8 +4,13 @@ import traceback
 from pathlib import Path
 
 from dataset import DATASET_KIND_ALIGNED, DATASET_KIND_STR, gen_dataset_index
-from fr.distances_generator import gen_dlib_distances, gen_dlib_faceparts_distances
+from fr.distances_generator import (
+    gen_dlib_distances,
+    gen_dlib_faceparts_distances,
+    gen_dlib_neighbors,
+)
 from fr.face_decomposition import decompose_face
+from fr.knn_index import KNN_INDEX_EXACT
 from util._telegram import send_simple_message
 
 logging.basicConfig(
@@ -14,6 +19,8 @@ logging.basicConfig(
 )
 
 __NAMES_TO_CALCULATE_DISTANCES_PATH = Path("names_to_calculate_distances.json")
+__NEIGHBORS_TOP_K = None  # Also calculate the top k neighbors lists of every image
+__NEIGHBORS_INDEX = KNN_INDEX_EXACT  # KNN_INDEX_EXACT or KNN_INDEX_IVF (approximate)
 
 
 def get_names_to_calculate(how_many_imgs_by_person=5):
@@ -89,6 +96,13 @@ if __name__ == "__main__":
         logging.info("Starting DLIB Faceparts distances calculation")
         gen_dlib_faceparts_distances(imgs_names=imgs_names)
         send_simple_message("Gen DLIB Faceparts distances matrix done!")
+
+        if __NEIGHBORS_TOP_K is not None:
+            logging.info("Starting DLIB neighbors calculation")
+            gen_dlib_neighbors(
+                imgs_names=imgs_names, k=__NEIGHBORS_TOP_K, method=__NEIGHBORS_INDEX
+            )
+            send_simple_message("Gen DLIB neighbors done!")
     except:
         send_simple_message("Error generating distances matrix.")
         logging.error(traceback.format_exc())
@@ -5,7 +5,12 @@ from pathlib import Path
 
 from dataset import DATASET_KIND_ALIGNED, DATASET_KIND_STR, gen_dataset_index
 from fr.face_decomposition import decompose_face
-from fr.resnet_descriptor import gen_resnet_distances, gen_resnet_faceparts_distances
+from fr.knn_index import KNN_INDEX_EXACT
+from fr.resnet_descriptor import (
+    gen_resnet_distances,
+    gen_resnet_faceparts_distances,
+    gen_resnet_neighbors,
+)
 from util._telegram import send_simple_message
 
 logging.basicConfig(
@@ -14,6 +19,10 @@ logging.basicConfig(
 )
 
 __NAMES_TO_CALCULATE_DISTANCES_PATH = Path("names_to_calculate_distances.json")
+__FACEPARTS_PROJECTION = None  # PROJECTION_PCA or PROJECTION_RANDOM to also calculate reduced distances
+__FACEPARTS_PROJECTION_COMPONENTS = 64
+__NEIGHBORS_TOP_K = None  # Also calculate the top k neighbors lists of every image
+__NEIGHBORS_INDEX = KNN_INDEX_EXACT  # KNN_INDEX_EXACT or KNN_INDEX_IVF (approximate)
 
 
 def get_names_to_calculate(how_many_imgs_by_person=5):
@@ -99,6 +108,26 @@ if __name__ == "__main__":
         )
         gen_resnet_faceparts_distances(imgs_names=imgs_names, no_blank=True)
         send_simple_message("Gen ResNET Faceparts (No Blank) distances matrix done!")
+
+        if __FACEPARTS_PROJECTION is not None:
+            send_simple_message(
+                f"Starting projected ({__FACEPARTS_PROJECTION}) ResNET Faceparts distances calculation"
+            )
+            for no_blank in [False, True]:
+                gen_resnet_faceparts_distances(
+                    imgs_names=imgs_names,
+                    no_blank=no_blank,
+                    projection=__FACEPARTS_PROJECTION,
+                    n_components=__FACEPARTS_PROJECTION_COMPONENTS,
+                )
+            send_simple_message("Gen projected ResNET Faceparts distances matrix done!")
+
+        if __NEIGHBORS_TOP_K is not None:
+            logging.info("Starting ResNET neighbors calculation")
+            gen_resnet_neighbors(
+                imgs_names=imgs_names, k=__NEIGHBORS_TOP_K, method=__NEIGHBORS_INDEX
+            )
+            send_simple_message("Gen ResNET neighbors done!")
     except:
         send_simple_message("Error generating ResNET distances matrix.")
         logging.error(traceback.format_exc())
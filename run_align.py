@@ -5,6 +5,7 @@ from pathlib import Path
 
 __OUTPUT_SIZE = 256
 __TRANSFORM_SIZE = 512
+__PACK_SHARDS = False  # Also pack the aligned images into tar shards
 
 if __name__ == "__main__":
     try:
@@ -26,7 +27,11 @@ if __name__ == "__main__":
         )
 
         # Update dataset index
-        _ = ds.get_dataset_index(recreate=True)
+        _ = ds.refresh_dataset_index()
+
+        if __PACK_SHARDS:
+            for dataset in ds.get_dataset_catalog().datasets():
+                ds.pack_shards(dataset, ds.DATASET_KIND_ALIGNED)
 
         send_simple_message("Alignment finished")
     except Exception as e:
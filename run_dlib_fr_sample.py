@@ -1,10 +1,10 @@
-from dataset import get_file_path, DATASET_KIND_ALIGNED
+from dataset import find_file_path, DATASET_KIND_ALIGNED
 from fr.dlib import DlibFr
 
 TOLERANCE = 0.6
 
-person_1_path = get_file_path("25004", DATASET_KIND_ALIGNED, ".png")
-person_2_path = get_file_path("25007", DATASET_KIND_ALIGNED, ".png")
+person_1_path = find_file_path("25004", DATASET_KIND_ALIGNED)
+person_2_path = find_file_path("25007", DATASET_KIND_ALIGNED)
 
 dlib_fr = DlibFr()
 features_1 = dlib_fr.gen_features(person_1_path)
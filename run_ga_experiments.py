@@ -2,6 +2,7 @@ import sys
 import traceback
 
 from experiments.dlib_resnet_ga_approximation import run_experiment, run_experiment_v2
+from experiments.ga_scheduler import run_experiment_parallel
 from util._telegram import send_simple_message
 import logging
 
@@ -11,6 +12,9 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+PARALLEL_WORKERS = 0  # Number of processes to run the experiments (None for all the CPUs, 0 to run sequentially)
+PARALLEL_ISLANDS = 1  # Islands (populations migrating individuals) by experiment, when run in parallel
+
 if __name__ == "__main__":
     params = None
 
@@ -32,7 +36,15 @@ if __name__ == "__main__":
     logging.info(f"Running experiment with params: {params}")
 
     try:
-        run_experiment_v2(params_comb=params, verbose=False)
+        if PARALLEL_WORKERS == 0:
+            run_experiment_v2(params_comb=params, verbose=False)
+        else:
+            run_experiment_parallel(
+                params_comb=params,
+                workers=PARALLEL_WORKERS,
+                islands=PARALLEL_ISLANDS,
+                verbose=False,
+            )
     except:
         print(traceback.format_exc())
         logging.error(traceback.format_exc())
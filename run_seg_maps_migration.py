@@ -0,0 +1,42 @@
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import dataset as ds
+from util._telegram import send_simple_message
+
+# One-off migration of the legacy int64 segmentation maps to compact uint8 maps
+__SEG_MAP_FORMAT = ds.SEG_MAP_FORMAT_NPY  # or ds.SEG_MAP_FORMAT_COMPRESSED / ds.SEG_MAP_FORMAT_RLE
+__WORKERS = 8
+
+if __name__ == "__main__":
+    seg_maps_paths = ds.get_seg_maps_dataset_index()["img_path"].tolist()
+    send_simple_message(
+        f"Migrating {len(seg_maps_paths)} segmentation maps to '{__SEG_MAP_FORMAT}'."
+    )
+
+    start_time = time()
+    old_total = 0
+    new_total = 0
+    try:
+        with ThreadPool(processes=__WORKERS) as pool:
+            for count, (old_size, new_size) in enumerate(
+                pool.imap_unordered(
+                    lambda path: ds.migrate_seg_map(path, seg_map_format=__SEG_MAP_FORMAT),
+                    seg_maps_paths,
+                    chunksize=64,
+                ),
+                start=1,
+            ):
+                old_total += old_size
+                new_total += new_size
+                if count % 1e4 == 0:
+                    print(
+                        f"{count}/{len(seg_maps_paths)} segmentation maps migrated in {round(time() - start_time, 2)} s."
+                    )
+    except Exception as e:
+        send_simple_message("Some error occurred while migrating segmentation maps")
+        raise e
+
+    send_simple_message(
+        f"Segmentation maps migration finished in {round(time() - start_time)} seconds. {round(old_total / 2**20)} MB -> {round(new_total / 2**20)} MB"
+    )
@@ -5,6 +5,8 @@ import dataset as ds
 from BiSeNet.face_seg import segment_images
 from util._telegram import send_simple_message
 
+__PACK_SHARDS = False  # Also pack the segmentation maps (as uint8) into tar shards
+
 # Get the list of imgs to segment, except the already segmented ones
 aligned_dataset = ds.get_aligned_imgs_dataset_index()
 seg_map_dataset = ds.get_seg_maps_dataset_index()
@@ -51,3 +53,8 @@ except Exception as e:
     raise e
 
 send_simple_message(f"Segmentation finished in {round(time() - start_time)} seconds")
+
+if __PACK_SHARDS:
+    ds.refresh_dataset_index()
+    for dataset in ds.get_dataset_catalog().datasets():
+        ds.pack_shards(dataset, ds.DATASET_KIND_SEG_MAP)